@@ -0,0 +1,74 @@
+"""Microbenchmark of rendering and writing the exposition with the full sensor lineup.
+
+Compares prometheus_client.generate_latest() and write_to_textfile() with the pre-rendered
+ExpositionTemplate used by QwiicExporter, for one and for several devices, with child gauges
+and with the flat collector.
+
+Run from the repository root with: python -m benchmarks.bench_exposition
+"""
+
+import logging
+import os
+import tempfile
+import timeit
+
+import prometheus_client  # type: ignore
+
+from qwiic_exporter.qwiic_exporter import QwiicExporter
+
+HEADER = "rtcDate,rtcTime,aX,aY,aZ,gX,gY,gZ,mX,mY,mZ,imu_degC,tvoc_ppb,co2_ppm,prox(no unit),ambient_lux,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count,"
+LINE = "01/07/2000,16:18:45.54,-638.67,153.32,782.23,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,99500.64,53.06,152.98,6.32,1.00,2523,"
+RENDERS = 2000
+
+
+def exporter(devices: int, flat: bool, prompath: str) -> QwiicExporter:
+    """Return an exporter with the full lineup on the given number of devices."""
+    qwe = QwiicExporter()
+    qwe.use_flat_collector = flat
+    qwe.prompath = prompath
+    if devices > 1:
+        qwe.serialport = "/dev/ttyUSB0"
+        for number in range(1, devices):
+            qwe.add_device(serialport=f"/dev/ttyUSB{number}")
+    for device in qwe.devices:
+        device.parse_sensor_config(headerline=HEADER)
+        device.ingest_data(data=LINE)
+    return qwe
+
+
+def main() -> None:
+    """Render and write the exposition with and without the template and print renders per second."""
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prompath = os.path.join(tmpdir, "qwiic.prom")
+        for devices in 1, 8:
+            for flat in False, True:
+                qwe = exporter(devices=devices, flat=flat, prompath=prompath)
+                results = {
+                    "generate_latest()": timeit.timeit(
+                        lambda: prometheus_client.generate_latest(qwe.registry),
+                        number=RENDERS,
+                    ),
+                    "template render": timeit.timeit(
+                        qwe.template.render, number=RENDERS
+                    ),
+                    "write_to_textfile()": timeit.timeit(
+                        lambda: prometheus_client.write_to_textfile(
+                            prompath, qwe.registry
+                        ),
+                        number=RENDERS,
+                    ),
+                    "template write": timeit.timeit(
+                        qwe.write_textfile_collector_file, number=RENDERS
+                    ),
+                }
+                print(f"{devices} device(s), {'flat collector' if flat else 'gauges'}:")
+                for name, seconds in results.items():
+                    print(f"{name:>20}: {RENDERS / seconds:10.0f} renders/s")
+                print(
+                    f"{'write speedup':>20}: {results['write_to_textfile()'] / results['template write']:10.2f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
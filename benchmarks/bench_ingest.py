@@ -0,0 +1,68 @@
+"""Microbenchmark of QwiicExporter.ingest_data() with the full sensor lineup.
+
+Compares the compiled IngestPlan used by ingest_data() with the old approach of
+resolving every child gauge with Gauge.labels() for every value of every line,
+the str based ingest_data() with the bytes based ingest_raw() and ingest_raw_batch(), and
+child gauges with the flat value array of --flat-collector.
+
+Run from the repository root with: python -m benchmarks.bench_ingest
+"""
+
+import logging
+import timeit
+
+from qwiic_exporter.qwiic_exporter import QwiicExporter, logger
+
+HEADER = "rtcDate,rtcTime,aX,aY,aZ,gX,gY,gZ,mX,mY,mZ,imu_degC,tvoc_ppb,co2_ppm,prox(no unit),ambient_lux,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count,"
+LINE = "01/07/2000,16:18:45.54,-638.67,153.32,782.23,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,99500.64,53.06,152.98,6.32,1.00,2523,"
+RAWLINE = LINE.encode("ASCII")
+LINES = 20000
+BATCH = 100
+
+
+def ingest_with_labels(qwe: QwiicExporter, data: str) -> None:
+    """Ingest a line the way ingest_data() did before the IngestPlan existed."""
+    readings = data.strip(",").split(",")[2:]
+    for gauge, reading in zip(qwe.gaugeindex, readings):
+        gauge[5].labels(sensor=gauge[0], sensorindex=gauge[1], subsensor=gauge[2]).set(
+            float(reading) * gauge[4]
+        )
+        logger.debug(f"Set gauge {gauge[3]} to {float(reading) * gauge[4]}")
+
+
+def main() -> None:
+    """Run all ingest variants and print lines per second for each."""
+    logging.basicConfig(level=logging.INFO)
+    qwe = QwiicExporter()
+    qwe.parse_sensor_config(headerline=HEADER)
+    flat = QwiicExporter()
+    flat.use_flat_collector = True
+    flat.parse_sensor_config(headerline=HEADER)
+
+    results = {
+        "labels() per value": timeit.timeit(
+            lambda: ingest_with_labels(qwe, LINE), number=LINES
+        ),
+        "compiled plan": timeit.timeit(
+            lambda: qwe.ingest_data(data=LINE), number=LINES
+        ),
+        "bytes parser": timeit.timeit(
+            lambda: qwe.ingest_raw(line=RAWLINE), number=LINES
+        ),
+        f"batches of {BATCH}": timeit.timeit(
+            lambda: qwe.ingest_raw_batch(lines=[RAWLINE] * BATCH),
+            number=LINES // BATCH,
+        ),
+        "flat collector": timeit.timeit(
+            lambda: flat.ingest_raw(line=RAWLINE), number=LINES
+        ),
+    }
+    for name, seconds in results.items():
+        print(f"{name:>20}: {LINES / seconds:10.0f} lines/s")
+    print(
+        f"{'speedup':>20}: {results['labels() per value'] / results['compiled plan']:10.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Replay benchmark suite for the whole ingest path.
+
+Generates captures for a number of sensor lineups and output rates, replays each of them
+through QwiicExporter.replay() with the textfile written at each flush interval and prints the throughput and per stage latencies. The results
+can be saved as JSON and compared with an earlier run to catch regressions.
+
+Run from the repository root with: python -m benchmarks.bench_replay [--save results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+import typing
+
+from qwiic_exporter.qwiic_exporter import (
+    LineGenerator,
+    QwiicExporter,
+    SensorCatalogue,
+    SensorConfig,
+)
+
+LINEUPS: typing.Dict[str, SensorConfig] = {
+    "single": [("OpenLog Artemis", ["Frequency", "Counter"])],
+    "weather": [
+        ("BME280 atmospheric sensor", ["Pressure", "Humidity", "Temperature"]),
+        ("OpenLog Artemis", ["Frequency", "Counter"]),
+    ],
+    "full": [
+        ("ICM-20948 IMU", ["Accelerometer", "Gyro", "Magnetometer", "Temperature"]),
+        ("CCS811 air quality sensor", ["TVOC", "CO2"]),
+        ("VCNL4040 proximity sensor", ["Proximity", "Ambient Light"]),
+        (
+            "BME280 atmospheric sensor",
+            ["Pressure", "Humidity", "Altitude", "Temperature"],
+        ),
+        ("OpenLog Artemis", ["Frequency", "Counter"]),
+    ],
+    "duplicates": [
+        ("VCNL4040 proximity sensor", ["Proximity", "Ambient Light"]),
+        ("VCNL4040 proximity sensor", ["Proximity", "Ambient Light"]),
+        ("VCNL4040 proximity sensor", ["Proximity", "Ambient Light"]),
+        ("MS8607 PHT sensor", ["Humidity", "Pressure", "Temperature"]),
+        ("MS8607 PHT sensor", ["Humidity", "Pressure", "Temperature"]),
+    ],
+}
+
+# output rates in lines per second, and how many seconds of output to replay
+RATES = [1, 10, 100]
+SECONDS = 200
+# seconds between two writes of the textfile, the default and a write after every line
+FLUSH_INTERVALS = [1.0, 0.0]
+
+
+def write_capture(path: pathlib.Path, sensorconfig: SensorConfig, rate: int) -> None:
+    """Write a capture with a reboot banner, a header line and SECONDS seconds of data lines at rate."""
+    generator = LineGenerator(
+        sensors=SensorCatalogue.load().sensors,
+        sensorconfig=sensorconfig,
+        rate=rate,
+        seed=1,
+    )
+    with path.open("wb") as f:
+        f.write(b"Artemis OpenLog v1.9\r\n")
+        f.write(generator.header_line())
+        for _ in range(SECONDS * rate):
+            f.write(generator.data_line())
+
+
+def run(tmpdir: pathlib.Path) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Replay all lineups at all rates and flush intervals, and return the summaries keyed by scenario name."""
+    results = {}
+    for lineup, sensorconfig in LINEUPS.items():
+        for rate in RATES:
+            capture = tmpdir / f"{lineup}@{rate}Hz.txt"
+            write_capture(capture, sensorconfig, rate)
+            for flush_interval in FLUSH_INTERVALS:
+                name = f"{lineup}@{rate}Hz"
+                if flush_interval != FLUSH_INTERVALS[0]:
+                    # the default keeps the names of earlier results, for --compare
+                    name += f"/flush={flush_interval:g}s"
+                qwe = QwiicExporter()
+                qwe.prompath = str(tmpdir / f"{lineup}@{rate}Hz.prom")
+                qwe.flush_interval = flush_interval
+                results[name] = qwe.replay(path=str(capture)).summary()
+    return results
+
+
+def main() -> None:
+    """Run the suite, print the results, and optionally save them or compare them with a baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", help="Save the results as JSON to this path.")
+    parser.add_argument(
+        "--compare", help="Compare the results with the JSON results in this path."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="The fraction of lost throughput to report as a regression. Defaults to 0.2.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run(pathlib.Path(tmpdir))
+
+    print(
+        f"{'scenario':>24} {'lines':>7} {'lines/s':>9} {'ingest p50':>11} {'ingest p99':>11} {'write p99':>10}"
+    )
+    for name, summary in results.items():
+        stages = summary["stages"]
+        print(
+            f"{name:>24} {summary['lines']:>7} {summary['lines_per_second']:>9.0f} {stages['ingest']['p50_us']:>9.1f}us {stages['ingest']['p99_us']:>9.1f}us {stages['write']['p99_us']:>8.1f}us"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = [
+            name
+            for name, summary in results.items()
+            if name in baseline
+            and summary["lines_per_second"]
+            < baseline[name]["lines_per_second"] * (1 - args.tolerance)
+        ]
+        for name in regressions:
+            print(
+                f"REGRESSION {name}: {results[name]['lines_per_second']:.0f} lines/s, baseline {baseline[name]['lines_per_second']:.0f} lines/s"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Benchmark of header line parsing with big sensor catalogues.
+
+Compares building the combinatorial signature lookup table and matching headers by trying
+every prefix length, with building the SignatureMatcher trie and matching headers with it,
+and with loading the compiled catalogue from a SensorCatalogue index file.
+The catalogues are synthetic, with a configurable number of sensors and subsensors per sensor.
+
+Run from the repository root with: python -m benchmarks.bench_signature_matching
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+import typing
+
+from qwiic_exporter.qwiic_exporter import (
+    QwiicExporter,
+    SensorCatalogue,
+    Sensors as Catalogue,
+    SignatureMatcher,
+)
+
+
+def make_catalogue(sensorcount: int, subsensorcount: int) -> Catalogue:
+    """Return a sensors dict with sensorcount sensors with subsensorcount single metric subsensors each."""
+    return {
+        f"sensor{s}": {
+            f"subsensor{u}": [(f"s{s}_u{u}", f"qwiic_s{s}_u{u}", "Synthetic metric", 1)]
+            for u in range(subsensorcount)
+        }
+        for s in range(sensorcount)
+    }
+
+
+def make_header(catalogue: Catalogue) -> typing.List[str]:
+    """Return the header tokens of a lineup with every other subsensor of every sensor enabled."""
+    return [
+        metric[0]
+        for subsensors in catalogue.values()
+        for metrics in list(subsensors.values())[::2]
+        for metric in metrics
+    ]
+
+
+def match_with_table(
+    signatures: typing.Dict[str, str], headerlist: typing.List[str]
+) -> int:
+    """Match a header the way parse_sensor_config() did with the lookup table, return the number of sensors."""
+    sensors = 0
+    while headerlist:
+        for i in reversed(range(0, len(headerlist) + 1)):
+            if ",".join(headerlist[0:i]) in signatures:
+                break
+        else:
+            break
+        headerlist = headerlist[i:]
+        sensors += 1
+    return sensors
+
+
+def match_with_matcher(matcher: SignatureMatcher, headerlist: typing.List[str]) -> int:
+    """Match a header with the SignatureMatcher, return the number of sensors."""
+    sensors = 0
+    position = 0
+    while position < len(headerlist):
+        match = matcher.longest_match(headerlist, position)
+        if not match:
+            break
+        position = match[2]
+        sensors += 1
+    return sensors
+
+
+def main() -> None:
+    """Run both approaches for a range of catalogue sizes and print the timings."""
+    logging.basicConfig(level=logging.INFO)
+    print(
+        f"{'sensors':>8} {'subsensors':>10} {'table build':>12} {'table match':>12} {'trie build':>12} {'trie match':>12} {'json+build':>12} {'index load':>12}"
+    )
+    for sensorcount, subsensorcount in [(6, 4), (50, 4), (200, 4), (50, 8), (50, 12)]:
+        catalogue = make_catalogue(sensorcount, subsensorcount)
+        headerlist = make_header(catalogue)
+
+        qwe = QwiicExporter()
+        qwe.sensors = catalogue
+        start = time.perf_counter()
+        signatures = qwe.get_sensor_signature_lookup_table()
+        table_build = time.perf_counter() - start
+        start = time.perf_counter()
+        assert match_with_table(signatures, headerlist) == sensorcount
+        table_match = time.perf_counter() - start
+
+        start = time.perf_counter()
+        matcher = SignatureMatcher(catalogue)
+        trie_build = time.perf_counter() - start
+        start = time.perf_counter()
+        assert match_with_matcher(matcher, headerlist) == sensorcount
+        trie_match = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "sensors.json")
+            indexpath = os.path.join(tmpdir, "sensors.index")
+            with open(path, "w") as f:
+                json.dump(
+                    {
+                        sensorname: {
+                            subsensorname: [
+                                {"header": m[0], "metric": m[1], "help": m[2]}
+                                for m in metrics
+                            ]
+                            for subsensorname, metrics in subsensors.items()
+                        }
+                        for sensorname, subsensors in catalogue.items()
+                    },
+                    f,
+                )
+            start = time.perf_counter()
+            SensorCatalogue.from_index(path, indexpath)
+            catalogue_build = time.perf_counter() - start
+            start = time.perf_counter()
+            SensorCatalogue.from_index(path, indexpath)
+            index_load = time.perf_counter() - start
+
+        print(
+            f"{sensorcount:>8} {subsensorcount:>10} {table_build * 1000:>10.2f}ms {table_match * 1000:>10.2f}ms {trie_build * 1000:>10.2f}ms {trie_match * 1000:>10.2f}ms {catalogue_build * 1000:>10.2f}ms {index_load * 1000:>10.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
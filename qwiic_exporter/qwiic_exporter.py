@@ -5,204 +5,242 @@ Can be installed from PyPi https://pypi.org/project/qwiic_exporter/
 Read more at https://qwiic-exporter.readthedocs.io/en/latest/
 """
 import argparse
+import array
+import asyncio
+import bisect
+import calendar
+import collections
+import cProfile
+import datetime
+import functools
+import gzip
+import http.client
+import http.server
+import importlib
+import io
 import itertools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import multiprocessing.context
+import operator
+import os
+import pickle
+import pstats
+import random
+import resource
+import select
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+import tty
 import typing
+import urllib.parse
 
 import prometheus_client  # type: ignore
+import prometheus_client.core  # type: ignore
+import prometheus_client.utils  # type: ignore
 import serial  # type: ignore
 
+
+def import_optional(name: str) -> typing.Any:
+    """Return the module of an optional dependency, or None if it is not installed.
+
+    The module is typed as Any, so mypy gives the same result whether it is installed or not.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+# numpy is optional, it is only used to convert big batches of buffered lines
+numpy = import_optional("numpy")
+
+# python-snappy is optional, without it remote-write payloads are sent as uncompressed snappy
+snappy = import_optional("snappy")
+
 __version__ = "0.3.0-dev"
 logger = logging.getLogger("qwiic_exporter.%s" % __name__)
 
+# a sensor config is a list of tuples of (sensorname, list of enabled subsensornames)
+SensorConfig = typing.List[typing.Tuple[str, typing.List[str]]]
+# the sensors of a sensor catalogue, each a dict of subsensors with a list of tuples of
+# (header name, metric name, description, multiplier) for the metrics of the subsensor
+Sensors = typing.Dict[
+    str, typing.Dict[str, typing.List[typing.Tuple[str, str, str, float]]]
+]
+
 
 class QwiicExporter:
     """The QwiicExporter class."""
 
-    # each element in the sensors dict is itself a dict of the subsensors of that sensor,
-    # as defined in the sensor unit documentation on
-    # https://github.com/sparkfun/OpenLog_Artemis/blob/master/SENSOR_UNITS.md
-    sensors: typing.Dict[
-        str, typing.Dict[str, typing.List[typing.Tuple[str, str, str, float]]]
-    ] = {
-        "BME280 atmospheric sensor": {
-            "Pressure": [
-                (
-                    "pressure_Pa",
-                    "qwiic_pressure_pascals",
-                    "The ambient pressure in pascals",
-                    1,
-                ),
-            ],
-            "Humidity": [
-                (
-                    "humidity_%",
-                    "qwiic_humidity_percent",
-                    "The relative humidity in percent",
-                    1,
-                ),
-            ],
-            "Altitude": [
-                ("altitude_m", "qwiic_altitude_meters", "The altitude in meters", 1),
-            ],
-            "Temperature": [
-                (
-                    "temp_degC",
-                    "qwiic_temperature_degrees",
-                    "The temperature in degrees celcius",
-                    1,
-                ),
-            ],
-        },
-        "CCS811 air quality sensor": {
-            "TVOC": [
-                (
-                    "tvoc_ppb",
-                    "qwiic_tvoc_ppb",
-                    "TVOC (Total Volatile Organic Compounds) parts per billion",
-                    1,
-                ),
-            ],
-            "CO2": [
-                ("co2_ppm", "qwiic_co2_ppm", "CO² parts per million", 1),
-            ],
-        },
-        "ICM-20948 IMU": {
-            "Accelerometer": [
-                # sensor reads in milli g so divide by 1000 to get g
-                (
-                    "aX",
-                    "qwiic_accelerometer_x_gs",
-                    "Accelration on the X axis in gs",
-                    0.001,
-                ),
-                (
-                    "aY",
-                    "qwiic_accelerometer_y_gs",
-                    "Accelration on the Y axis in gs",
-                    0.001,
-                ),
-                (
-                    "aZ",
-                    "qwiic_accelerometer_z_gs",
-                    "Accelration on the Z axis in gs",
-                    0.001,
-                ),
-            ],
-            "Gyro": [
-                (
-                    "gX",
-                    "qwiic_gyroscope_x_degrees",
-                    "Gyroscope X axis degrees per second",
-                    1,
-                ),
-                (
-                    "gY",
-                    "qwiic_gyroscope_y_degrees",
-                    "Gyroscope Y axis degrees per second",
-                    1,
-                ),
-                (
-                    "gZ",
-                    "qwiic_gyroscope_z_degrees",
-                    "Gyroscope Z axis degrees per second",
-                    1,
-                ),
-            ],
-            "Magnetometer": [
-                # sensor reads in micro teslas so divide by 1000000 to get teslas
-                (
-                    "mX",
-                    "qwiic_magnetometer_x_teslas",
-                    "Magnetometer X axis teslas",
-                    0.000001,
-                ),
-                (
-                    "mY",
-                    "qwiic_magnetometer_y_teslas",
-                    "Magnetometer Y axis teslas",
-                    0.000001,
-                ),
-                (
-                    "mZ",
-                    "qwiic_magnetometer_z_teslas",
-                    "Magnetometer Z axis teslas",
-                    0.000001,
-                ),
-            ],
-            "Temperature": [
-                (
-                    "imu_degC",
-                    "qwiic_temperature_degrees",
-                    "Temperature in degrees celcius",
-                    1,
-                ),
-            ],
-        },
-        "MS8607 PHT sensor": {
-            "Humidity": [
-                (
-                    "humidity_%",
-                    "qwiic_humidity_percent",
-                    "The relative humidity in percent",
-                    1,
-                ),
-            ],
-            "Pressure": [
-                # sensor reading is in hectoPascals so multiply by 100 to get pascals
-                ("hPa", "qwiic_pressure_pascals", "The pressure in pascals", 100),
-            ],
-            "Temperature": [
-                (
-                    "degC",
-                    "qwiic_temperature_degrees",
-                    "The temperature in degrees celcius",
-                    1,
-                ),
-            ],
-        },
-        "OpenLog Artemis": {
-            "Frequency": [
-                (
-                    "output_Hz",
-                    "qwiic_output_hertz",
-                    "The actual frequency of output from OpenLog Artemis in hertz",
-                    1,
-                ),
-            ],
-            "Counter": [
-                (
-                    "count",
-                    "qwiic_measurements_total",
-                    "The number of measurements made by OpenLog Artemis in hertz",
-                    1,
-                ),
-            ],
-        },
-        "VCNL4040 proximity sensor": {
-            "Proximity": [
-                (
-                    "prox(no unit)",
-                    "qwiic_proximity",
-                    "The output of the proximity sensor (higher value=object closer)",
-                    1,
-                ),
-            ],
-            "Ambient Light": [
-                ("ambient_lux", "qwiic_light_lux", "The ambient light in Lux", 1),
-            ],
-        },
-    }
     serialport: str
-    prompath: str
+    prompath: typing.Optional[str] = None
+    # address and port to serve /metrics on, like "127.0.0.1:9999" or ":9999"
+    listen: typing.Optional[str] = None
+    # minimum number of seconds between two textfile writes, 0 means write after every line
+    flush_interval: float = 1.0
+    # maximum number of seconds the textfile can go without being rewritten
+    max_staleness: float = 60.0
+    # the smallest batch of lines which is converted with numpy when it is available
+    numpy_batch_size: int = 32
+    # seconds between opening the menu and asking for the header line
+    header_delay: float = 1.0
+    # minimum seconds between header requests made because data lines are out of sync
+    header_interval: float = 10.0
+    # data lines in a row with the same unexpected number of readings before they are not noise
+    resync_threshold: int = 3
+    # run the serial pipeline on an asyncio event loop instead of the blocking read loops
+    use_asyncio: bool = False
+    # the path of the file to persist parsed header lines in between runs
+    header_cache_path: typing.Optional[str] = None
+    # the number of parsed header lines to keep
+    header_cache_size: int = 32
+    # seconds per window of min/max/mean aggregation of all readings, 0 means disabled
+    aggregation_window: float = 0
+    # seconds series no longer in the sensor config of their device are exported, 0 removes them right away
+    series_ttl: float = 0
+    # the most series of sensor metrics kept for all devices, the oldest retired ones are evicted beyond it
+    max_series: int = 10000
+    # bytes waiting on the serial port before the backlog is drained in one go, 0 means never
+    drain_threshold: int = 4096
+    # the path of the ring buffer file to record all readings in, and its size in records
+    ring_path: typing.Optional[str] = None
+    ring_size: int = 100000
+    # the ring buffer shared by all devices, opened by open_ring()
+    ring: typing.Optional["ReadingRing"] = None
+    # the URL to push every reading to, as remote-write or to a Pushgateway, see PushSink
+    push_url: typing.Optional[str] = None
+    push_format: str = "remote-write"
+    push_interval: float = 10.0
+    push_batch_size: int = 5000
+    push_queue_size: int = 100
+    # the push sink shared by all devices, started by start_push()
+    sink: typing.Optional["PushSink"] = None
+    # the write and saved write counters of TextfileFlusher, registered by the first flusher
+    textfile_writes: typing.Optional[
+        typing.Tuple[prometheus_client.Counter, prometheus_client.Counter]
+    ] = None
+    # the derived metrics to compute from the readings of each line, see load_derived_metrics()
+    derived_metrics: typing.Optional[
+        typing.Dict[str, typing.Dict[str, typing.Any]]
+    ] = None
+    # keep the values of all sensor metrics in flat arrays exported by FlatCollector instead of Gauges
+    use_flat_collector: bool = False
+    # ingest the lines of each device in a worker process of its own, see start_workers()
+    use_workers: bool = False
+    # timestamp readings with the rtcDate and rtcTime of the device instead of the host clock
+    device_time: bool = False
+    # the strptime format of rtcDate, and the drift from the host clock which is warned about
+    date_format: str = "%m/%d/%Y"
+    max_drift: float = 5.0
 
-    def __init__(self) -> None:
-        """Find all possible sensor signatures with the current sensor config."""
-        logger.debug("Getting sensor signature lookup table...")
-        self.signatures = self.get_sensor_signature_lookup_table()
+    # the value of the device label, only set when more than one device is monitored
+    device: typing.Optional[str] = None
+    # these are shared by all devices added with add_device()
+    sensors: Sensors
+    matcher: "SignatureMatcher"
+    headercache: "HeaderCache"
+    registry: prometheus_client.CollectorRegistry
+    exposition: "ExpositionCache"
+    devices: typing.List["QwiicExporter"]
+    # compiled from the header line by apply_sensor_config(), missing until then
+    plan: "IngestPlan"
+    # held while series are added to or removed from the registry, see evict_series()
+    serieslock: threading.RLock
+    # the shared memory of the worker process of each device, see start_workers()
+    shards: typing.List["Shard"]
+    workers: typing.List[multiprocessing.process.BaseProcess]
+
+    def __init__(
+        self,
+        owner: typing.Optional["QwiicExporter"] = None,
+        catalogue: typing.Optional["SensorCatalogue"] = None,
+    ) -> None:
+        """Build the sensor signature matcher and the registry.
+
+        Args:
+            owner: The QwiicExporter this device is added to with add_device(), if any.
+                   Devices share the signatures, registry and exposition of the owner.
+            catalogue: The sensor catalogue to use, defaults to the catalogue shipped with
+                       qwiic_exporter, which is only loaded if no catalogue is given
+        """
+        # generation is incremented every time ingest_data() or evict_series() changes the metric values
+        self.generation = 0
+        # the number of data lines skipped because they had non-numeric readings
+        self.rejected_lines = 0
+        # self-instrumentation, plain numbers here which are exported by SelfCollector
+        self.lines_read = 0
+        self.decode_errors = 0
+        self.header_requests = 0
+        self.last_ingest: typing.Optional[float] = None
+        # data lines skipped when draining a backlog, and the size of the last backlog in lines
+        self.lines_dropped = 0
+        self.lines_lagging = 0
+        self.ingest_latency = LatencyHistogram()
+        # the bytes read from the serial port, which complete lines are sliced out of
+        self.framer = LineFramer()
+        # when to send "h" for a pending header request made with request_header()
+        self.header_due: typing.Optional[float] = None
+        # when the header line was last requested, for rate limiting the requests made by resync()
+        self.header_requested: typing.Optional[float] = None
+        # the number of readings of the data lines out of sync, and how many in a row there were
+        self.mismatch_count = 0
+        self.mismatches = 0
+        # data lines skipped as noise because their number of readings did not match
+        self.noise_lines = 0
+        # the event loop when running under asyncio
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        # the cached header line in use until the real header line is seen
+        self.provisional_header: typing.Optional[str] = None
+        # aggregates all readings when aggregation_window is set
+        self.aggregator: typing.Optional[WindowAggregator] = None
+        # the derived metrics compiled with the plan, if derived_metrics is set
+        self.derived: typing.Optional[DerivedPlan] = None
+        # the layout number of the plan in the ring buffer, registered on the first record()
+        self.ring_layout: typing.Optional[int] = None
+        # parses rtcDate and rtcTime when device_time is set, created on the first data line
+        self.clock: typing.Optional[DeviceClock] = None
+        # series of earlier sensor configs which are not in the current one, and when they were retired
+        self.retired: typing.Dict[typing.Tuple[str, typing.Tuple[str, ...]], float] = {}
+        self.series_evicted = 0
+
+        if owner:
+            # settings made on the owner, overriding the class attributes, apply to this device too
+            for name, value in vars(owner).items():
+                if hasattr(QwiicExporter, name):
+                    setattr(self, name, value)
+            self.sensors = owner.sensors
+            self.matcher = owner.matcher
+            self.headercache = owner.headercache
+            self.registry = owner.registry
+            self.exposition = owner.exposition
+            self.devices = owner.devices
+            self.serieslock = owner.serieslock
+            return
+
+        logger.debug("Loading sensor catalogue...")
+        self.devices = [self]
+        self.use_catalogue(catalogue or SensorCatalogue.load())
+        self.headercache = HeaderCache(maxsize=self.header_cache_size)
         logger.debug("Initiating Prometheus collector registry...")
         self.registry = prometheus_client.CollectorRegistry()
+        self.serieslock = threading.RLock()
+        self.exposition = ExpositionCache(exporter=self)
+        self.template = ExpositionTemplate(exporter=self)
+        self.textfile_latency = LatencyHistogram()
+        self.shards = []
+        self.workers = []
+        self.registry.register(AggregationCollector(exporter=self))
+        self.registry.register(SelfCollector(exporter=self))
 
         # qwiic_build_info
         build_info = prometheus_client.Info(
@@ -213,14 +251,79 @@ class QwiicExporter:
         build_info.info(
             {"version": __version__, "pyserial_version": serial.__version__}
         )
+        # registered where the gauges would be, so the exposition is the same
+        self.registry.register(FlatCollector(exporter=self))
+
+    def use_catalogue(self, catalogue: "SensorCatalogue") -> None:
+        """Use the sensors and the signature matcher of the catalogue for all devices.
+
+        This must be done before any header line is parsed.
+        """
+        for device in self.devices:
+            device.sensors = catalogue.sensors
+            device.matcher = catalogue.matcher
+
+    def open_ring(self) -> None:
+        """Open the ring buffer at ring_path and record the readings of all devices in it."""
+        assert self.ring_path
+        ring = ReadingRing(self.ring_path, capacity=self.ring_size)
+        for device in self.devices:
+            device.ring = ring
+
+    def start_push(self) -> "PushSink":
+        """Start pushing the readings of all devices to push_url.
+
+        Returns: The running sink, stop it with stop() to send the remaining readings
+        """
+        assert self.push_url
+        sink = PushSink(
+            url=self.push_url,
+            format=self.push_format,
+            batch_size=self.push_batch_size,
+            flush_interval=self.push_interval,
+            queue_size=self.push_queue_size,
+        )
+        sink.start()
+        for device in self.devices:
+            device.sink = sink
+        return sink
+
+    def add_device(self, serialport: str) -> "QwiicExporter":
+        """Add another OpenLog Artemis to be monitored from this process.
+
+        All devices share the registry of this QwiicExporter, and the sensor metrics of every
+        device get a device label with the serial port. Devices must be added before any header
+        line is parsed, so all Gauges are created with the device label.
+
+        Args:
+            serialport: The path to the serial port of the new device
+
+        Returns: The QwiicExporter for the new device, with the same settings as this one
+        """
+        assert not hasattr(self, "plan"), "Devices must be added before ingesting data"
+        device = QwiicExporter(owner=self)
+        device.serialport = serialport
+        device.device = serialport
+        self.device = self.serialport
+        self.devices.append(device)
+        return device
+
+    def total_generation(self) -> int:
+        """Return the sum of the generations of all devices sharing the registry, or of their workers."""
+        return sum(device.generation for device in self.devices) + sum(
+            shard.generation() for shard in self.shards
+        )
 
-    def initialise_serial(self) -> None:
+    def initialise_serial(self, timeout: typing.Optional[float] = 1) -> None:
         """Open serial port."""
-        self.serial = serial.Serial(self.serialport, 115200, timeout=1)
+        self.serial = serial.Serial(self.serialport, 115200, timeout=timeout)
 
     def get_sensor_signature_lookup_table(self) -> typing.Dict[str, str]:
         """Loop over sensors dict and get possible sensor signatures for all combinations of enabled subsensors.
 
+        The number of signatures grows exponentially with the number of subsensors, so this is
+        no longer used for matching header lines. SignatureMatcher does that instead.
+
         Args:
             sensors: dict of sensors
 
@@ -289,223 +392,3861 @@ class QwiicExporter:
 
     def parse_sensor_config(self, headerline: str) -> None:
         """Parse the help/header line with all the unit definitions and set self.sensorconfig."""
-        self.sensorconfig: typing.List[typing.Tuple[str, typing.List[str]]] = []
-        # gaugeindex is a list of tuples of (sensorname, sensorindex, subsensorname, metricname, Gauge obj)
-        self.gaugeindex: typing.List[
-            typing.Tuple[str, int, str, str, float, prometheus_client.Gauge]
-        ] = []
+        self.sensorconfig: SensorConfig = []
         headerlist = headerline.split(",")
         # skip date and time and empty elements
         headerlist = headerlist[2:]
         headerlist = [x for x in headerlist if x not in ["", "\r\n"]]
 
+        header = ",".join(headerlist)
+        if self.provisional_header is not None:
+            if header == self.provisional_header:
+                logger.info("Header line confirms the cached sensor config in use")
+            else:
+                logger.warning(
+                    "Header line does not match the cached sensor config in use, replacing it"
+                )
+            self.provisional_header = None
+
+        # known header lines skip signature matching
+        cached = self.headercache.get(header)
+        if cached is not None:
+            logger.debug("Header line found in header cache")
+            self.sensorconfig = cached
+            self.apply_sensor_config()
+            return
+
         # loop as long as we still have unidentified header elements
-        while headerlist:
-            match = False
-            # try longest first, we want to match a whole sensor rather than just a subsensor if possible
-            for i in reversed(range(0, len(headerlist) + 1)):
-                signature = headerlist[0:i]
-                sigstr = ",".join(signature)
-                if sigstr in self.signatures:
-                    sensorname = self.signatures[sigstr]
-                    match = True
-                    break
+        position = 0
+        while position < len(headerlist):
+            # the matcher finds the longest signature, we want to match a whole sensor rather than just a subsensor if possible
+            match = self.matcher.longest_match(headerlist, position)
 
             # no matches found, one or more unknown sensors might be attached
             if not match:
                 logger.error(
-                    f"Unable to find a matching sensor for headerlist {headerlist} - bailing out"
+                    f"Unable to find a matching sensor for headerlist {headerlist[position:]} - bailing out"
                 )
-                return
-
-            headerlist = headerlist[len(signature) :]
+                break
 
+            sensorname, subsensornames, position = match
             logger.debug(
-                f"Found signature matching sensor {sensorname} - finding enabled subsensors..."
-            )
-            self.sensorconfig.append((sensorname, []))
-            for subsensorname in self.sensors[sensorname].keys():
-                subsig = self.get_subsensor_signature(sensorname, subsensorname)
-                for i in range(0, len(signature)):
-                    candidate = signature[i : len(subsig)]
-                    if subsig == candidate:
-                        signature = signature[len(subsig) :]
-                        logger.debug(
-                            f"Sensor {sensorname} has subsensor {subsensorname} enabled (signature {subsig}), creating metrics..."
-                        )
-                        self.sensorconfig[-1][1].append(subsensorname)
-                        metrics = self.sensors[sensorname][subsensorname]
-                        for metric in metrics:
-                            # do we already have a metric with this name?
-                            # more than one sensor can export the same metric (like temperature_degrees),
-                            # and we can also have more than one of the same sensor
-                            if metric[1] not in self.registry._names_to_collectors:
-                                prometheus_client.Gauge(
-                                    metric[1],
-                                    metric[2],
-                                    ["sensor", "sensorindex", "subsensor"],
-                                    registry=self.registry,
-                                )
-                            # add this to the gaugeindex
-                            self.gaugeindex.append(
-                                (
-                                    sensorname,
-                                    len(self.sensorconfig),
-                                    subsensorname,
-                                    metric[1],
-                                    metric[3],
-                                    self.registry._names_to_collectors[metric[1]],
-                                )
-                            )
+                f"Found signature matching sensor {sensorname} with subsensors {subsensornames}"
+            )
+            self.sensorconfig.append((sensorname, subsensornames))
+        else:
+            # only fully identified header lines are cached
+            self.headercache.put(header, self.sensorconfig)
+
+        self.apply_sensor_config()
+
+    def apply_cached_layout(self, fieldcount: int) -> bool:
+        """Use the most recently seen cached sensor config with fieldcount metrics until the header line arrives.
+
+        Returns: True if a cached sensor config was applied, False if none has fieldcount metrics
+        """
+        for header, sensorconfig in self.headercache.by_fieldcount(fieldcount):
+            logger.info(
+                f"Ingesting with cached sensor config for header {header} until the header line arrives"
+            )
+            self.provisional_header = header
+            self.sensorconfig = sensorconfig
+            self.apply_sensor_config()
+            return True
+        return False
+
+    def apply_sensor_config(self) -> None:
+        """Create metrics for the enabled subsensors in self.sensorconfig, and set self.gaugeindex and self.plan."""
+        with self.serieslock:
+            previous = self.plans()
+            self.build_plan()
+            self.retire_series(previous)
+        self.ring_layout = None
+        if self.aggregation_window > 0:
+            self.aggregator = WindowAggregator(
+                size=len(self.plan), window=self.aggregation_window
+            )
+
+    def enabled_metrics(
+        self,
+    ) -> typing.Iterator[
+        typing.Tuple[str, int, str, typing.Tuple[str, str, str, float]]
+    ]:
+        """Yield the sensorname, sensorindex, subsensorname and metric of each metric in self.sensorconfig, in header order."""
+        for sensorindex, (sensorname, subsensornames) in enumerate(
+            self.sensorconfig, start=1
+        ):
+            for subsensorname in subsensornames:
+                for metric in self.sensors[sensorname][subsensorname]:
+                    yield sensorname, sensorindex, subsensorname, metric
+
+    def build_plan(self) -> None:
+        """Create the gauges for self.sensorconfig, and compile them into self.gaugeindex and self.plan, and self.derived."""
+        self.plan, self.gaugeindex = self.compile_plan(
+            [
+                (
+                    sensorname,
+                    sensorindex,
+                    subsensorname,
+                    metric[1],
+                    metric[3],
+                    metric[2],
+                )
+                for sensorname, sensorindex, subsensorname, metric in self.enabled_metrics()
+            ]
+        )
+        self.derived = self.compile_derived() if self.derived_metrics else None
+
+    def compile_plan(
+        self, metricindex: typing.List[typing.Tuple[str, int, str, str, float, str]]
+    ) -> typing.Tuple[
+        "IngestPlan",
+        typing.List[typing.Tuple[str, int, str, str, float, prometheus_client.Gauge]],
+    ]:
+        """Compile the (sensorname, sensorindex, subsensorname, metricname, multiplier, description) of each metric into a plan.
+
+        Returns: A tuple of the plan and the gaugeindex, which is empty for a FlatPlan
+        """
+        # gaugeindex is a list of tuples of (sensorname, sensorindex, subsensorname, metricname, Gauge obj)
+        gaugeindex: typing.List[
+            typing.Tuple[str, int, str, str, float, prometheus_client.Gauge]
+        ] = []
+        if self.use_flat_collector:
+            # no gauges at all, FlatCollector exports the values of the plan
+            return FlatPlan(metricindex, device=self.device), gaugeindex
+
+        for (
+            sensorname,
+            sensorindex,
+            subsensorname,
+            name,
+            multiplier,
+            description,
+        ) in metricindex:
+            # do we already have a metric with this name?
+            # more than one sensor can export the same metric (like temperature_degrees),
+            # and we can also have more than one of the same sensor
+            if name not in self.registry._names_to_collectors:
+                prometheus_client.Gauge(
+                    name,
+                    description,
+                    ["sensor", "sensorindex", "subsensor"]
+                    + (["device"] if self.device else []),
+                    registry=self.registry,
+                )
+            # add this to the gaugeindex
+            gaugeindex.append(
+                (
+                    sensorname,
+                    sensorindex,
+                    subsensorname,
+                    name,
+                    multiplier,
+                    self.registry._names_to_collectors[name],
+                )
+            )
+
+        # compile the gaugeindex into the plan used by ingest_data()
+        return IngestPlan(gaugeindex, device=self.device), gaugeindex
 
-                        # The subsensor signature has been removed from the signature,
-                        # and all metrics for this subsensor have Gauges,
-                        # continue with the next subsensor for this sensor
-                        break
+    def compile_derived(self) -> typing.Optional["DerivedPlan"]:
+        """Compile the derived metrics of every sensor in self.sensorconfig which has all their inputs.
 
-    def trigger_header_line(self) -> None:
-        """Send newline to open the menu, sleep 1 second, then send "h" to see headers."""
+        Returns: The DerivedPlan, or None if no sensor has the inputs of any derived metric
+        """
+        assert self.derived_metrics is not None
+        # the position of each metric in a data line, by sensorindex and metric name
+        positions: typing.Dict[int, typing.Dict[str, int]] = {}
+        sensornames: typing.Dict[int, str] = {}
+        for position, (sensorname, sensorindex, _, metric) in enumerate(
+            self.enabled_metrics()
+        ):
+            positions.setdefault(sensorindex, {})[metric[1]] = position
+            sensornames[sensorindex] = sensorname
+
+        metricindex: typing.List[typing.Tuple[str, int, str, str, float, str]] = []
+        functions: typing.List[typing.Callable[..., float]] = []
+        inputs: typing.List[typing.List[int]] = []
+        for name, definition in self.derived_metrics.items():
+            for sensorindex, metrics in positions.items():
+                if not all(metric in metrics for metric in definition["inputs"]):
+                    continue
+                metricindex.append(
+                    (
+                        sensornames[sensorindex],
+                        sensorindex,
+                        definition["subsensor"],
+                        name,
+                        1.0,
+                        definition["help"],
+                    )
+                )
+                functions.append(
+                    functools.partial(
+                        derivations[definition["function"]],
+                        **definition.get("parameters", {}),
+                    )
+                )
+                inputs.append([metrics[metric] for metric in definition["inputs"]])
+        if not metricindex:
+            return None
+        plan, _ = self.compile_plan(metricindex)
+        return DerivedPlan(plan, functions, inputs)
+
+    def plans(self) -> typing.List["IngestPlan"]:
+        """Return the plan and the plan of the derived metrics, if any."""
+        plan = getattr(self, "plan", None)
+        if plan is None:
+            return []
+        return [plan, self.derived.plan] if self.derived else [plan]
+
+    def retire_series(self, previous: typing.List["IngestPlan"]) -> None:
+        """Retire the series of the previous plans which are not in the current plans, and evict the ones due.
+
+        Series of the current plans which were retired before are in use again, and are kept.
+        """
+        if isinstance(self.plan, FlatPlan):
+            # the series of a flat plan are gone with the plan
+            return
+        current = {series for plan in self.plans() for series in plan.series()}
+        for series in current:
+            self.retired.pop(series, None)
+        now = time.monotonic()
+        for plan in previous:
+            for series in plan.series():
+                if series not in current:
+                    self.retired.setdefault(series, now)
+        self.evict_series()
+
+    def evict_series(self) -> int:
+        """Remove the retired series of all devices which are older than series_ttl from the registry.
+
+        When all devices together have more than max_series series the oldest retired series are
+        removed regardless of their age, so the exposition stays bounded however often the
+        sensor config changes. Gauges without any series left are unregistered.
+
+        Returns: The number of series removed
+        """
+        if not any(device.retired for device in self.devices):
+            return 0
+        with self.serieslock:
+            retired = sorted(
+                (
+                    (retiredat, series, device)
+                    for device in self.devices
+                    for series, retiredat in device.retired.items()
+                ),
+                key=operator.itemgetter(0),
+            )
+            excess = 0
+            if self.max_series:
+                live = sum(
+                    len(plan) for device in self.devices for plan in device.plans()
+                )
+                excess = live + len(retired) - self.max_series
+            now = time.monotonic()
+            evicted = 0
+            for retiredat, series, device in retired:
+                if evicted >= excess and now - retiredat < self.series_ttl:
+                    break
+                del device.retired[series]
+                device.series_evicted += 1
+                evicted += 1
+                name, labelvalues = series
+                gauge = self.registry._names_to_collectors.get(name)
+                if gauge is None:
+                    continue
+                try:
+                    gauge.remove(*labelvalues)
+                except KeyError:
+                    pass
+                if not gauge._metrics:
+                    self.registry.unregister(gauge)
+        if evicted:
+            logger.info(
+                f"Evicted {evicted} series which are no longer in the sensor config"
+            )
+            # the exposition has changed
+            self.generation += 1
+        return evicted
+
+    def request_header(self) -> None:
+        """Send newline to open the menu, and schedule sending "h" header_delay seconds later.
+
+        This never sleeps. The "h" is sent by the event loop when
+        running under asyncio, and by service_header_request() from the read loops otherwise.
+        """
+        self.header_requests += 1
         self.serial.write(b"\n")
-        time.sleep(1)
+        self.header_requested = time.monotonic()
+        self.header_due = self.header_requested + self.header_delay
+        if self.loop:
+            self.loop.call_later(self.header_delay, self.service_header_request)
+
+    def service_header_request(self) -> typing.Optional[float]:
+        """Send "h" for a pending header request if it is due.
+
+        Returns: The number of seconds until the pending header request is due, or None
+        """
+        if self.header_due is None:
+            return None
+        remaining = self.header_due - time.monotonic()
+        if remaining > 0:
+            if self.loop:
+                self.loop.call_later(remaining, self.service_header_request)
+            return remaining
         self.serial.write(b"h")
+        self.header_due = None
+        return None
+
+    def resync(self, fieldcount: int, lines: int = 1) -> bool:
+        """Handle data lines with fieldcount readings, which is not the number of metrics in the plan.
+
+        Short or garbled lines are common on a noisy serial line, so they are skipped until
+        resync_threshold lines in a row have the same number of readings. Then the sensor config
+        has changed: the most recently seen header line with fieldcount metrics is applied from the
+        header cache right away, and the header line is requested to confirm it. Requests are not
+        repeated while one is pending, nor within header_interval seconds of the last one.
+
+        Args:
+            fieldcount: The number of readings of the lines
+            lines: The number of lines with fieldcount readings in a row
+
+        Returns: True if a sensor config with fieldcount metrics was applied, False if not
+        """
+        if fieldcount != self.mismatch_count:
+            self.mismatch_count = fieldcount
+            self.mismatches = 0
+        self.mismatches += lines
+        if self.mismatches < self.resync_threshold:
+            self.noise_lines += lines
+            logger.warning(
+                f"Skipping line with {fieldcount} readings, expected {len(self.plan)}"
+            )
+            return False
+
+        logger.error(
+            f"Gauge index is out of sync (index has {len(self.plan)} metrics, {self.mismatches} lines in a row have {fieldcount} metrics)"
+        )
+        if self.header_due is None and (
+            self.header_requested is None
+            or time.monotonic() - self.header_requested >= self.header_interval
+        ):
+            logger.info("Getting new headers")
+            self.request_header()
+        return self.apply_cached_layout(fieldcount=fieldcount)
 
     def ingest_data(self, data: str) -> None:
         """Parse a line of sensor data and update all the prometheus metrics."""
         # remove trailing comma, split into a list, skip date and timestamp
-        readings = data.strip(",").split(",")[2:]
+        fields = data.strip(",").split(",")
+        timestamp = self.device_timestamp(fields) if self.device_time else None
+        self.ingest_readings(fields[2:], timestamp=timestamp)
 
-        # make sure we have the number of metrics we expect
-        if len(self.gaugeindex) != len(readings):
-            logger.error(
-                f"Gauge index is out of sync (index has {len(self.gaugeindex)} metrics, reading has {len(readings)} metrics), getting new headers"
-            )
-            self.trigger_header_line()
-            return
+    def ingest_raw(self, line: bytes) -> bool:
+        """Parse a stripped line of sensor data as read from the serial port, without decoding it.
 
-        # loop over readings and gauges and update each
-        # gauge is a tuple of
-        for gauge, reading in zip(self.gaugeindex, readings):
-            # gauge is a tuple of (sensorname, sensorindex, subsensorname, metricname, multiplier, and Gauge object)
-            gauge[5].labels(
-                sensor=gauge[0], sensorindex=gauge[1], subsensor=gauge[2]
-            ).set(float(reading) * gauge[4])
-            logger.debug(f"Set gauge {gauge[3]} to {float(reading) * gauge[4]}")
+        Returns: True if the metrics were updated, False if not
+        """
+        fields = split_line(line)
+        timestamp = self.device_timestamp(fields) if self.device_time else None
+        # skip date and timestamp
+        return self.ingest_readings(fields[2:], timestamp=timestamp)
 
-    def write_textfile_collector_file(self) -> None:
-        """Write metrics to the textfile collector path."""
-        prometheus_client.write_to_textfile(self.prompath, self.registry)
+    def device_timestamp(
+        self, fields: typing.Sequence[typing.Union[str, bytes]]
+    ) -> typing.Optional[float]:
+        """Return the timestamp of a data line from its rtcDate and rtcTime fields.
 
-    def disco(self) -> None:
-        """Do stuff."""
-        logger.debug(f"Initialising serial port {self.serialport} ...")
-        self.initialise_serial()
-        self.trigger_header_line()
+        Returns: The timestamp in seconds since the epoch, or None if the fields are not a date and time
+        """
+        if self.clock is None:
+            self.clock = DeviceClock(
+                date_format=self.date_format, max_drift=self.max_drift
+            )
+        try:
+            return self.clock.timestamp(fields[0], fields[1])
+        except (IndexError, ValueError):
+            self.clock.errors += 1
+            return None
 
-        while True:
-            try:
-                reading = self.serial.readline().decode("ASCII").strip().strip(",")
-            except UnicodeDecodeError:
-                # skip random serial line noise
-                continue
+    def ingest_readings(
+        self,
+        readings: typing.Sequence[typing.Union[str, bytes]],
+        timestamp: typing.Optional[float] = None,
+    ) -> bool:
+        """Convert a list of readings in header order and update all the prometheus metrics.
 
-            logger.debug(f"Got line: {reading}")
+        Args:
+            readings: The readings of a data line without rtcDate and rtcTime
+            timestamp: The time of the readings, defaults to now
 
-            # detect reboots
-            if reading[0 : len("Artemis OpenLog")] == "Artemis OpenLog":
-                # reboot detected, check sensor config
-                self.trigger_header_line()
-                continue
+        Returns: True if the metrics were updated, False if not
+        """
+        # make sure we have the number of metrics we expect
+        if len(self.plan) != len(readings):
+            if not self.resync(fieldcount=len(readings)):
+                return False
+        elif self.mismatches:
+            self.mismatches = 0
 
-            # detect header line
-            if reading[0:15] == "rtcDate,rtcTime":
-                logger.debug("Header line detected, parsing sensor config...")
-                self.parse_sensor_config(headerline=reading)
-                continue
-            #
-            # we can only ingest data after we've seen the header line and created metrics
-            if hasattr(self, "gaugeindex"):
-                self.ingest_data(data=reading)
-                self.write_textfile_collector_file()
-                continue
+        values = self.plan.convert(readings)
+        if values is None:
+            self.rejected_lines += 1
+            logger.warning("Skipping line with non-numeric readings")
+            return False
 
+        self.plan.apply(values)
+        if self.derived:
+            self.derived.apply(values)
+        if self.aggregator:
+            self.aggregator.update(values)
+        if self.ring or self.sink:
+            self.record(time.time() if timestamp is None else timestamp, values)
+        self.last_ingest = time.monotonic()
+        self.generation += 1
+        return True
 
-def get_parser() -> argparse.ArgumentParser:
-    """Create and return the argparse object.
+    def line_time(self, fields: typing.Sequence[bytes]) -> float:
+        """Return the timestamp of a data line, from the device clock if device_time is set."""
+        timestamp = self.device_timestamp(fields) if self.device_time else None
+        return time.time() if timestamp is None else timestamp
 
-    Args: None
-    Returns: The argparse object
-    """
-    parser = argparse.ArgumentParser(
-        description=f"qwiic_exporter version {__version__}. Exports metrics from SparkFun OpenLog Artemis sensors to Prometheus node_exporter textfile collector path."
-    )
+    def record(self, timestamp: float, values: typing.Sequence[float]) -> None:
+        """Hand the values of a line to the ring buffer and the push sink."""
+        if self.ring:
+            if self.ring_layout is None:
+                self.ring_layout = self.ring.layout(self.plan)
+            self.ring.append(timestamp, self.ring_layout, values)
+        if self.sink:
+            self.sink.add(self.plan, timestamp, values)
 
-    parser.add_argument(
-        "SERIALPORT",
-        type=str,
-        help="The path to the serial port where the SparkFun OpenLog Artemis is connected.",
-    )
+    def ingest_raw_batch(
+        self, lines: typing.List[bytes], newest_only: bool = False
+    ) -> int:
+        """Parse a batch of stripped data lines and update the metrics with the newest valid line.
 
-    parser.add_argument(
-        "PROMPATH",
-        type=str,
-        help="The path to the Prometheus node_exporter textfile collector file to write output to. Remember the .prom suffix.",
-    )
+        Lines with the wrong number of readings are skipped. When numpy is available and the batch
+        is big enough, all readings are converted and multiplied in one vectorized operation.
 
-    parser.add_argument(
-        "-d",
-        "--debug",
-        action="store_const",
-        dest="loglevel",
-        const="DEBUG",
-        help="Debug mode. Equal to setting --log-level=DEBUG.",
-        default=argparse.SUPPRESS,
-    )
+        Args:
+            lines: The data lines, oldest first
+            newest_only: Only convert lines until the newest valid one is found, the older lines
+                         are not ingested at all
 
-    parser.add_argument(
-        "-l",
-        "--log-level",
-        dest="loglevel",
-        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
-        help="Logging level. One of DEBUG, INFO, WARNING, ERROR, CRITICAL. Defaults to INFO.",
-        default="INFO",
-    )
+        Returns: The number of lines ingested
+        """
+        fieldcount = len(self.plan) + 2
+        batch = list(map(split_line, lines))
+        batch = [fields for fields in batch if len(fields) == fieldcount]
+        if not batch:
+            return 0
 
-    parser.add_argument(
-        "-q",
-        "--quiet",
-        action="store_const",
-        dest="loglevel",
-        const="WARNING",
-        help="Quiet mode. No output at all if no errors are encountered. Equal to setting --log-level=WARNING.",
-        default=argparse.SUPPRESS,
-    )
+        if (
+            numpy is not None
+            and not newest_only
+            and len(batch) >= self.numpy_batch_size
+        ):
+            try:
+                matrix = self.plan.convert_matrix(batch)
+            except ValueError:
+                # one or more bad lines in the batch, convert line by line instead
+                pass
+            else:
+                self.plan.apply(matrix[-1].tolist())
+                if self.derived:
+                    self.derived.apply(self.plan.values)
+                if self.aggregator:
+                    self.aggregator.update_many(matrix)
+                if self.ring or self.sink:
+                    for fields, row in zip(batch, matrix.tolist()):
+                        self.record(self.line_time(fields), row)
+                self.last_ingest = time.monotonic()
+                self.generation += len(batch)
+                return len(batch)
 
-    parser.add_argument(
-        "-v",
-        "--version",
-        action="version",
-        version=f"%(prog)s version {__version__}",
-        help="Show qwiic_exporter version and exit.",
-    )
+        ingested = 0
+        # the converted lines, newest first, for the ring buffer and the push sink
+        converted = []
+        for fields in reversed(batch):
+            values = self.plan.convert(fields[2:])
+            if values is None:
+                self.rejected_lines += 1
+                continue
+            if not ingested:
+                # only the newest line needs to be set, the gauges only keep the last value
+                self.plan.apply(values)
+                if self.derived:
+                    self.derived.apply(values)
+            if self.aggregator:
+                self.aggregator.update(values)
+            if self.ring or self.sink:
+                converted.append((fields, values))
+            ingested += 1
+            if newest_only:
+                break
+        for fields, values in reversed(converted):
+            self.record(self.line_time(fields), values)
+        if ingested:
+            self.last_ingest = time.monotonic()
+        self.generation += ingested
+        return ingested
 
-    return parser
+    def write_textfile_collector_file(self) -> None:
+        """Write metrics to the textfile collector path."""
+        assert self.prompath
+        self.evict_series()
+        started = time.perf_counter()
+        body = self.template.render()
+        # write to a temporary file and rename it, so the textfile collector never reads half a file
+        tmppath = f"{self.prompath}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmppath, "wb") as f:
+            f.write(body)
+        os.replace(tmppath, self.prompath)
+        self.textfile_latency.observe(time.perf_counter() - started)
 
+    def disco(self) -> None:
+        """Do stuff."""
+        if self.header_cache_path:
+            self.headercache.load(self.header_cache_path, self.sensors)
+        if self.ring_path:
+            self.open_ring()
+        sink = self.start_push() if self.push_url else None
 
-def main() -> None:
-    """Get args, initialise QwiicExporter object, and start the loop.
+        for device in [] if self.use_workers else self.devices:
+            logger.debug(f"Initialising serial port {device.serialport} ...")
+            # when multiplexing more than one device or using asyncio the reads must not block
+            blocking = len(self.devices) == 1 and not self.use_asyncio
+            device.initialise_serial(timeout=1 if blocking else 0)
+            device.request_header()
 
-    Args: None
-    Returns: None
-    """
-    # get argparse object and parse args
-    parser = get_parser()
-    args = parser.parse_args()
+        if self.use_workers:
+            # forked before any thread is started
+            self.start_workers()
+        if self.listen:
+            self.start_http_server()
 
-    # define the log format used for stdout depending on the requested loglevel
-    if args.loglevel == "DEBUG":
-        console_logformat = "%(asctime)s %(levelname)s qwiic_exporter.%(funcName)s():%(lineno)i:  %(message)s"
-    else:
-        console_logformat = "%(asctime)s %(levelname)s qwiic_exporter %(message)s"
+        # with a flush interval the textfile is written from a background thread
+        flusher = None
+        if self.prompath and self.flush_interval > 0:
+            flusher = TextfileFlusher(
+                exporter=self,
+                min_interval=self.flush_interval,
+                max_staleness=self.max_staleness,
+            )
+            flusher.start()
+
+        try:
+            if self.use_workers:
+                self.supervise(flusher=flusher)
+            elif self.use_asyncio:
+                asyncio.run(self.run_async(flusher=flusher))
+            elif len(self.devices) == 1:
+                self.read_loop(flusher=flusher)
+            else:
+                self.multiplex_loop(flusher=flusher)
+        finally:
+            if flusher:
+                flusher.stop()
+            if sink:
+                sink.stop()
+            self.stop_workers()
+
+    def start_workers(self) -> None:
+        """Fork a worker process for each device, which ingests its lines and publishes the values in shared memory.
+
+        The workers share nothing with this process but a Shard each, which the front-end in this
+        process renders the exposition from. Nothing is sent between the processes per sample.
+        """
+        context = multiprocessing.get_context("fork")
+        if not self.shards:
+            self.shards = [Shard(context) for _ in self.devices]
+            self.registry.register(ShardCollector(exporter=self))
+        self.workers = [self.start_worker(index) for index in range(len(self.devices))]
+
+    def start_worker(self, index: int) -> multiprocessing.process.BaseProcess:
+        """Fork the worker process of the device at index in self.devices.
+
+        Returns: The running worker process
+        """
+        device = self.devices[index]
+        worker = multiprocessing.get_context("fork").Process(
+            target=device.run_worker,
+            args=(self.shards[index],),
+            name=f"qwiic-worker-{index}",
+            daemon=True,
+        )
+        worker.start()
+        logger.info(f"Started worker {worker.pid} for {device.serialport}")
+        return worker
+
+    def run_worker(self, shard: "Shard") -> None:
+        """Ingest the lines of this device forever, and publish the values in the shard after each read."""
+        try:
+            self.initialise_serial(timeout=1)
+            self.request_header()
+            while True:
+                if self.read_serial():
+                    shard.publish(self.generation, self.plans())
+                self.service_header_request()
+                shard.publish_stats(self)
+        except KeyboardInterrupt:
+            pass
+
+    def supervise(self, flusher: typing.Optional["TextfileFlusher"] = None) -> None:
+        """Restart workers which exit, and write the textfile if no flusher does it, forever."""
+        written = self.total_generation()
+        # workers are restarted at most once per second, a missing serial port would spin otherwise
+        started = [time.monotonic()] * len(self.workers)
+        while True:
+            time.sleep(0.1)
+            for index, worker in enumerate(self.workers):
+                if worker.is_alive() or time.monotonic() - started[index] < 1:
+                    continue
+                worker.join()
+                logger.error(
+                    f"Worker for {self.devices[index].serialport} exited with {worker.exitcode}, restarting it"
+                )
+                self.shards[index].reset()
+                self.workers[index] = self.start_worker(index)
+                started[index] = time.monotonic()
+            generation = self.total_generation()
+            if self.prompath and not flusher and generation != written:
+                self.write_textfile_collector_file()
+                written = generation
+
+    def stop_workers(self) -> None:
+        """Stop all worker processes."""
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def read_loop(self, flusher: typing.Optional["TextfileFlusher"] = None) -> None:
+        """Read lines from the serial port forever and handle each of them."""
+        while True:
+            # returns after at most one second on a quiet line
+            ingested = self.read_serial()
+            self.service_header_request()
+            if ingested and self.prompath and not flusher:
+                self.write_textfile_collector_file()
+
+    def multiplex_loop(
+        self, flusher: typing.Optional["TextfileFlusher"] = None
+    ) -> None:
+        """Wait for data on the serial ports of all devices forever and handle the lines."""
+        selector = selectors.DefaultSelector()
+        for device in self.devices:
+            selector.register(device.serial.fileno(), selectors.EVENT_READ, device)
+
+        while True:
+            # sleep until there is data or a header request is due
+            timeouts = [device.service_header_request() for device in self.devices]
+            timeout = min([t for t in timeouts if t is not None], default=None)
+            ingested = False
+            for key, _ in selector.select(timeout=timeout):
+                device = key.data
+                ingested = device.read_serial() or ingested
+            if ingested and self.prompath and not flusher:
+                self.write_textfile_collector_file()
+
+    async def run_async(
+        self, flusher: typing.Optional["TextfileFlusher"] = None
+    ) -> None:
+        """Handle the lines from the serial ports of all devices on the asyncio event loop forever.
+
+        The serial ports must be opened without a timeout. Each port gets a reader callback on the
+        event loop, so nothing runs while the lines are quiet, and header requests are scheduled
+        on the event loop instead of sleeping.
+
+        Raises: serial.SerialException or OSError when a serial port fails, like the other loops
+        """
+        loop = asyncio.get_running_loop()
+        failed: "asyncio.Future[None]" = loop.create_future()
+        for device in self.devices:
+            device.loop = loop
+            loop.add_reader(
+                device.serial.fileno(), self.read_device, device, flusher, failed
+            )
+            # header requests made before the loop was running are scheduled now
+            device.service_header_request()
+        try:
+            await failed
+        finally:
+            for device in self.devices:
+                loop.remove_reader(device.serial.fileno())
+                device.loop = None
+
+    def read_device(
+        self,
+        device: "QwiicExporter",
+        flusher: typing.Optional["TextfileFlusher"] = None,
+        failed: typing.Optional["asyncio.Future[None]"] = None,
+    ) -> None:
+        """Read whatever is waiting on the serial port of the device and handle the complete lines.
+
+        Args:
+            device: The device whose serial port is ready to read
+            flusher: The flusher writing the textfile, if any
+            failed: The future of run_async(), which gets the exception if the serial port fails
+        """
+        try:
+            ingested = device.read_serial()
+        except (OSError, serial.SerialException) as e:
+            if failed is None:
+                raise
+            # the reader would be called again right away, forever
+            if device.loop:
+                device.loop.remove_reader(device.serial.fileno())
+            if not failed.done():
+                failed.set_exception(e)
+            return
+        if ingested and self.prompath and not flusher:
+            self.write_textfile_collector_file()
+
+    def read_serial(self) -> bool:
+        """Read whatever is waiting on the serial port and handle the complete lines.
+
+        Returns: True if one or more lines updated the metrics, False if not
+        """
+        return self.read_from(self.serial, self.serial.in_waiting)
+
+    def receive(self, data: bytes) -> bool:
+        """Handle bytes read from the serial port elsewhere, just like read_serial() would.
+
+        Returns: True if one or more lines updated the metrics, False if not
+        """
+        return self.read_from(io.BytesIO(data), len(data))
+
+    def read_from(self, stream: typing.Any, waiting: int) -> bool:
+        """Read the waiting bytes from the stream into the line framer and handle the complete lines.
+
+        When more than drain_threshold bytes are waiting we are falling behind, and the backlog is
+        drained: reboot banners and header lines are handled in order, but of the data lines
+        between them only the newest valid one updates the metrics, unless aggregation is enabled
+        in which case all of them are ingested.
+
+        Args:
+            stream: The serial port or other stream with a readinto() method
+            waiting: The number of bytes waiting, if nothing is waiting one byte is read which
+                     blocks for at most the timeout of the stream
+
+        Returns: True if one or more lines updated the metrics, False if not
+        """
+        backlog = bool(self.drain_threshold) and waiting > self.drain_threshold
+        if backlog:
+            self.lines_lagging = 0
+        # data lines of the backlog since the last banner or header line
+        pending: typing.List[bytes] = []
+        ingested = False
+        while True:
+            read = self.framer.fill(stream, waiting or 1)
+            for line in self.framer.lines():
+                if not backlog:
+                    ingested = self.handle_line(bytes(line)) or ingested
+                    continue
+                self.lines_lagging += 1
+                data = bytes(line)
+                if data.startswith(b"Artemis OpenLog") or data.startswith(
+                    b"rtcDate,rtcTime"
+                ):
+                    ingested = self.ingest_pending(pending) or ingested
+                    pending = []
+                    self.handle_line(data)
+                else:
+                    pending.append(data.strip())
+            waiting -= read
+            if not read or waiting <= 0:
+                break
+        return self.ingest_pending(pending) or ingested
+
+    def ingest_pending(self, lines: typing.List[bytes]) -> bool:
+        """Ingest the data lines from a drained backlog, only the newest valid one unless aggregating.
+
+        Returns: True if the metrics were updated, False if not
+        """
+        if not lines:
+            return False
+        self.lines_read += len(lines)
+        if not hasattr(self, "plan") and not self.apply_cached_layout(
+            fieldcount=lines[-1].rstrip(b",").count(b",") - 1
+        ):
+            self.lines_dropped += len(lines)
+            return False
+        newest_only = self.aggregator is None
+        ingested = self.ingest_raw_batch(lines, newest_only=newest_only)
+        if ingested:
+            self.mismatches = 0
+        elif self.resync(
+            fieldcount=lines[-1].rstrip(b",").count(b",") - 1, lines=len(lines)
+        ):
+            # no line had the number of metrics we expected, but the sensor config was inferred
+            ingested = self.ingest_raw_batch(lines, newest_only=newest_only)
+        self.lines_dropped += len(lines) - ingested
+        return ingested > 0
+
+    def handle_line(self, line: bytes) -> bool:
+        """Handle a raw line from the serial port, be it a reboot banner, a header line or data.
+
+        Returns: True if the line was data which updated the metrics, False if not
+        """
+        line = line.strip()
+        if not line:
+            # read timeout or empty line
+            return False
+        self.lines_read += 1
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Got line: {line!r}")
+
+        # detect reboots
+        if line.startswith(b"Artemis OpenLog"):
+            # reboot detected, check sensor config
+            self.request_header()
+            return False
+
+        # detect header line
+        if line.startswith(b"rtcDate,rtcTime"):
+            self.handle_header_line(line)
+            return False
+
+        # we can only ingest data after we've seen the header line and created metrics,
+        # or found a cached sensor config with the same number of metrics as this line
+        if not hasattr(self, "plan") and not self.apply_cached_layout(
+            fieldcount=line.rstrip(b",").count(b",") - 1
+        ):
+            return False
+        started = time.perf_counter()
+        ingested = self.ingest_raw(line)
+        self.ingest_latency.observe(time.perf_counter() - started)
+        return ingested
+
+    def handle_header_line(self, line: bytes) -> None:
+        """Decode a stripped header line and apply the sensor config in it."""
+        try:
+            headerline = line.decode("ASCII").strip(",")
+        except UnicodeDecodeError:
+            # skip random serial line noise
+            self.decode_errors += 1
+            return
+        logger.debug("Header line detected, parsing sensor config...")
+        self.parse_sensor_config(headerline=headerline)
+
+    def replay(self, path: str, trace_memory: bool = False) -> "ReplayStats":
+        """Feed a recorded serial capture through handle_line() as fast as possible.
+
+        The capture is a file with the raw lines as read from the serial port. No serial port is
+        opened and header requests are discarded, so nothing ever sleeps. The textfile is written
+        like disco() does, with a TextfileFlusher called inline instead of from a thread.
+
+        Args:
+            path: The path of the capture file
+            trace_memory: Measure peak Python memory use with tracemalloc, which slows things down
+
+        Returns: The statistics of the replay
+        """
+        self.serial = NullSerial()
+        if self.header_cache_path:
+            self.headercache.load(self.header_cache_path, self.sensors)
+        if self.ring_path:
+            self.open_ring()
+        sink = self.start_push() if self.push_url else None
+        flusher = None
+        if self.prompath and self.flush_interval > 0:
+            flusher = TextfileFlusher(
+                exporter=self,
+                min_interval=self.flush_interval,
+                max_staleness=self.max_staleness,
+            )
+
+        stats = ReplayStats()
+        if trace_memory:
+            tracemalloc.start()
+        clock = time.perf_counter
+        with open(path, "rb") as f:
+            started = clock()
+            while True:
+                before = clock()
+                line = f.readline()
+                read = clock()
+                if not line:
+                    break
+                stats.add("read", read - before)
+                ingested = self.handle_line(line)
+                handled = clock()
+                # reboot banners are header handling too
+                header = line.startswith((b"rtcDate,rtcTime", b"Artemis OpenLog"))
+                stats.add("header" if header else "ingest", handled - read)
+                if ingested and self.prompath:
+                    if not flusher:
+                        self.write_textfile_collector_file()
+                    elif not flusher.flush_if_due():
+                        continue
+                    stats.add("write", clock() - handled)
+            stats.seconds = clock() - started
+        if flusher:
+            flusher.stop()
+        if sink:
+            sink.stop()
+        if trace_memory:
+            stats.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return stats
+
+    def start_http_server(self) -> http.server.ThreadingHTTPServer:
+        """Serve the cached exposition on self.listen from a background thread.
+
+        Returns: The running server
+        """
+        assert self.listen
+        address, _, port = self.listen.rpartition(":")
+        # IPv6 addresses are bracketed like [::1]:9999
+        address = address.strip("[]")
+        serverclass = (
+            IPv6HTTPServer if ":" in address else http.server.ThreadingHTTPServer
+        )
+        server = serverclass((address, int(port)), MetricsHandler)
+        server.daemon_threads = True
+        server.exposition = self.exposition  # type: ignore
+        logger.info(f"Serving metrics on http://{self.listen}/metrics")
+        threading.Thread(
+            target=server.serve_forever, name="http-server", daemon=True
+        ).start()
+        return server
+
+
+class LineFramer:
+    """A fixed size buffer which serial port reads go into, and complete lines are sliced out of.
+
+    Bytes are read straight into the free space at the end of the buffer with readinto(), lines
+    are found with find() and handed out as memoryview slices of the buffer without copying. Only
+    the partial line left over is moved to the front of the buffer before the next read. A line
+    which does not fit in the buffer, like a burst of noise without newlines, is discarded up to
+    the next newline.
+    """
+
+    def __init__(self, size: int = 65536) -> None:
+        """Allocate the buffer.
+
+        Args:
+            size: The size of the buffer in bytes, which is also the longest line possible
+        """
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # the first byte not handed out as part of a line yet, and the end of the bytes read
+        self.start = 0
+        self.end = 0
+        # set while skipping the rest of a line which did not fit in the buffer
+        self.discarding = False
+        self.overflows = 0
+
+    def pending(self) -> memoryview:
+        """Return the partial line at the end of the buffer."""
+        return self.view[self.start : self.end]
+
+    def free(self) -> memoryview:
+        """Make room for a read by moving the partial line to the front and return the free space."""
+        if self.start:
+            size = self.end - self.start
+            self.view[:size] = self.view[self.start : self.end]
+            self.start, self.end = 0, size
+        if self.end == len(self.buffer):
+            # the partial line fills the whole buffer, discard it up to the next newline
+            logger.warning(
+                f"Discarding a line longer than the {len(self.buffer)} byte line buffer"
+            )
+            self.overflows += 1
+            self.discarding = True
+            self.end = 0
+        return self.view[self.end :]
+
+    def fill(self, stream: typing.Any, size: int) -> int:
+        """Read at most size bytes from the stream into the free space of the buffer.
+
+        Returns: The number of bytes read
+        """
+        read: int = stream.readinto(self.free()[:size]) or 0
+        self.end += read
+        return read
+
+    def lines(self) -> typing.Iterator[memoryview]:
+        """Yield the complete non-empty lines in the buffer without the line ending.
+
+        The slices are only valid until the next fill().
+        """
+        buffer = self.buffer
+        while True:
+            newline = buffer.find(b"\n", self.start, self.end)
+            if newline < 0:
+                return
+            start, end = self.start, newline
+            self.start = newline + 1
+            if self.discarding:
+                # the end of a line which did not fit in the buffer
+                self.discarding = False
+                continue
+            if end > start and buffer[end - 1] == 13:
+                # strip the \r
+                end -= 1
+            if end > start:
+                yield self.view[start:end]
+
+
+class NullSerial:
+    """A stand-in for the serial port when replaying a capture, everything written is discarded."""
+
+    in_waiting = 0
+
+    def write(self, data: bytes) -> int:
+        """Discard the data."""
+        return len(data)
+
+
+class DeviceClock:
+    """Converts the rtcDate and rtcTime fields of data lines into timestamps, and tracks drift.
+
+    The real time clock of the OpenLog Artemis is taken to be in UTC. The date only changes once a
+    day, so it is only parsed when it changes, and every line just adds the time of day to the
+    cached midnight. The drift is the difference between the device clock and the host clock when
+    the line was ingested, which includes the delay of the serial port.
+    """
+
+    def __init__(self, date_format: str = "%m/%d/%Y", max_drift: float = 5.0) -> None:
+        """Start out without a cached date."""
+        self.date_format = date_format
+        self.max_drift = max_drift
+        self.date: typing.Union[str, bytes, None] = None
+        self.midnight = 0.0
+        self.dates_parsed = 0
+        # the number of lines with a date or time which could not be parsed
+        self.errors = 0
+        self.drift: typing.Optional[float] = None
+        self.drifting = False
+
+    def timestamp(
+        self, date: typing.Union[str, bytes], clock: typing.Union[str, bytes]
+    ) -> float:
+        """Return the seconds since the epoch of a rtcDate and rtcTime like 01/07/2000 and 16:18:45.54.
+
+        Raises: ValueError if the date or time cannot be parsed
+        """
+        if date != self.date:
+            datestring = date.decode("ASCII") if isinstance(date, bytes) else date
+            self.midnight = float(
+                calendar.timegm(time.strptime(datestring, self.date_format))
+            )
+            self.date = date
+            self.dates_parsed += 1
+        hours, minutes, seconds = (
+            clock.split(b":") if isinstance(clock, bytes) else clock.split(":")
+        )
+        timestamp = (
+            self.midnight + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        )
+
+        self.drift = timestamp - time.time()
+        drifting = abs(self.drift) > self.max_drift
+        if drifting != self.drifting:
+            self.drifting = drifting
+            if drifting:
+                logger.warning(
+                    f"Device clock is {self.drift:+.1f} seconds off the host clock"
+                )
+            else:
+                logger.info("Device clock is back in sync with the host clock")
+        return timestamp
+
+
+class ReplayStats:
+    """Throughput, per stage latencies and memory use of a replay."""
+
+    def __init__(self) -> None:
+        """Start out without any measurements."""
+        self.seconds = 0.0
+        # the duration of each pass through each stage, in seconds
+        self.stages: typing.Dict[str, "array.array[float]"] = {}
+        # the peak Python memory use in bytes, when measured with tracemalloc
+        self.peak_memory: typing.Optional[int] = None
+
+    def add(self, stage: str, seconds: float) -> None:
+        """Add a measurement for a stage."""
+        if stage not in self.stages:
+            self.stages[stage] = array.array("d")
+        self.stages[stage].append(seconds)
+
+    @property
+    def lines(self) -> int:
+        """Return the number of lines read."""
+        return len(self.stages.get("read", []))
+
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        """Return the statistics as a dict which can be serialised as JSON.
+
+        Stage latencies are in microseconds, the maximum resident set size in kilobytes.
+        """
+        stages = {}
+        for stage, durations in self.stages.items():
+            ordered = sorted(durations)
+            stages[stage] = {
+                "count": len(ordered),
+                "total_s": sum(ordered),
+            }
+            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                stages[stage][f"{name}_us"] = (
+                    ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1e6
+                )
+            stages[stage]["max_us"] = ordered[-1] * 1e6
+        return {
+            "lines": self.lines,
+            "seconds": self.seconds,
+            "lines_per_second": self.lines / self.seconds if self.seconds else 0,
+            "stages": stages,
+            "peak_memory_bytes": self.peak_memory,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+    def report(self) -> str:
+        """Return the statistics as human readable text."""
+        summary = self.summary()
+        lines = [
+            f"Replayed {summary['lines']} lines in {summary['seconds']:.3f} seconds ({summary['lines_per_second']:.0f} lines/s)",
+            f"{'stage':>8} {'count':>8} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>9}",
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(
+                f"{stage:>8} {stats['count']:>8} {stats['p50_us']:>9.1f} {stats['p90_us']:>9.1f} {stats['p99_us']:>9.1f} {stats['max_us']:>9.1f}"
+            )
+        if summary["peak_memory_bytes"] is not None:
+            lines.append(f"Peak traced memory: {summary['peak_memory_bytes']} bytes")
+        lines.append(f"Max resident set size: {summary['max_rss_kb']} kB")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """Run the exporter under cProfile for a number of lines or seconds, and dump the stats by stage.
+
+    Every thread started while profiling gets a profile of its own which is merged into the one
+    of the main thread, so the writes of the TextfileFlusher and the HTTP server count too. The
+    merged stats are dumped in the pstats format, and summed up by stage as JSON next to them.
+    """
+
+    def __init__(
+        self,
+        exporter: QwiicExporter,
+        path: str,
+        lines: int = 0,
+        seconds: float = 0,
+        trace_memory: bool = False,
+    ) -> None:
+        """Remember where to dump the stats and when to stop.
+
+        Args:
+            exporter: The exporter whose devices count the lines read
+            path: The path of the pstats file, the summary is written to path.json
+            lines: Stop after this many lines have been read, 0 means no limit
+            seconds: Stop after this many seconds, 0 means no limit
+            trace_memory: Also trace memory allocations with tracemalloc, which slows things down
+        """
+        self.exporter = exporter
+        self.path = path
+        self.lines = lines
+        self.seconds = seconds
+        self.trace_memory = trace_memory
+        self.profiles: typing.List[cProfile.Profile] = []
+        self.done = threading.Event()
+
+    @staticmethod
+    def stages() -> typing.Dict[str, typing.List[typing.Tuple[str, int, str]]]:
+        """Return the pstats keys of the functions whose cumulative time makes up each stage.
+
+        Calls between the functions of a stage are counted once, and the time spent in other
+        stages called from a stage, like the decode stage called from ingest, is not counted.
+        """
+
+        def key(
+            function: typing.Callable[..., typing.Any],
+        ) -> typing.Tuple[str, int, str]:
+            code = function.__code__
+            return code.co_filename, code.co_firstlineno, code.co_name
+
+        return {
+            # replay() reads lines from a capture file instead
+            "serial read": [
+                key(LineFramer.fill),
+                ("~", 0, "<method 'readline' of '_io.BufferedReader' objects>"),
+            ],
+            "decode": [
+                key(split_line),
+                key(IngestPlan.convert),
+                key(IngestPlan.convert_matrix),
+            ],
+            # reboot banners, header lines, and data lines out of sync with the sensor config
+            "header parse": [
+                key(QwiicExporter.request_header),
+                key(QwiicExporter.handle_header_line),
+                key(QwiicExporter.parse_sensor_config),
+                key(QwiicExporter.apply_cached_layout),
+                key(QwiicExporter.resync),
+            ],
+            "ingest": [
+                key(QwiicExporter.ingest_data),
+                key(QwiicExporter.ingest_raw),
+                key(QwiicExporter.ingest_readings),
+                key(QwiicExporter.ingest_raw_batch),
+            ],
+            "textfile write": [key(QwiicExporter.write_textfile_collector_file)],
+        }
+
+    def start_thread_profile(
+        self, frame: typing.Any, event: str, arg: typing.Any
+    ) -> None:
+        """Profile a thread started while profiling, called for the first profile event of the thread."""
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer Pythons only allow one active profiler, the thread is not profiled then
+            return
+        self.profiles.append(profile)
+
+    def interrupt(self, signum: int, frame: typing.Any) -> None:
+        """Stop the profiled target on SIGINT, from the watcher or from the user."""
+        if not self.done.is_set():
+            raise KeyboardInterrupt
+
+    def watch(self) -> None:
+        """Send SIGINT to this process when enough lines have been read or enough seconds have passed."""
+        started = time.monotonic()
+        while not self.done.wait(0.1):
+            lines = sum(device.lines_read for device in self.exporter.devices)
+            if (self.lines and lines >= self.lines) or (
+                self.seconds and time.monotonic() - started >= self.seconds
+            ):
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+
+    def run(
+        self, target: typing.Callable[[], typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+        """Run the target under the profiler until it returns or the limit is reached, and dump the stats.
+
+        Returns: The summary which is written to path.json
+        """
+        handler = signal.signal(signal.SIGINT, self.interrupt)
+        # started before profiling, so the watcher is not profiled itself
+        threading.Thread(
+            target=self.watch, name="qwiic-profile-watcher", daemon=True
+        ).start()
+        if self.trace_memory:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        self.profiles = [profile]
+        threading.setprofile(self.start_thread_profile)
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            target()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - started
+            threading.setprofile(None)
+            self.done.set()
+            signal.signal(signal.SIGINT, handler)
+
+        stats = pstats.Stats(profile)
+        for other in self.profiles[1:]:
+            stats.add(other)
+        stats.dump_stats(self.path)
+        summary = self.summarise(stats, seconds)
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            summary["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            summary["allocations"] = [
+                {
+                    "location": f"{allocation.traceback[0].filename}:{allocation.traceback[0].lineno}",
+                    "size_bytes": allocation.size,
+                    "count": allocation.count,
+                }
+                for allocation in snapshot.statistics("lineno")[:20]
+            ]
+            tracemalloc.stop()
+        with open(f"{self.path}.json", "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def summarise(
+        self, stats: pstats.Stats, seconds: float
+    ) -> typing.Dict[str, typing.Any]:
+        """Sum up the cumulative time of the functions of each stage, and list the slowest functions.
+
+        Returns: A dict which can be serialised as JSON, times are in seconds
+        """
+        entries = stats.stats  # type: ignore
+        stagekeys = self.stages()
+        stageof = {key: stage for stage, keys in stagekeys.items() for key in keys}
+        stages: typing.Dict[str, typing.Dict[str, float]] = {
+            stage: {"seconds": 0.0, "calls": 0} for stage in stagekeys
+        }
+        for key, stage in stageof.items():
+            if key not in entries:
+                continue
+            # the callers of a function are tuples of (calls, primitive calls, tottime, cumtime)
+            for caller, (calls, _, _, cumtime) in entries[key][4].items():
+                callerstage = stageof.get(caller)
+                if callerstage == stage:
+                    continue
+                stages[stage]["seconds"] += cumtime
+                stages[stage]["calls"] += calls
+                if callerstage:
+                    stages[callerstage]["seconds"] -= cumtime
+        functions = sorted(entries.items(), key=lambda entry: entry[1][2], reverse=True)
+        return {
+            "seconds": seconds,
+            "lines": sum(device.lines_read for device in self.exporter.devices),
+            "threads": len(self.profiles),
+            "stages": stages,
+            "functions": [
+                {
+                    "function": f"{key[0]}:{key[1]}({key[2]})",
+                    "calls": calls,
+                    "tottime": tottime,
+                    "cumtime": cumtime,
+                }
+                for key, (_, calls, tottime, cumtime, _) in functions[:25]
+            ],
+        }
+
+    @staticmethod
+    def report(summary: typing.Dict[str, typing.Any]) -> str:
+        """Return the time spent in each stage as human readable text."""
+        lines = [
+            f"Profiled {summary['lines']} lines in {summary['seconds']:.3f} seconds in {summary['threads']} thread(s)",
+            f"{'stage':>14} {'calls':>8} {'seconds':>9}",
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(f"{stage:>14} {stats['calls']:>8} {stats['seconds']:>9.3f}")
+        if "peak_memory_bytes" in summary:
+            lines.append(f"Peak traced memory: {summary['peak_memory_bytes']} bytes")
+        return "\n".join(lines)
+
+
+class LineGenerator:
+    """Generate header and data lines like an OpenLog Artemis with the given sensor config would."""
+
+    def __init__(
+        self,
+        sensors: typing.Dict[
+            str, typing.Dict[str, typing.List[typing.Tuple[str, str, str, float]]]
+        ],
+        sensorconfig: SensorConfig,
+        rate: float = 1.0,
+        seed: typing.Optional[int] = None,
+    ) -> None:
+        """Find the header elements of the sensor config.
+
+        Args:
+            sensors: The sensors dict
+            sensorconfig: The sensors and enabled subsensors, in output order
+            rate: The number of lines per second, used for the timestamps in the lines
+            seed: Seed for the random readings, for reproducible output
+        """
+        self.metrics = [
+            metric[0]
+            for sensorname, subsensornames in sensorconfig
+            for subsensorname in subsensornames
+            for metric in sensors[sensorname][subsensorname]
+        ]
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.timestamp = datetime.datetime(2000, 1, 7, 16, 18, 45)
+        self.count = 0
+
+    def header_line(self) -> bytes:
+        """Return the header line, as shown after sending "h" to the OpenLog Artemis."""
+        return f"rtcDate,rtcTime,{','.join(self.metrics)},\r\n".encode("ASCII")
+
+    def data_line(self) -> bytes:
+        """Return the next data line with random readings."""
+        self.count += 1
+        readings = []
+        for metric in self.metrics:
+            if metric == "output_Hz":
+                readings.append(f"{self.rate:.02f}")
+            elif metric == "count":
+                readings.append(str(self.count))
+            else:
+                readings.append(f"{self.random.uniform(-1000, 1000):.02f}")
+        line = f"{self.timestamp:%m/%d/%Y,%H:%M:%S}.{self.timestamp.microsecond // 10000:02d},{','.join(readings)},\r\n"
+        self.timestamp += datetime.timedelta(seconds=1 / self.rate)
+        return line.encode("ASCII")
+
+
+class OpenLogSimulator:
+    """Pretend to be an OpenLog Artemis on a pseudo-terminal, for load testing without hardware.
+
+    Data lines for the sensor config are written at the configured rate from a background thread.
+    A newline followed by "h" is answered with the header line, like the real menu does. Reboot
+    banners, line noise and truncated lines are injected with the configured probabilities.
+    When the reader falls behind and the pty buffer is full, lines are dropped like a UART would.
+    """
+
+    def __init__(
+        self,
+        sensorconfig: SensorConfig,
+        rate: float = 10.0,
+        reboot_probability: float = 0.0,
+        noise_probability: float = 0.0,
+        truncate_probability: float = 0.0,
+        seed: typing.Optional[int] = None,
+    ) -> None:
+        """Create the pseudo-terminal. Open the serial port at self.path to talk to the simulator."""
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.rate = rate
+        self.reboot_probability = reboot_probability
+        self.noise_probability = noise_probability
+        self.truncate_probability = truncate_probability
+        self.random = random.Random(seed)
+        self.generator = LineGenerator(
+            sensors=SensorCatalogue.load().sensors,
+            sensorconfig=sensorconfig,
+            rate=rate,
+            seed=seed,
+        )
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="simulator", daemon=True)
+        # the number of lines written and dropped because the reader was too slow
+        self.written = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        """Start writing lines."""
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop writing lines and close the pseudo-terminal."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self) -> None:
+        """Write lines at the configured rate and answer the menu until stop() is called."""
+        interval = 1 / self.rate
+        next_line = time.monotonic()
+        menu_open = False
+        while not self.stopped.is_set():
+            readable, _, _ = select.select(
+                [self.master], [], [], max(0, next_line - time.monotonic())
+            )
+            if readable:
+                try:
+                    commands = os.read(self.master, 1024)
+                except BlockingIOError:
+                    commands = b""
+                for command in commands:
+                    if command == ord("\n"):
+                        menu_open = True
+                    elif command == ord("h") and menu_open:
+                        self.write(self.generator.header_line())
+                        menu_open = False
+            if time.monotonic() >= next_line:
+                self.write(self.next_line())
+                next_line += interval
+
+    def next_line(self) -> bytes:
+        """Return the next line to write, which is usually a data line."""
+        chance = self.random.random()
+        if chance < self.reboot_probability:
+            return b"Artemis OpenLog v1.9\r\n"
+        chance -= self.reboot_probability
+        if chance < self.noise_probability:
+            noise = bytes(self.random.randrange(256) for _ in range(20))
+            return noise + b"\r\n"
+        chance -= self.noise_probability
+        line = self.generator.data_line()
+        if chance < self.truncate_probability:
+            return line[: self.random.randrange(1, len(line) - 2)] + b"\r\n"
+        return line
+
+    def write(self, line: bytes) -> None:
+        """Write a line to the pseudo-terminal, or drop it if the reader is too slow."""
+        try:
+            os.write(self.master, line)
+            self.written += 1
+        except BlockingIOError:
+            self.dropped += 1
+
+
+class ExpositionCache:
+    """The rendered exposition of an exporter registry, rebuilt only when the values changed.
+
+    Both the plain and the gzipped exposition are cached, so any number of scrapers can
+    fetch the metrics between two ingested lines for the price of a single render. When no
+    values change the exposition is still rebuilt every max_age seconds, so the metrics about
+    the exporter itself, like the age of the newest sample, stay current.
+    """
+
+    max_age: float = 5.0
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Start out with an empty cache."""
+        self.exporter = exporter
+        self.lock = threading.Lock()
+        self.generation: typing.Optional[int] = None
+        self.rendered = 0.0
+        self.body = b""
+        self.gzipped: typing.Optional[bytes] = None
+        self.renders = 0
+
+    def get(self, compressed: bool = False) -> bytes:
+        """Return the exposition, rendering it first if ingest_data() changed anything.
+
+        Args:
+            compressed: Return the gzipped exposition instead of the plain one
+
+        Returns: The exposition in the Prometheus text format
+        """
+        with self.lock:
+            self.exporter.evict_series()
+            generation = self.exporter.total_generation()
+            now = time.monotonic()
+            if generation != self.generation or now - self.rendered > self.max_age:
+                self.body = self.exporter.template.render()
+                self.gzipped = None
+                self.generation = generation
+                self.rendered = now
+                self.renders += 1
+            if not compressed:
+                return self.body
+            if self.gzipped is None:
+                self.gzipped = gzip.compress(self.body)
+            return self.gzipped
+
+
+class ExpositionTemplate:
+    """The exposition of the registry of an exporter, with the sensor metrics pre-rendered.
+
+    The HELP and TYPE lines and the label sets of the sensor metrics only change with the sensor
+    config, so they are rendered once into a template with a slot for each value, and a render
+    only formats the current values into it. The other collectors, like the metrics about the
+    exporter itself, are rendered as usual. The output is the same as generate_latest().
+    """
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Start out without a template, it is built on the first render."""
+        self.exporter = exporter
+        self.lock = threading.Lock()
+        # what the template was built for, see stale()
+        self.key: typing.Optional[typing.Tuple[typing.Any, ...]] = None
+        # each segment is either a template and the value getters for its slots, or a group of
+        # collectors which are rendered with generate_latest()
+        self.segments: typing.List[
+            typing.Union[
+                typing.Tuple[str, typing.List[typing.Callable[[], float]]],
+                "CollectorGroup",
+            ]
+        ] = []
+        self.builds = 0
+
+    def current_key(self) -> typing.Tuple[typing.Any, ...]:
+        """Return what the template depends on: the plan of each device, evictions and the collectors."""
+        devices = self.exporter.devices
+        return (
+            [getattr(device, "plan", None) for device in devices],
+            sum(device.series_evicted for device in devices),
+            len(self.exporter.registry._collector_to_names),
+        )
+
+    def stale(self, key: typing.Tuple[typing.Any, ...]) -> bool:
+        """Return True if the template was built for other plans or collectors than the current ones."""
+        if self.key is None:
+            return True
+        plans, evicted, collectors = self.key
+        return (
+            evicted != key[1]
+            or collectors != key[2]
+            or len(plans) != len(key[0])
+            or any(plan is not current for plan, current in zip(plans, key[0]))
+        )
+
+    def build(self) -> None:
+        """Render the sensor metrics in registry order into templates, and group the other collectors."""
+        segments: typing.List[
+            typing.Union[
+                typing.Tuple[str, typing.List[typing.Callable[[], float]]],
+                CollectorGroup,
+            ]
+        ] = []
+        lines: typing.List[str] = []
+        getters: typing.List[typing.Callable[[], float]] = []
+        others: typing.List[typing.Any] = []
+
+        def add_family(
+            name: str,
+            documentation: str,
+            samples: typing.Iterable[
+                typing.Tuple[typing.Dict[str, str], typing.Callable[[], float]]
+            ],
+        ) -> None:
+            """Add the HELP and TYPE lines and a line with a slot for each sample of a gauge family."""
+            if others:
+                segments.append(CollectorGroup(list(others)))
+                others.clear()
+            documentation = documentation.replace("\\", r"\\").replace("\n", r"\n")
+            # literal percent signs must survive formatting the values into the template
+            lines.append(
+                f"# HELP {name} {documentation}\n# TYPE {name} gauge\n".replace(
+                    "%", "%%"
+                )
+            )
+            for labels, getter in samples:
+                labelstr = "{" + format_labels(labels) + "}" if labels else ""
+                lines.append(f"{name}{labelstr}".replace("%", "%%") + " %s\n")
+                getters.append(getter)
+
+        def flush_template() -> None:
+            """End the template of the sensor metrics rendered so far."""
+            if lines:
+                segments.append(("".join(lines), list(getters)))
+                lines.clear()
+                getters.clear()
+
+        with self.exporter.serieslock:
+            key = self.current_key()
+            for collector in list(self.exporter.registry._collector_to_names):
+                if isinstance(collector, prometheus_client.Gauge):
+                    add_family(
+                        collector._name,
+                        collector._documentation,
+                        (
+                            (
+                                dict(zip(collector._labelnames, labelvalues)),
+                                child._value.get,
+                            )
+                            for labelvalues, child in list(collector._metrics.items())
+                        ),
+                    )
+                elif isinstance(collector, FlatCollector):
+                    for name, (documentation, samples) in collector.families().items():
+                        add_family(
+                            name,
+                            documentation,
+                            (
+                                (
+                                    labels,
+                                    functools.partial(plan.array.__getitem__, index),
+                                )
+                                for labels, plan, index in samples
+                            ),
+                        )
+                else:
+                    flush_template()
+                    others.append(collector)
+            flush_template()
+            if others:
+                segments.append(CollectorGroup(others))
+        self.segments = segments
+        self.key = key
+        self.builds += 1
+
+    def render(self) -> bytes:
+        """Return the exposition in the Prometheus text format, building the template first if it is stale."""
+        with self.lock:
+            if self.stale(self.current_key()):
+                self.build()
+            output = []
+            floatstr = prometheus_client.utils.floatToGoString
+            for segment in self.segments:
+                if isinstance(segment, tuple):
+                    template, slots = segment
+                    output.append(
+                        (template % tuple([floatstr(get()) for get in slots])).encode(
+                            "utf-8"
+                        )
+                    )
+                else:
+                    output.append(prometheus_client.generate_latest(segment))
+            return b"".join(output)
+
+
+class CollectorGroup:
+    """A list of collectors with the collect() of a registry, for rendering them with generate_latest()."""
+
+    def __init__(self, collectors: typing.List[typing.Any]) -> None:
+        """Remember the collectors, in registry order."""
+        self.collectors = collectors
+
+    def collect(self) -> typing.Iterator[prometheus_client.core.Metric]:
+        """Yield the metric families of all collectors."""
+        for collector in self.collectors:
+            yield from collector.collect()
+
+
+class IPv6HTTPServer(http.server.ThreadingHTTPServer):
+    """A ThreadingHTTPServer listening on an IPv6 address."""
+
+    address_family = socket.AF_INET6
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler serving the cached exposition with keep-alive and gzip."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        """Serve /metrics from the exposition cache."""
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = self.server.exposition.get(compressed=compressed)  # type: ignore
+        self.send_response(200)
+        self.send_header("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        """Send the access log to the debug log instead of stderr."""
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def format_labels(labels: typing.Dict[str, str]) -> str:
+    """Render labels the way they go between the braces in the text exposition formats."""
+    return ",".join(
+        '{}="{}"'.format(
+            key,
+            value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for key, value in sorted(labels.items())
+    )
+
+
+class ReadingRing:
+    """A fixed size ring buffer of timestamped readings in a memory mapped file.
+
+    Each record is the timestamp of a data line, the number of its layout and up to width values,
+    all as float64s, so appending a line is a single pack_into() the page cache takes care of. The
+    width is that of the widest line recorded and is kept in the header, a wider layout widens
+    the records of the whole file once. A layout is the metric name, description and labels of
+    each value of a line, the layouts are kept in a JSON file next to the ring file. When the ring
+    is full the oldest records are overwritten. The records can be exported as OpenMetrics for
+    backfilling with promtool.
+    """
+
+    # magic, version, width, capacity and the number of records ever appended
+    header = struct.Struct("<4sIIQQ4x")
+    magic = b"QWRB"
+    version = 1
+    # the offset of the number of records ever appended in the header
+    head_offset = 20
+
+    def __init__(self, path: str, capacity: int, width: int = 0) -> None:
+        """Open the ring file at path, or create it if it does not exist or has another capacity.
+
+        Args:
+            path: The path of the ring file, the layouts are kept in path.layouts.json
+            capacity: The number of records in the ring
+            width: The number of values the records have room for at least, they are widened to
+                   the widest line recorded
+        """
+        self.path = path
+        self.capacity = capacity
+        self.file = open(path, "a+b")
+        self.file.seek(0)
+        existing = self.file.read(self.header.size)
+        self.head = 0
+        oldwidth = 0
+        if len(existing) == self.header.size:
+            magic, version, oldwidth, oldcapacity, head = self.header.unpack(existing)
+            if (magic, version, oldcapacity) == (self.magic, self.version, capacity):
+                self.head = head
+            else:
+                logger.warning(
+                    f"Ring buffer {path} has another format or size, starting it over"
+                )
+                oldwidth = 0
+        self.map(oldwidth)
+        if width > self.width:
+            self.widen(width)
+        # one struct per number of values, so appends do not pad the records
+        self.packers: typing.Dict[int, struct.Struct] = {}
+
+        self.layoutpath = f"{path}.layouts.json"
+        self.layouts: typing.List[typing.List[typing.Any]] = []
+        if self.head:
+            try:
+                with open(self.layoutpath) as f:
+                    self.layouts = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    f"Unable to load ring buffer layouts {self.layoutpath}, starting over: {e}"
+                )
+                self.head = 0
+        self.layoutnumbers = {
+            json.dumps(layout, sort_keys=True): number
+            for number, layout in enumerate(self.layouts)
+        }
+
+    @classmethod
+    def open(cls, path: str) -> "ReadingRing":
+        """Open an existing ring file with the capacity and width it was created with.
+
+        Raises: OSError or ValueError if path is not a ring file
+        """
+        with open(path, "rb") as f:
+            existing = f.read(cls.header.size)
+        if len(existing) != cls.header.size:
+            raise ValueError(f"{path} is not a ring buffer file")
+        magic, version, width, capacity, _ = cls.header.unpack(existing)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError(f"{path} is not a ring buffer file")
+        return cls(path, capacity=capacity, width=width)
+
+    def close(self) -> None:
+        """Close the memory map and the file."""
+        self.mmap.close()
+        self.file.close()
+
+    def map(self, width: int) -> None:
+        """Size the file for records of width values and map it, the records in it are kept as they are."""
+        self.width = width
+        self.record = struct.Struct(f"<{width + 2}d")
+        size = self.header.size + self.capacity * self.record.size
+        self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.header.pack_into(
+            self.mmap, 0, self.magic, self.version, width, self.capacity, self.head
+        )
+
+    def widen(self, width: int) -> None:
+        """Rewrite the records in the ring with room for width values each."""
+        logger.info(
+            f"Widening the records of ring buffer {self.path} to {width} values"
+        )
+        indexes = range(max(0, self.head - self.capacity), self.head)
+        records = [
+            self.record.unpack_from(
+                self.mmap, self.header.size + (index % self.capacity) * self.record.size
+            )
+            for index in indexes
+        ]
+        self.mmap.close()
+        self.map(width)
+        for index, record in zip(indexes, records):
+            offset = self.header.size + (index % self.capacity) * self.record.size
+            struct.pack_into(f"<{len(record)}d", self.mmap, offset, *record)
+
+    def layout(self, plan: "IngestPlan") -> int:
+        """Return the number of the layout of the plan, adding it if it is new.
+
+        Returns: The layout number
+        """
+        if len(plan) > self.width:
+            self.widen(len(plan))
+        layout = [
+            [name, description, labels]
+            for name, description, labels in zip(
+                plan.metricnames, plan.descriptions, plan.labelsets
+            )
+        ]
+        key = json.dumps(layout, sort_keys=True)
+        if key not in self.layoutnumbers:
+            self.layoutnumbers[key] = len(self.layouts)
+            self.layouts.append(layout)
+            tmppath = f"{self.layoutpath}.{os.getpid()}.tmp"
+            with open(tmppath, "w") as f:
+                json.dump(self.layouts, f)
+            os.replace(tmppath, self.layoutpath)
+        return self.layoutnumbers[key]
+
+    def append(
+        self, timestamp: float, layout: int, values: typing.Sequence[float]
+    ) -> None:
+        """Write a record over the oldest one."""
+        packer = self.packers.get(len(values))
+        if packer is None:
+            packer = self.packers[len(values)] = struct.Struct(f"<{len(values) + 2}d")
+        offset = self.header.size + (self.head % self.capacity) * self.record.size
+        packer.pack_into(self.mmap, offset, timestamp, layout, *values)
+        self.head += 1
+        struct.pack_into("<Q", self.mmap, self.head_offset, self.head)
+
+    def query(
+        self, start: float = -math.inf, end: float = math.inf
+    ) -> typing.Iterator[typing.Tuple[float, int, typing.Tuple[float, ...]]]:
+        """Yield the records with a timestamp from start up to but not including end, oldest first.
+
+        Returns: An iterator of (timestamp, layout number, values) tuples
+        """
+        for index in range(max(0, self.head - self.capacity), self.head):
+            offset = self.header.size + (index % self.capacity) * self.record.size
+            timestamp, layout = struct.unpack_from("<dd", self.mmap, offset)
+            if start <= timestamp < end:
+                values = self.record.unpack_from(self.mmap, offset)[2:]
+                yield timestamp, int(layout), values[: len(self.layouts[int(layout)])]
+
+    def export_openmetrics(
+        self, out: typing.TextIO, start: float = -math.inf, end: float = math.inf
+    ) -> int:
+        """Write the records from start up to end as OpenMetrics, for promtool tsdb create-blocks-from openmetrics.
+
+        Returns: The number of samples written
+        """
+        # metric name: (description, {label string: [(value, timestamp)]}), in order of appearance
+        families: typing.Dict[
+            str,
+            typing.Tuple[
+                str, typing.Dict[str, typing.List[typing.Tuple[float, float]]]
+            ],
+        ] = {}
+        # layout number: the (family, label string) of each value, rendered once per layout
+        targets: typing.Dict[int, typing.List[typing.Tuple[str, str]]] = {}
+        samples = 0
+        for timestamp, layout, values in self.query(start, end):
+            if layout not in targets:
+                targets[layout] = []
+                for name, description, labels in self.layouts[layout]:
+                    families.setdefault(name, (description, {}))
+                    targets[layout].append((name, format_labels(labels)))
+            for (name, labelstring), value in zip(targets[layout], values):
+                families[name][1].setdefault(labelstring, []).append((value, timestamp))
+                samples += 1
+        for name, (description, series) in families.items():
+            out.write(f"# TYPE {name} gauge\n")
+            out.write(f"# HELP {name} {description}\n")
+            for labelstring, points in series.items():
+                for value, timestamp in points:
+                    out.write(
+                        f"{name}{{{labelstring}}} {prometheus_client.utils.floatToGoString(value)} {timestamp:.3f}\n"
+                    )
+        out.write("# EOF\n")
+        return samples
+
+
+class HeaderCache:
+    """A LRU cache of header lines and the sensor configs parsed from them.
+
+    When a path is loaded the cache is also saved to it every time a new header line is added,
+    so a restarted exporter can start ingesting before the header line arrives.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        """Start out with an empty cache which is not persisted."""
+        self.maxsize = maxsize
+        self.path: typing.Optional[str] = None
+        self.entries: "collections.OrderedDict[str, SensorConfig]" = (
+            collections.OrderedDict()
+        )
+
+    def get(self, header: str) -> typing.Optional[SensorConfig]:
+        """Return a copy of the sensor config for the header, or None if it is not cached."""
+        if header not in self.entries:
+            return None
+        self.entries.move_to_end(header)
+        return [(name, list(subsensors)) for name, subsensors in self.entries[header]]
+
+    def put(self, header: str, sensorconfig: SensorConfig) -> None:
+        """Add the sensor config for the header, and save the cache if it is persisted."""
+        self.entries[header] = [
+            (name, list(subsensors)) for name, subsensors in sensorconfig
+        ]
+        self.entries.move_to_end(header)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        if self.path:
+            self.save()
+
+    def by_fieldcount(
+        self, fieldcount: int
+    ) -> typing.Iterator[typing.Tuple[str, SensorConfig]]:
+        """Yield the cached headers and sensor configs with fieldcount metrics, most recently used first."""
+        for header in list(reversed(self.entries)):
+            # every element of the header line is one metric
+            if header and header.count(",") + 1 == fieldcount:
+                sensorconfig = self.get(header)
+                assert sensorconfig is not None
+                yield header, sensorconfig
+
+    def load(
+        self,
+        path: str,
+        sensors: typing.Dict[
+            str, typing.Dict[str, typing.List[typing.Tuple[str, str, str, float]]]
+        ],
+    ) -> None:
+        """Persist the cache to path from now on, and load the header lines already saved there.
+
+        Args:
+            path: The path of the cache file
+            sensors: The sensors dict, header lines with unknown (sub)sensors are not loaded
+        """
+        self.path = path
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to load header cache {path}, ignoring it: {e}")
+            return
+        for header, sensorconfig in entries:
+            if all(
+                name in sensors and all(sub in sensors[name] for sub in subsensors)
+                for name, subsensors in sensorconfig
+            ):
+                self.entries[header] = [
+                    (name, list(subsensors)) for name, subsensors in sensorconfig
+                ]
+        logger.debug(f"Loaded {len(self.entries)} header lines from {path}")
+
+    def save(self) -> None:
+        """Write the cache to the path atomically, oldest header line first."""
+        assert self.path
+        tmppath = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmppath, "w") as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(tmppath, self.path)
+
+
+class SensorCatalogue:
+    """The sensor definitions of a catalogue file, and the SignatureMatcher compiled from them.
+
+    The catalogue is a JSON object of sensors, each an object of subsensors, each a list of the
+    metrics of the subsensor in the order they appear in the header line. Sensors later in the
+    catalogue win when two sensors match a header equally well. The compiled catalogue can be
+    saved to an index file, which is loaded instead of compiling the catalogue again on the next
+    run as long as the catalogue file is unchanged.
+    """
+
+    # the catalogue of the sensors supported by the OpenLog Artemis, shipped with qwiic_exporter
+    default_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "sensors.json"
+    )
+    # the catalogues loaded by this process, by (catalogue path, index path)
+    loaded: typing.Dict[typing.Tuple[str, typing.Optional[str]], "SensorCatalogue"] = {}
+
+    def __init__(self, sensors: Sensors) -> None:
+        """Compile the signature matcher for the sensors."""
+        self.sensors = sensors
+        self.matcher = SignatureMatcher(sensors)
+
+    @classmethod
+    def load(
+        cls, path: typing.Optional[str] = None, indexpath: typing.Optional[str] = None
+    ) -> "SensorCatalogue":
+        """Return the catalogue at path, only loading and compiling it once per process.
+
+        Args:
+            path: The path of the catalogue file, defaults to the catalogue shipped with qwiic_exporter
+            indexpath: The path of the index file to load the compiled catalogue from, and to save
+                       it to when it is missing or out of date
+
+        Raises: OSError or ValueError if the catalogue file cannot be read or is invalid
+        """
+        key = (path or cls.default_path, indexpath)
+        if key not in cls.loaded:
+            if indexpath:
+                cls.loaded[key] = cls.from_index(key[0], indexpath)
+            else:
+                cls.loaded[key] = cls.from_file(key[0])
+        return cls.loaded[key]
+
+    @classmethod
+    def from_file(cls, path: str) -> "SensorCatalogue":
+        """Load and compile the catalogue file at path.
+
+        Raises: OSError or ValueError if the catalogue file cannot be read or is invalid
+        """
+        with open(path, encoding="utf-8") as f:
+            catalogue = json.load(f)
+        try:
+            sensors: Sensors = {
+                str(sensorname): {
+                    str(subsensorname): [
+                        (
+                            str(metric["header"]),
+                            str(metric["metric"]),
+                            str(metric["help"]),
+                            float(metric.get("multiplier", 1)),
+                        )
+                        for metric in metrics
+                    ]
+                    for subsensorname, metrics in subsensors.items()
+                }
+                for sensorname, subsensors in catalogue.items()
+            }
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid sensor catalogue {path}: {e!r}")
+        logger.debug(f"Loaded {len(sensors)} sensors from catalogue {path}")
+        return cls(sensors)
+
+    @classmethod
+    def from_index(cls, path: str, indexpath: str) -> "SensorCatalogue":
+        """Load the compiled catalogue from the index file, or compile it and save the index file.
+
+        The index file is a pickle, so it must not be writable by anyone who should not be able to
+        run code as the exporter.
+
+        Raises: OSError or ValueError if the catalogue file cannot be read or is invalid
+        """
+        stat = os.stat(path)
+        source = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, __version__]
+        try:
+            with open(indexpath, "rb") as f:
+                index = pickle.load(f)
+            if index["source"] == source:
+                logger.debug(f"Loaded compiled sensor catalogue from {indexpath}")
+                return typing.cast(SensorCatalogue, index["catalogue"])
+            logger.info(f"Sensor catalogue {path} changed, rebuilding {indexpath}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(
+                f"Unable to load sensor index {indexpath}, rebuilding it: {e!r}"
+            )
+
+        catalogue = cls.from_file(path)
+        tmppath = f"{indexpath}.{os.getpid()}.tmp"
+        try:
+            with open(tmppath, "wb") as f:
+                pickle.dump({"source": source, "catalogue": catalogue}, f)
+            os.replace(tmppath, indexpath)
+        except OSError as e:
+            logger.warning(f"Unable to save sensor index {indexpath}: {e!r}")
+        return catalogue
+
+
+class TrieNode:
+    """A node in the token trie of SignatureMatcher."""
+
+    __slots__ = ("children", "ends")
+
+    def __init__(self) -> None:
+        """Start out without children or subsensor signatures ending here."""
+        self.children: typing.Dict[str, TrieNode] = {}
+        # tuples of (sensorname, subsensor position, subsensorname) for signatures ending here
+        self.ends: typing.List[typing.Tuple[str, int, str]] = []
+
+
+class SignatureMatcher:
+    """Match header tokens against the subsensor signatures of all known sensors.
+
+    The signature of every subsensor is added to a token trie once. A header is matched by
+    walking the trie from the current position, and extending the match with the next
+    subsensors of the same sensor, in the order they appear in the sensors dict. This finds the
+    same longest match as looking up every combination of subsensors, without enumerating them.
+    """
+
+    def __init__(
+        self,
+        sensors: typing.Dict[
+            str, typing.Dict[str, typing.List[typing.Tuple[str, str, str, float]]]
+        ],
+    ) -> None:
+        """Build the token trie from the sensors dict."""
+        self.root = TrieNode()
+        # sensors later in the sensors dict win when two sensors match equally well
+        self.priority = {name: index for index, name in enumerate(sensors)}
+        for sensorname, subsensors in sensors.items():
+            for index, (subsensorname, metrics) in enumerate(subsensors.items()):
+                node = self.root
+                for metric in metrics:
+                    node = node.children.setdefault(metric[0], TrieNode())
+                node.ends.append((sensorname, index, subsensorname))
+
+    def subsensor_matches(
+        self, tokens: typing.Sequence[str], position: int
+    ) -> typing.Iterator[typing.Tuple[str, int, str, int]]:
+        """Walk the trie from position and yield every subsensor signature found.
+
+        Returns: An iterator of (sensorname, subsensor position, subsensorname, end position) tuples
+        """
+        node = self.root
+        for end in range(position, len(tokens)):
+            child = node.children.get(tokens[end])
+            if child is None:
+                return
+            node = child
+            for sensorname, index, subsensorname in node.ends:
+                yield sensorname, index, subsensorname, end + 1
+
+    def longest_match(
+        self, tokens: typing.Sequence[str], position: int
+    ) -> typing.Optional[typing.Tuple[str, typing.List[str], int]]:
+        """Find the sensor matching the most tokens from position.
+
+        Returns: A tuple of (sensorname, enabled subsensornames, end position), or None if no
+                 sensor matches at position
+        """
+        best: typing.Optional[typing.Tuple[str, typing.List[str], int]] = None
+        # each state is a partial match of (sensorname, last subsensor position, subsensornames, end position)
+        states = [
+            (sensorname, index, [subsensorname], end)
+            for sensorname, index, subsensorname, end in self.subsensor_matches(
+                tokens, position
+            )
+        ]
+        while states:
+            sensorname, index, subsensornames, end = states.pop()
+            if (
+                best is None
+                or end > best[2]
+                or (
+                    end == best[2]
+                    and self.priority[sensorname] > self.priority[best[0]]
+                )
+            ):
+                best = (sensorname, subsensornames, end)
+            # extend with the following subsensors of the same sensor
+            for nextname, nextindex, subsensorname, nextend in self.subsensor_matches(
+                tokens, end
+            ):
+                if nextname == sensorname and nextindex > index:
+                    states.append(
+                        (
+                            sensorname,
+                            nextindex,
+                            subsensornames + [subsensorname],
+                            nextend,
+                        )
+                    )
+        return best
+
+
+def split_line(line: bytes) -> typing.List[bytes]:
+    """Split a stripped data line as read from the serial port into its fields, without the trailing comma."""
+    return line.rstrip(b",").split(b",")
+
+
+class IngestPlan:
+    """A gaugeindex compiled into already resolved child gauges and their multipliers.
+
+    Resolving the labelled child of a Gauge takes a dict lookup under a lock, so it is
+    done once per header line here instead of once per value in ingest_data().
+    """
+
+    __slots__ = (
+        "children",
+        "multipliers",
+        "metricnames",
+        "descriptions",
+        "labelsets",
+        "values",
+    )
+
+    def __init__(
+        self,
+        gaugeindex: typing.List[
+            typing.Tuple[str, int, str, str, float, prometheus_client.Gauge]
+        ],
+        device: typing.Optional[str] = None,
+    ) -> None:
+        """Resolve the child gauge for each element of the gaugeindex, in header order."""
+        extralabels = {"device": device} if device else {}
+        self.children = [
+            gauge[5].labels(
+                sensor=gauge[0], sensorindex=gauge[1], subsensor=gauge[2], **extralabels
+            )
+            for gauge in gaugeindex
+        ]
+        self.multipliers = array.array("d", [gauge[4] for gauge in gaugeindex])
+        self.metricnames = [gauge[3] for gauge in gaugeindex]
+        self.descriptions = [gauge[5]._documentation for gauge in gaugeindex]
+        self.labelsets = [
+            dict(
+                sensor=gauge[0],
+                sensorindex=str(gauge[1]),
+                subsensor=gauge[2],
+                **extralabels,
+            )
+            for gauge in gaugeindex
+        ]
+        # the values applied last
+        self.values: typing.Sequence[float] = []
+
+    def __len__(self) -> int:
+        """Return the number of values a data line must have."""
+        return len(self.children)
+
+    def series(self) -> typing.List[typing.Tuple[str, typing.Tuple[str, ...]]]:
+        """Return the metric name and label values of each child gauge."""
+        return [
+            (name, tuple(labels.values()))
+            for name, labels in zip(self.metricnames, self.labelsets)
+        ]
+
+    def convert(
+        self, readings: typing.Iterable[typing.Union[str, bytes]]
+    ) -> typing.Optional[typing.List[float]]:
+        """Convert all readings to floats and apply the multipliers in one go.
+
+        Returns: The list of values, or None if one or more readings are not numeric
+        """
+        try:
+            return list(map(operator.mul, map(float, readings), self.multipliers))
+        except ValueError:
+            return None
+
+    def convert_matrix(self, batch: typing.List[typing.List[bytes]]) -> typing.Any:
+        """Convert the readings of a batch of split data lines to a numpy matrix with one row per line and apply the multipliers.
+
+        Raises: ValueError if one or more readings are not numeric
+        """
+        return (
+            numpy.array([fields[2:] for fields in batch]).astype(float)
+            * self.multipliers
+        )
+
+    def apply(self, values: typing.Sequence[float]) -> None:
+        """Set each child gauge to the value at the same position."""
+        for child, value in zip(self.children, values):
+            child.set(value)
+        self.values = values
+
+
+class WindowAggregator:
+    """Streaming min/max/sum/count of every value of an IngestPlan over fixed time windows.
+
+    Memory use is four numbers per value no matter how many lines arrive in a window. The
+    aggregates of the last complete window are exported by AggregationCollector, which rolls
+    the window from the scrape thread, so rolling and updating are done with the lock held.
+    """
+
+    __slots__ = (
+        "window",
+        "window_end",
+        "mins",
+        "maxs",
+        "sums",
+        "counts",
+        "published",
+        "lock",
+    )
+
+    def __init__(self, size: int, window: float) -> None:
+        """Start the first window now."""
+        self.lock = threading.Lock()
+        self.window = window
+        self.window_end = time.monotonic() + window
+        self.reset(size)
+        # the (mins, maxs, sums, counts) of the last complete window
+        self.published: typing.Optional[
+            typing.Tuple[
+                "array.array[float]",
+                "array.array[float]",
+                "array.array[float]",
+                "array.array[float]",
+            ]
+        ] = None
+
+    def reset(self, size: int) -> None:
+        """Start over with empty aggregates."""
+        self.mins = array.array("d", [math.inf]) * size
+        self.maxs = array.array("d", [-math.inf]) * size
+        self.sums = array.array("d", [0.0]) * size
+        self.counts = array.array("d", [0.0]) * size
+
+    def roll(self) -> None:
+        """Publish the current window and start a new one if the current window has ended."""
+        with self.lock:
+            self.advance()
+
+    def advance(self) -> None:
+        """Like roll(), called with the lock held."""
+        now = time.monotonic()
+        if now < self.window_end:
+            return
+        if self.counts and self.counts[0]:
+            self.published = (self.mins, self.maxs, self.sums, self.counts)
+        else:
+            # no lines in the window
+            self.published = None
+        self.reset(len(self.counts))
+        # windows are aligned to the start of the first one
+        self.window_end += self.window * ((now - self.window_end) // self.window + 1)
+
+    def update(self, values: typing.Sequence[float]) -> None:
+        """Add the values of one line to the aggregates."""
+        with self.lock:
+            self.advance()
+            mins, maxs, sums, counts = self.mins, self.maxs, self.sums, self.counts
+            for index, value in enumerate(values):
+                if value < mins[index]:
+                    mins[index] = value
+                if value > maxs[index]:
+                    maxs[index] = value
+                sums[index] += value
+                counts[index] += 1
+
+    def update_many(self, matrix: typing.Any) -> None:
+        """Add the values of a numpy matrix with one row per line to the aggregates."""
+        with self.lock:
+            self.advance()
+            mins = numpy.frombuffer(self.mins)
+            maxs = numpy.frombuffer(self.maxs)
+            numpy.minimum(mins, matrix.min(axis=0), out=mins)
+            numpy.maximum(maxs, matrix.max(axis=0), out=maxs)
+            sums = numpy.frombuffer(self.sums)
+            sums += matrix.sum(axis=0)
+            counts = numpy.frombuffer(self.counts)
+            counts += len(matrix)
+
+
+class LatencyHistogram:
+    """A minimal histogram of durations in seconds, cheap enough to observe every line.
+
+    Unlike a prometheus_client Histogram no lock is taken, this is only updated from the
+    thread reading the serial port. It is exported by SelfCollector.
+    """
+
+    __slots__ = ("counts", "total")
+
+    # upper bounds of the buckets in seconds, the last bucket is +Inf
+    buckets = (
+        0.00001,
+        0.000025,
+        0.00005,
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.1,
+    )
+
+    def __init__(self) -> None:
+        """Start out with empty buckets."""
+        self.counts = array.array("d", [0.0]) * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Add a duration to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+
+    def add_to(
+        self,
+        family: prometheus_client.core.HistogramMetricFamily,
+        labelvalues: typing.List[str],
+    ) -> None:
+        """Add the cumulative buckets and the sum to a metric family."""
+        cumulative = list(itertools.accumulate(self.counts))
+        family.add_metric(
+            labelvalues,
+            [
+                (prometheus_client.utils.floatToGoString(bound), count)
+                for bound, count in zip(self.buckets + (math.inf,), cumulative)
+            ],
+            self.total,
+        )
+
+
+class SelfCollector:
+    """Export metrics about the exporter itself for all devices.
+
+    The counters are plain numbers on each device and the serial backlog and sample age are
+    only computed here, so nothing but an increment is added to the hot path.
+    """
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Remember the exporter owning the devices to collect from."""
+        self.exporter = exporter
+
+    def collect(self) -> typing.Iterator[prometheus_client.core.Metric]:
+        """Yield the self-instrumentation metric families."""
+        core = prometheus_client.core
+        lines_read = core.CounterMetricFamily(
+            "qwiic_lines_read",
+            "The number of non-empty lines read from the serial port",
+            labels=["device"],
+        )
+        lines_rejected = core.CounterMetricFamily(
+            "qwiic_lines_rejected",
+            "The number of data lines skipped because of non-numeric readings",
+            labels=["device"],
+        )
+        decode_errors = core.CounterMetricFamily(
+            "qwiic_decode_errors",
+            "The number of header lines skipped because they could not be decoded",
+            labels=["device"],
+        )
+        header_requests = core.CounterMetricFamily(
+            "qwiic_header_requests",
+            "The number of times the header line was requested, because of startup, reboots or data lines out of sync",
+            labels=["device"],
+        )
+        noise_lines = core.CounterMetricFamily(
+            "qwiic_noise_lines",
+            "The number of data lines skipped as noise because they did not have the expected number of readings",
+            labels=["device"],
+        )
+        series_evicted = core.CounterMetricFamily(
+            "qwiic_series_evicted",
+            "The number of series removed because they were no longer in the sensor config",
+            labels=["device"],
+        )
+        ingest_latency = core.HistogramMetricFamily(
+            "qwiic_ingest_duration_seconds",
+            "The time it takes to parse a data line and update the metrics",
+            labels=["device"],
+        )
+        backlog = core.GaugeMetricFamily(
+            "qwiic_serial_backlog_bytes",
+            "The number of bytes waiting to be read from the serial port",
+            labels=["device"],
+        )
+        overlong_lines = core.CounterMetricFamily(
+            "qwiic_overlong_lines",
+            "The number of lines discarded because they did not fit in the line buffer",
+            labels=["device"],
+        )
+        clock_drift = core.GaugeMetricFamily(
+            "qwiic_device_clock_drift_seconds",
+            "The difference between the device clock and the host clock when the newest data line was ingested",
+            labels=["device"],
+        )
+        lines_dropped = core.CounterMetricFamily(
+            "qwiic_lines_dropped",
+            "The number of data lines skipped when catching up with a backlog on the serial port",
+            labels=["device"],
+        )
+        lines_lagging = core.GaugeMetricFamily(
+            "qwiic_lines_lagging",
+            "The number of lines in the last backlog caught up with",
+            labels=["device"],
+        )
+        sample_age = core.GaugeMetricFamily(
+            "qwiic_newest_sample_age_seconds",
+            "The number of seconds since the newest data line was ingested",
+            labels=["device"],
+        )
+        now = time.monotonic()
+        shards = self.exporter.shards
+        for index, device in enumerate(self.exporter.devices):
+            if shards:
+                # the device is ingested by a worker process
+                shards[index].load_stats(device)
+            labelvalues = [device.device or ""]
+            lines_read.add_metric(labelvalues, device.lines_read)
+            lines_rejected.add_metric(labelvalues, device.rejected_lines)
+            decode_errors.add_metric(labelvalues, device.decode_errors)
+            header_requests.add_metric(labelvalues, device.header_requests)
+            noise_lines.add_metric(labelvalues, device.noise_lines)
+            series_evicted.add_metric(labelvalues, device.series_evicted)
+            overlong_lines.add_metric(labelvalues, device.framer.overflows)
+            lines_dropped.add_metric(labelvalues, device.lines_dropped)
+            lines_lagging.add_metric(labelvalues, device.lines_lagging)
+            device.ingest_latency.add_to(ingest_latency, labelvalues)
+            try:
+                backlog.add_metric(labelvalues, device.serial.in_waiting)
+            except (AttributeError, OSError, serial.SerialException):
+                # serial port not open (yet)
+                pass
+            if device.last_ingest is not None:
+                sample_age.add_metric(labelvalues, now - device.last_ingest)
+            if device.clock and device.clock.drift is not None:
+                clock_drift.add_metric(labelvalues, device.clock.drift)
+        yield from (lines_read, lines_rejected, decode_errors, header_requests)
+        yield from (noise_lines, series_evicted)
+        yield ingest_latency
+        yield from (overlong_lines, lines_dropped, lines_lagging, backlog, sample_age)
+        if self.exporter.device_time:
+            yield clock_drift
+
+        textfile_latency = core.HistogramMetricFamily(
+            "qwiic_textfile_write_duration_seconds",
+            "The time it takes to write the textfile collector file",
+        )
+        self.exporter.textfile_latency.add_to(textfile_latency, [])
+        yield textfile_latency
+
+        sink = self.exporter.sink
+        if sink:
+            yield core.CounterMetricFamily(
+                "qwiic_push_samples",
+                "The number of samples delivered to the push URL",
+                value=sink.samples_sent,
+            )
+            yield core.CounterMetricFamily(
+                "qwiic_push_errors",
+                "The number of failed attempts to push a batch",
+                value=sink.send_errors,
+            )
+            yield core.CounterMetricFamily(
+                "qwiic_push_batches_dropped",
+                "The number of batches dropped because the push queue was full, they could not be encoded or the receiver rejected them",
+                value=sink.batches_dropped,
+            )
+            yield core.CounterMetricFamily(
+                "qwiic_push_samples_rejected",
+                "The number of samples not pushed because their timestamp was negative or not finite",
+                value=sink.samples_rejected,
+            )
+            yield core.GaugeMetricFamily(
+                "qwiic_push_queue_batches",
+                "The number of batches waiting to be pushed",
+                value=len(sink.queue),
+            )
+
+
+class FlatPlan(IngestPlan):
+    """An IngestPlan which keeps the values in one array instead of setting child gauges.
+
+    Setting a child gauge takes its lock, so with many metrics most of the time of an ingest
+    goes to gauges. Here a line is packed straight into a preallocated array and FlatCollector
+    builds the samples at collect time instead.
+    """
+
+    __slots__ = ("array", "packer")
+
+    def __init__(
+        self,
+        metricindex: typing.List[typing.Tuple[str, int, str, str, float, str]],
+        device: typing.Optional[str] = None,
+    ) -> None:
+        """Compile the (sensorname, sensorindex, subsensorname, metricname, multiplier, description) of each metric, in header order."""
+        extralabels = {"device": device} if device else {}
+        self.children = []
+        self.multipliers = array.array("d", [metric[4] for metric in metricindex])
+        self.metricnames = [metric[3] for metric in metricindex]
+        self.descriptions = [metric[5] for metric in metricindex]
+        self.labelsets = [
+            dict(
+                sensor=metric[0],
+                sensorindex=str(metric[1]),
+                subsensor=metric[2],
+                **extralabels,
+            )
+            for metric in metricindex
+        ]
+        # gauges start out at 0 too
+        self.array = array.array("d", bytes(8 * len(metricindex)))
+        self.values = self.array
+        self.packer = struct.Struct(f"{len(metricindex)}d")
+
+    def __len__(self) -> int:
+        """Return the number of values a data line must have."""
+        return len(self.multipliers)
+
+    def apply(self, values: typing.Sequence[float]) -> None:
+        """Copy the values into the value array, without allocating an array for them."""
+        self.packer.pack_into(self.array, 0, *values)
+
+
+def dew_point(temperature: float, humidity: float) -> float:
+    """Return the dew point in degrees celcius, with the Magnus formula."""
+    gamma = math.log(humidity / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+def absolute_humidity(temperature: float, humidity: float) -> float:
+    """Return the absolute humidity in grams of water vapour per cubic meter of air."""
+    vapour_pressure = (
+        6.112 * math.exp(17.67 * temperature / (243.5 + temperature)) * humidity
+    )
+    return vapour_pressure * 2.1674 / (273.15 + temperature)
+
+
+def sea_level_pressure(
+    pressure: float, temperature: float, elevation: float = 0.0
+) -> float:
+    """Return the pressure reduced to sea level, with the hypsometric formula.
+
+    Args:
+        pressure: The pressure at the sensor
+        temperature: The temperature at the sensor in degrees celcius
+        elevation: The elevation of the sensor above sea level in meters
+    """
+    return pressure * math.pow(
+        1 - 0.0065 * elevation / (temperature + 0.0065 * elevation + 273.15), -5.257
+    )
+
+
+def magnitude(*components: float) -> float:
+    """Return the length of the vector with the components, like the acceleration of all three axes."""
+    return math.sqrt(sum(component * component for component in components))
+
+
+# the functions derived metrics can be computed with, by the name used in the definitions
+derivations: typing.Dict[str, typing.Callable[..., float]] = {
+    "dew_point": dew_point,
+    "absolute_humidity": absolute_humidity,
+    "sea_level_pressure": sea_level_pressure,
+    "magnitude": magnitude,
+}
+
+
+def load_derived_metrics(
+    path: typing.Optional[str] = None,
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Load and check the definitions of derived metrics from a JSON file.
+
+    The file is a JSON object of metric names, each an object with the help text, the subsensor
+    label, the name of the function in derivations, the names of the sensor metrics passed to it
+    as inputs and optionally extra keyword parameters. A derived metric is computed for every
+    sensor with all the inputs.
+
+    Args:
+        path: The path of the definitions, defaults to derived.json next to this module
+
+    Returns: The definitions by metric name
+    """
+    path = path or os.path.join(os.path.dirname(__file__), "derived.json")
+    with open(path) as f:
+        definitions: typing.Dict[str, typing.Dict[str, typing.Any]] = json.load(f)
+    for name, definition in definitions.items():
+        for key in ("help", "subsensor", "function", "inputs"):
+            if key not in definition:
+                raise ValueError(f"Derived metric {name} in {path} has no {key}")
+        if definition["function"] not in derivations:
+            raise ValueError(
+                f"Derived metric {name} in {path} has unknown function {definition['function']}, use one of {', '.join(derivations)}"
+            )
+    logger.debug(f"Loaded {len(definitions)} derived metrics from {path}")
+    return definitions
+
+
+class DerivedPlan:
+    """The derived metrics of a sensor config, compiled into their functions and input positions.
+
+    The values are computed from the values of each line right after they are applied, and
+    exported by the plan of the derived metrics like any other sensor metric.
+    """
+
+    __slots__ = ("plan", "functions", "inputs")
+
+    def __init__(
+        self,
+        plan: IngestPlan,
+        functions: typing.List[typing.Callable[..., float]],
+        inputs: typing.List[typing.List[int]],
+    ) -> None:
+        """Remember the plan of the derived metrics, and the function and input positions of each."""
+        self.plan = plan
+        self.functions = functions
+        self.inputs = inputs
+
+    def apply(self, values: typing.Sequence[float]) -> None:
+        """Compute all derived metrics from the values of a line and apply them to the plan."""
+        results = []
+        for function, positions in zip(self.functions, self.inputs):
+            try:
+                results.append(function(*[values[position] for position in positions]))
+            except (ValueError, ZeroDivisionError, OverflowError):
+                # like the dew point at 0% humidity
+                results.append(math.nan)
+        self.plan.apply(results)
+
+
+class FlatCollector:
+    """Export the values of the FlatPlan of every device, the same way their gauges would."""
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Remember the exporter owning the devices to collect from."""
+        self.exporter = exporter
+
+    def families(
+        self,
+    ) -> typing.Dict[
+        str,
+        typing.Tuple[
+            str, typing.List[typing.Tuple[typing.Dict[str, str], FlatPlan, int]]
+        ],
+    ]:
+        """Return the description and the labels, plan and index of each sample by metric name, in the order they were first seen."""
+        families: typing.Dict[
+            str,
+            typing.Tuple[
+                str, typing.List[typing.Tuple[typing.Dict[str, str], FlatPlan, int]]
+            ],
+        ] = {}
+        plans = [plan for device in self.exporter.devices for plan in device.plans()]
+        for plan in plans:
+            if not isinstance(plan, FlatPlan):
+                continue
+            for index, (name, description, labels) in enumerate(
+                zip(plan.metricnames, plan.descriptions, plan.labelsets)
+            ):
+                families.setdefault(name, (description, []))[1].append(
+                    (labels, plan, index)
+                )
+        return families
+
+    def collect(self) -> typing.Iterator[prometheus_client.core.Metric]:
+        """Yield a gauge family for each metric name in the plans, in the order they were first seen."""
+        for name, (description, samples) in self.families().items():
+            family = prometheus_client.core.GaugeMetricFamily(
+                name, description, labels=list(samples[0][0])
+            )
+            for labels, plan, index in samples:
+                family.add_metric(list(labels.values()), plan.array[index])
+            yield family
+
+
+class Shard:
+    """The current values of the device of a worker process, in memory shared with the front-end.
+
+    The shared array holds a sequence number, the generation, the layout number and the values of
+    the device. The worker makes the sequence number odd while it writes, and the front-end retries
+    reads which overlap a write, so no lock is shared between the processes. A worker which dies
+    in the middle of a write leaves the sequence number odd, so the retries are bounded and the
+    front-end falls back to the last consistent read until the worker is restarted, when the
+    shard is reset. A layout is the metric name, description and labels of each value, it is
+    sent over a pipe once per distinct header line.
+
+    The counters of the worker device which SelfCollector exports are published in a second
+    array after every read. Each counter is a single double, so they are written without the
+    sequence number.
+    """
+
+    # the highest number of values of a device
+    width = 256
+    # the counters of a device published for SelfCollector, followed by the clock drift and the ingest latency
+    counters = (
+        "lines_read",
+        "rejected_lines",
+        "decode_errors",
+        "header_requests",
+        "noise_lines",
+        "series_evicted",
+        "lines_dropped",
+        "lines_lagging",
+        "last_ingest",
+    )
+    # the number of times a read which overlaps a write is retried
+    retries = 1000
+
+    def __init__(self, context: multiprocessing.context.BaseContext) -> None:
+        """Allocate the shared memory and the layout pipe, before the worker is forked."""
+        self.array = context.RawArray("d", 3 + self.width)
+        self.stats = context.RawArray(
+            "d", len(self.counters) + 3 + len(LatencyHistogram.buckets) + 1
+        )
+        self.layouts = context.SimpleQueue()
+        # in the worker: the number of each layout by its contents, so a header line sent again
+        # after a reboot gets the number it had before, and the plans published last with their
+        # ids and layout number, the plans kept so their ids are not reused
+        self.layoutnumbers: typing.Dict[str, int] = {}
+        self.plans: typing.List[IngestPlan] = []
+        self.planids: typing.Tuple[int, ...] = ()
+        self.number = -1
+        # in the front-end: the layouts received from the worker
+        self.received: typing.Dict[
+            int, typing.List[typing.Tuple[str, str, typing.Dict[str, str]]]
+        ] = {}
+        self.last: typing.Optional[
+            typing.Tuple[
+                typing.List[typing.Tuple[str, str, typing.Dict[str, str]]],
+                typing.List[float],
+            ]
+        ] = None
+
+    def publish(self, generation: int, plans: typing.List["IngestPlan"]) -> None:
+        """Write the values applied last by the plans of a device, called in the worker.
+
+        Nothing is written until every plan has applied a line, so the values of the previous
+        plans are never exported with the layout of the new ones.
+        """
+        if any(len(plan.values) != len(plan) for plan in plans):
+            return
+        planids = tuple(id(plan) for plan in plans)
+        if planids != self.planids:
+            self.plans = list(plans)
+            self.planids = planids
+            self.number = self.layout_number(plans)
+        number = self.number
+        if number < 0:
+            return
+        array = self.array
+        array[0] += 1
+        array[1] = generation
+        array[2] = number
+        start = 3
+        for plan in plans:
+            array[start : start + len(plan.values)] = plan.values
+            start += len(plan.values)
+        array[0] += 1
+
+    def layout_number(self, plans: typing.List["IngestPlan"]) -> int:
+        """Return the number of the layout of the plans, and send the layout to the front-end if it is new.
+
+        Returns: The layout number, or -1 if the values do not fit in the shared memory
+        """
+        layout = [
+            entry
+            for plan in plans
+            for entry in zip(plan.metricnames, plan.descriptions, plan.labelsets)
+        ]
+        key = json.dumps(layout, sort_keys=True)
+        number = self.layoutnumbers.get(key)
+        if number is not None:
+            return number
+        if len(layout) > self.width:
+            logger.error(
+                f"Lines with {len(layout)} values do not fit in the shared memory of {self.width} values, not publishing them"
+            )
+            number = -1
+        else:
+            number = len(self.layoutnumbers)
+            # the layout is sent before the values which refer to it
+            self.layouts.put((number, layout))
+        self.layoutnumbers[key] = number
+        return number
+
+    def publish_stats(self, device: QwiicExporter) -> None:
+        """Write the counters, clock drift and ingest latency of the device, called in the worker."""
+        stats = self.stats
+        for index, name in enumerate(self.counters):
+            value = getattr(device, name)
+            stats[index] = math.nan if value is None else value
+        index = len(self.counters)
+        stats[index] = device.framer.overflows
+        drift = device.clock.drift if device.clock else None
+        stats[index + 1] = math.nan if drift is None else drift
+        stats[index + 2] = device.ingest_latency.total
+        stats[index + 3 :] = device.ingest_latency.counts
+
+    def load_stats(self, device: QwiicExporter) -> None:
+        """Set the counters, clock drift and ingest latency of the front-end device to the ones published, called in the front-end."""
+        stats = self.stats[:]
+        for index, name in enumerate(self.counters):
+            # NaN is None, for the last_ingest of a device which has not ingested anything yet
+            setattr(device, name, None if math.isnan(stats[index]) else stats[index])
+        index = len(self.counters)
+        device.framer.overflows = int(stats[index])
+        if not math.isnan(stats[index + 1]):
+            if device.clock is None:
+                device.clock = DeviceClock()
+            device.clock.drift = stats[index + 1]
+        device.ingest_latency.total = stats[index + 2]
+        device.ingest_latency.counts[:] = array.array("d", stats[index + 3 :])
+
+    def reset(self) -> None:
+        """Forget everything the worker published before it is restarted, called in the front-end.
+
+        The worker must not be running. The restarted worker numbers its layouts from 0 again,
+        so the layouts and values of the dead one are discarded, including an interrupted write,
+        and nothing is exported until the restarted worker publishes.
+        """
+        if self.array[0] % 2:
+            logger.warning("Worker died while publishing, discarding its last values")
+        while not self.layouts.empty():
+            self.layouts.get()
+        self.received = {}
+        self.last = None
+        self.array[0] = 0
+
+    def generation(self) -> int:
+        """Return the generation published last."""
+        return int(self.array[1])
+
+    def read(
+        self,
+    ) -> typing.Optional[
+        typing.Tuple[
+            typing.List[typing.Tuple[str, str, typing.Dict[str, str]]],
+            typing.List[float],
+        ]
+    ]:
+        """Return the layout and the values published last, called in the front-end.
+
+        Returns: A tuple of (layout, values), the last consistent read if the worker kept
+            writing during all retries, or None if nothing has been published yet
+        """
+        while not self.layouts.empty():
+            number, layout = self.layouts.get()
+            self.received[number] = layout
+        array = self.array
+        for _ in range(self.retries):
+            sequence = array[0]
+            if sequence % 2:
+                # the worker is writing
+                time.sleep(0)
+                continue
+            layout = self.received.get(int(array[2]))
+            if sequence == 0 or layout is None:
+                return None
+            values = array[3 : 3 + len(layout)]
+            if array[0] == sequence:
+                self.last = layout, values
+                return self.last
+        logger.warning(
+            "Worker kept writing while reading its shard, using the last values read"
+        )
+        return self.last
+
+
+class ShardCollector:
+    """Export the values the worker processes published in their shards."""
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Remember the exporter owning the shards to collect from."""
+        self.exporter = exporter
+
+    def collect(self) -> typing.Iterator[prometheus_client.core.Metric]:
+        """Yield a gauge family for each metric published by any worker."""
+        families: typing.Dict[str, prometheus_client.core.GaugeMetricFamily] = {}
+        for shard in self.exporter.shards:
+            published = shard.read()
+            if published is None:
+                continue
+            layout, values = published
+            for (name, description, labels), value in zip(layout, values):
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = prometheus_client.core.GaugeMetricFamily(
+                        name, description, labels=list(labels)
+                    )
+                family.add_metric(list(labels.values()), value)
+        yield from families.values()
+
+
+class AggregationCollector:
+    """Export the last complete aggregation window of every device as extra metrics.
+
+    Each metric gets three extra metrics with the suffixes _min, _max and _mean, and the number of
+    lines in the window is exported per device as qwiic_aggregation_window_lines.
+    """
+
+    def __init__(self, exporter: QwiicExporter) -> None:
+        """Remember the exporter owning the devices to collect from."""
+        self.exporter = exporter
+
+    def collect(self) -> typing.Iterator[prometheus_client.core.Metric]:
+        """Yield the min/max/mean metric families for all devices with a published window."""
+        families: typing.Dict[str, prometheus_client.core.GaugeMetricFamily] = {}
+        lines = prometheus_client.core.GaugeMetricFamily(
+            "qwiic_aggregation_window_lines",
+            "The number of lines in the last complete aggregation window",
+            labels=["device"],
+        )
+        for device in self.exporter.devices:
+            aggregator = device.aggregator
+            if aggregator is None:
+                continue
+            # the ingest thread may be in the middle of update()
+            with aggregator.lock:
+                aggregator.advance()
+                published = aggregator.published
+            if published is None:
+                continue
+            mins, maxs, sums, counts = published
+            plan = device.plan
+            lines.add_metric([device.device or ""], counts[0])
+            for index, name in enumerate(plan.metricnames):
+                labels = plan.labelsets[index]
+                for suffix, value in (
+                    ("min", mins[index]),
+                    ("max", maxs[index]),
+                    ("mean", sums[index] / counts[index]),
+                ):
+                    family = families.get(f"{name}_{suffix}")
+                    if family is None:
+                        family = families[
+                            f"{name}_{suffix}"
+                        ] = prometheus_client.core.GaugeMetricFamily(
+                            f"{name}_{suffix}",
+                            f"{plan.descriptions[index]} ({suffix} over the aggregation window)",
+                            labels=list(labels),
+                        )
+                    family.add_metric(list(labels.values()), value)
+        if lines.samples:
+            yield lines
+        yield from families.values()
+
+
+class TextfileFlusher(threading.Thread):
+    """Background thread which writes the textfile collector file on a schedule.
+
+    The file is written at most once every min_interval seconds, and only if ingest_data()
+    has changed the metric values since the last write. If nothing changes the file is still
+    rewritten after max_staleness seconds so the mtime stays fresh for node_exporter.
+    """
+
+    def __init__(
+        self, exporter: QwiicExporter, min_interval: float, max_staleness: float
+    ) -> None:
+        """Save the schedule and register the flusher metrics in the exporter registry, once per exporter."""
+        super().__init__(name="textfile-flusher", daemon=True)
+        self.exporter = exporter
+        self.min_interval = min_interval
+        self.max_staleness = max(max_staleness, min_interval)
+        self.stopped = threading.Event()
+        self.flushed_generation = exporter.total_generation()
+        # the first flush is always due
+        self.last_flush = float("-inf")
+        if exporter.textfile_writes is None:
+            # the flusher of a later replay() or disco() counts on
+            exporter.textfile_writes = (
+                prometheus_client.Counter(
+                    "qwiic_textfile_writes",
+                    "The number of times the textfile collector file has been written.",
+                    registry=exporter.registry,
+                ),
+                prometheus_client.Counter(
+                    "qwiic_textfile_writes_saved",
+                    "The number of textfile writes saved by coalescing ingested lines.",
+                    registry=exporter.registry,
+                ),
+            )
+        self.writes, self.writes_saved = exporter.textfile_writes
+
+    def run(self) -> None:
+        """Flush whenever the schedule says so until stop() is called."""
+        while not self.stopped.is_set():
+            self.flush_if_due()
+            # polling at min_interval keeps the ingest path free of any signalling
+            self.stopped.wait(timeout=self.min_interval)
+
+    def flush_if_due(self) -> bool:
+        """Write the textfile if values changed and min_interval has passed, or if it is stale.
+
+        Returns: True if the file was written, False if not
+        """
+        age = time.monotonic() - self.last_flush
+        if self.exporter.total_generation() != self.flushed_generation:
+            if age < self.min_interval:
+                return False
+        elif age < self.max_staleness:
+            return False
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        """Write the textfile and update the counters."""
+        generation = self.exporter.total_generation()
+        # every ingested line would have caused a write before, so all but one are saved
+        saved = generation - self.flushed_generation - 1
+        if saved > 0:
+            self.writes_saved.inc(saved)
+        self.writes.inc()
+        self.exporter.write_textfile_collector_file()
+        self.flushed_generation = generation
+        self.last_flush = time.monotonic()
+        logger.debug(
+            f"Wrote textfile at generation {generation}, saved {saved if saved > 0 else 0} writes"
+        )
+
+    def stop(self) -> None:
+        """Stop the thread and write any pending changes to the textfile."""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        if self.exporter.total_generation() != self.flushed_generation:
+            self.flush()
+
+
+# a batch of readings to push, tuples of (plan, timestamp, values)
+PushBatch = typing.List[typing.Tuple["IngestPlan", float, typing.Sequence[float]]]
+
+
+class PushSink(threading.Thread):
+    """Background thread which pushes every reading to Prometheus remote-write or a Pushgateway.
+
+    Readings are buffered with their timestamps and sent in a batch when batch_size samples are
+    buffered or the oldest has waited flush_interval seconds, over one persistent HTTP connection.
+    Batches which fail to send are kept in a queue of at most queue_size batches and retried,
+    oldest first, on the next flush. The oldest batch is dropped when the queue is full.
+
+    Remote-write keeps every sample and its timestamp. A Pushgateway only keeps the current value
+    of each series and rejects timestamps, so only the newest value in each batch is pushed there.
+    """
+
+    formats = ["remote-write", "pushgateway"]
+
+    def __init__(
+        self,
+        url: str,
+        format: str = "remote-write",
+        batch_size: int = 5000,
+        flush_interval: float = 10.0,
+        queue_size: int = 100,
+        timeout: float = 10.0,
+    ) -> None:
+        """Save the settings, nothing is sent until the thread is started."""
+        super().__init__(name="push-sink", daemon=True)
+        assert format in self.formats
+        self.url = urllib.parse.urlsplit(url)
+        self.format = format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # readings not sent yet, and the number of samples in them
+        self.buffer: PushBatch = []
+        self.buffered = 0
+        self.first_buffered: typing.Optional[float] = None
+        # encoded batches waiting to be sent, oldest first
+        self.queue: typing.Deque[typing.Tuple[bytes, int]] = collections.deque()
+        self.queue_size = queue_size
+        self.connection: typing.Optional[http.client.HTTPConnection] = None
+        self.samples_sent = 0
+        self.batches_sent = 0
+        self.send_errors = 0
+        self.batches_dropped = 0
+        self.samples_rejected = 0
+
+    def add(
+        self, plan: "IngestPlan", timestamp: float, values: typing.Sequence[float]
+    ) -> None:
+        """Buffer the values of a line, and wake up the thread if a batch is full.
+
+        Lines with a negative or non-finite timestamp, like from a device clock which is way off,
+        can not be encoded and are rejected here instead of failing the whole batch.
+        """
+        if not 0 <= timestamp < math.inf:
+            self.samples_rejected += len(values)
+            logger.debug(f"Not pushing readings with timestamp {timestamp}")
+            return
+        with self.lock:
+            self.buffer.append((plan, timestamp, values))
+            self.buffered += len(values)
+            if self.first_buffered is None:
+                self.first_buffered = time.monotonic()
+            full = self.buffered >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def run(self) -> None:
+        """Flush whenever a batch is full or due until stop() is called."""
+        while not self.stopped.is_set():
+            first = self.first_buffered
+            timeout = self.flush_interval
+            if first is not None:
+                timeout = max(0.0, first + self.flush_interval - time.monotonic())
+            self.wakeup.wait(timeout=timeout)
+            self.wakeup.clear()
+            self.flush_if_due()
+
+    def flush_if_due(self) -> bool:
+        """Send the buffered readings if a batch is full or the oldest reading has waited flush_interval.
+
+        Failed batches are retried every flush_interval even if nothing new is buffered.
+
+        Returns: True if a batch was sent or retried, False if not
+        """
+        first = self.first_buffered
+        if self.buffered < self.batch_size and (
+            first is None or time.monotonic() - first < self.flush_interval
+        ):
+            if not self.queue:
+                return False
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        """Encode the buffered readings as a batch, and send all queued batches."""
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+            samples, self.buffered = self.buffered, 0
+            self.first_buffered = None
+        if batch:
+            try:
+                payload = self.encode(batch)
+            except (ValueError, OverflowError) as e:
+                # a batch which can not be encoded now never can, and must not stop the thread
+                logger.error(f"Unable to encode push batch, dropping it: {e!r}")
+                self.batches_dropped += 1
+                batch = []
+        if batch:
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.batches_dropped += 1
+                logger.warning("Push queue is full, dropping the oldest batch")
+            self.queue.append((payload, samples))
+        while self.queue:
+            payload, samples = self.queue[0]
+            if not self.send(payload):
+                # try again on the next flush
+                return
+            self.queue.popleft()
+            self.samples_sent += samples
+
+    def encode(self, batch: PushBatch) -> bytes:
+        """Encode a batch in the format of the sink."""
+        if self.format == "pushgateway":
+            return self.encode_pushgateway(batch)
+        return self.encode_remote_write(batch)
+
+    @staticmethod
+    def varint(number: int) -> bytes:
+        """Encode a non-negative integer as a protobuf varint."""
+        encoded = bytearray()
+        while number > 0x7F:
+            encoded.append(number & 0x7F | 0x80)
+            number >>= 7
+        encoded.append(number)
+        return bytes(encoded)
+
+    @classmethod
+    def field(cls, number: int, data: bytes) -> bytes:
+        """Encode a length-delimited protobuf field."""
+        return cls.varint(number << 3 | 2) + cls.varint(len(data)) + data
+
+    @classmethod
+    def snappy_block(cls, data: bytes) -> bytes:
+        """Compress data in the snappy block format, with python-snappy if it is installed.
+
+        Without python-snappy the data is encoded as literals only, which any snappy decoder
+        accepts, so nothing is compressed but nothing needs to be installed either.
+        """
+        if snappy is not None:
+            return typing.cast(bytes, snappy.compress(data))
+        encoded = bytearray(cls.varint(len(data)))
+        for start in range(0, len(data), 65536):
+            chunk = data[start : start + 65536]
+            length = len(chunk) - 1
+            if length < 60:
+                encoded.append(length << 2)
+            elif length < 256:
+                encoded += bytes([60 << 2, length])
+            else:
+                encoded += bytes([61 << 2]) + length.to_bytes(2, "little")
+            encoded += chunk
+        return bytes(encoded)
+
+    @classmethod
+    def encode_remote_write(cls, batch: PushBatch) -> bytes:
+        """Encode a batch as a snappy compressed remote-write WriteRequest protobuf.
+
+        The protobuf is small enough to encode by hand. A WriteRequest has a TimeSeries for each
+        series with its Labels sorted by name, and a Sample with the value and the timestamp in
+        milliseconds for every reading of the series.
+        """
+        # encoded labels of each series: encoded samples of the series
+        series: typing.Dict[bytes, bytearray] = {}
+        # the encoded labels of each value of a plan, encoded once per plan
+        encodedlabels: typing.Dict[int, typing.List[bytes]] = {}
+        for plan, timestamp, values in batch:
+            labels = encodedlabels.get(id(plan))
+            if labels is None:
+                labels = encodedlabels[id(plan)] = [
+                    b"".join(
+                        cls.field(
+                            1,
+                            cls.field(1, key.encode()) + cls.field(2, value.encode()),
+                        )
+                        for key, value in sorted({"__name__": name, **labelset}.items())
+                    )
+                    for name, labelset in zip(plan.metricnames, plan.labelsets)
+                ]
+            milliseconds = cls.varint(int(timestamp * 1000))
+            for label, value in zip(labels, values):
+                samples = series.get(label)
+                if samples is None:
+                    samples = series[label] = bytearray()
+                # Sample: value as field 1 (64 bit), timestamp as field 2 (varint)
+                samples += cls.field(
+                    2, b"\x09" + struct.pack("<d", value) + b"\x10" + milliseconds
+                )
+        request = b"".join(
+            cls.field(1, label + samples) for label, samples in series.items()
+        )
+        return cls.snappy_block(request)
+
+    @staticmethod
+    def encode_pushgateway(batch: PushBatch) -> bytes:
+        """Encode the newest value of each series in a batch in the text exposition format."""
+        # metric name: (description, {label string: value}), in order of appearance
+        families: typing.Dict[str, typing.Tuple[str, typing.Dict[str, float]]] = {}
+        for plan, _, values in batch:
+            for name, description, labels, value in zip(
+                plan.metricnames, plan.descriptions, plan.labelsets, values
+            ):
+                families.setdefault(name, (description, {}))[1][
+                    format_labels(labels)
+                ] = value
+        lines = []
+        for name, (description, series) in families.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for labelstring, value in series.items():
+                lines.append(
+                    f"{name}{{{labelstring}}} {prometheus_client.utils.floatToGoString(value)}"
+                )
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def send(self, payload: bytes) -> bool:
+        """POST an encoded batch over the persistent connection, reconnecting if needed.
+
+        Returns: True if the batch was delivered or rejected for good, False if it should be retried
+        """
+        if self.format == "pushgateway":
+            headers = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        else:
+            headers = {
+                "Content-Type": "application/x-protobuf",
+                "Content-Encoding": "snappy",
+                "X-Prometheus-Remote-Write-Version": "0.1.0",
+            }
+        path = self.url.path or "/"
+        if self.url.query:
+            path += f"?{self.url.query}"
+        try:
+            if self.connection is None:
+                connectionclass = (
+                    http.client.HTTPSConnection
+                    if self.url.scheme == "https"
+                    else http.client.HTTPConnection
+                )
+                self.connection = connectionclass(self.url.netloc, timeout=self.timeout)
+            self.connection.request("POST", path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning(f"Unable to push to {self.url.geturl()}, will retry: {e!r}")
+            self.send_errors += 1
+            self.close()
+            return False
+        if response.status < 300:
+            self.batches_sent += 1
+            return True
+        self.send_errors += 1
+        if response.status == 429 or response.status >= 500:
+            logger.warning(
+                f"Push to {self.url.geturl()} failed with status {response.status}, will retry"
+            )
+            return False
+        # retrying a batch the receiver does not like will not help
+        logger.error(
+            f"Push to {self.url.geturl()} rejected with status {response.status}, dropping the batch: {body[:200]!r}"
+        )
+        self.batches_dropped += 1
+        return True
+
+    def close(self) -> None:
+        """Close the connection, the next send() opens a new one."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def stop(self) -> None:
+        """Stop the thread and try to send everything buffered and queued."""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self.close()
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Create and return the argparse object.
+
+    Args: None
+    Returns: The argparse object
+    """
+    parser = argparse.ArgumentParser(
+        description=f"qwiic_exporter version {__version__}. Exports metrics from SparkFun OpenLog Artemis sensors to Prometheus node_exporter textfile collector path, and/or serves them over HTTP."
+    )
+
+    parser.add_argument(
+        "SERIALPORT",
+        type=str,
+        help="The path to the serial port where the SparkFun OpenLog Artemis is connected.",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--serial-port",
+        dest="serialports",
+        metavar="SERIALPORT",
+        action="append",
+        help="The path to the serial port of another SparkFun OpenLog Artemis to monitor from this process. Can be specified multiple times. All sensor metrics get a device label with the serial port when more than one device is monitored.",
+        default=[],
+    )
+
+    parser.add_argument(
+        "PROMPATH",
+        type=str,
+        nargs="?",
+        help="The path to the Prometheus node_exporter textfile collector file to write output to. Remember the .prom suffix. Can be omitted when --listen is used.",
+    )
+
+    parser.add_argument(
+        "-L",
+        "--listen",
+        dest="listen",
+        metavar="[ADDRESS]:PORT",
+        type=str,
+        help="Serve metrics over HTTP on this address and port, for example :9999, 127.0.0.1:9999 or [::]:9999. The rendered metrics are cached between changes.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--flush-interval",
+        dest="flushinterval",
+        metavar="SECONDS",
+        type=float,
+        help="Minimum number of seconds between two writes of the textfile collector file. Changes are coalesced and written from a background thread. Set to 0 to write the file after every line from the serial port. Defaults to 1.",
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "-m",
+        "--max-staleness",
+        dest="maxstaleness",
+        metavar="SECONDS",
+        type=float,
+        help="Maximum number of seconds the textfile collector file can go without being rewritten, even if no values changed. Defaults to 60.",
+        default=60.0,
+    )
+
+    parser.add_argument(
+        "-A",
+        "--aggregation-window",
+        dest="aggregationwindow",
+        metavar="SECONDS",
+        type=float,
+        help="Aggregate all readings over windows of this many seconds, and export the min, max and mean of each metric over the last complete window as extra metrics with _min, _max and _mean suffixes. Defaults to 0 which disables aggregation.",
+        default=0,
+    )
+
+    parser.add_argument(
+        "-D",
+        "--drain-threshold",
+        dest="drainthreshold",
+        metavar="BYTES",
+        type=int,
+        help="When more than this many bytes are waiting on the serial port, read them all in one go and only ingest the newest data line, or all of them when aggregating. Defaults to 4096. Set to 0 to always handle every line.",
+        default=4096,
+    )
+
+    parser.add_argument(
+        "--header-interval",
+        dest="headerinterval",
+        metavar="SECONDS",
+        type=float,
+        help="The minimum number of seconds between asking for the header line again because data lines are out of sync. Defaults to 10.",
+        default=10.0,
+    )
+
+    parser.add_argument(
+        "--resync-threshold",
+        dest="resyncthreshold",
+        metavar="LINES",
+        type=int,
+        help="The number of data lines in a row with an unexpected number of readings before the sensor config is considered changed, fewer are skipped as noise. A cached sensor config with the new number of readings is used until the header line arrives. Defaults to 3.",
+        default=3,
+    )
+
+    parser.add_argument(
+        "--series-ttl",
+        dest="seriesttl",
+        metavar="SECONDS",
+        type=float,
+        help="The number of seconds metrics of sensors which are no longer in the header line keep being exported with their last value. Defaults to 0, which removes them as soon as the header line changes.",
+        default=0,
+    )
+
+    parser.add_argument(
+        "--max-series",
+        dest="maxseries",
+        metavar="N",
+        type=int,
+        help="The most sensor metric series to export for all devices together. When the header line changes and there are more, metrics of sensors which are no longer in the header line are removed regardless of --series-ttl, oldest first. Defaults to 10000. Set to 0 for no limit.",
+        default=10000,
+    )
+
+    parser.add_argument(
+        "-c",
+        "--header-cache",
+        dest="headercache",
+        metavar="PATH",
+        type=str,
+        help="Path of a file to cache parsed header lines in. After a restart, data lines matching a cached header line are ingested before the header line arrives.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--sensor-catalogue",
+        dest="sensorcatalogue",
+        metavar="PATH",
+        type=str,
+        help="Path of a JSON file with the sensors, subsensors and metrics to recognise in header lines. Defaults to the catalogue of the sensors supported by the OpenLog Artemis shipped with qwiic_exporter.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--sensor-index",
+        dest="sensorindex",
+        metavar="PATH",
+        type=str,
+        help="Path of a file to save the compiled sensor catalogue in, so it is not compiled again on the next run unless the catalogue changes.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-a",
+        "--asyncio",
+        dest="useasyncio",
+        action="store_true",
+        help="Read the serial ports from an asyncio event loop instead of blocking reads.",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--replay",
+        dest="replay",
+        action="store_true",
+        help="Treat SERIALPORT as a file with recorded serial output and replay it as fast as possible, then print throughput and latency statistics and exit.",
+    )
+
+    parser.add_argument(
+        "-R",
+        "--ring",
+        dest="ring",
+        metavar="PATH",
+        type=str,
+        help="Record every reading with its timestamp in a ring buffer file at this path, so readings missed by Prometheus can be backfilled later with --export-ring.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--ring-size",
+        dest="ringsize",
+        metavar="RECORDS",
+        type=int,
+        help="The number of data lines the ring buffer holds before the oldest are overwritten. Changing it starts the ring buffer over. Each line takes 16 bytes plus 8 bytes per reading of the widest line recorded, so the default of 100000 lines takes 17.6 MB for lines of 20 readings. Defaults to 100000.",
+        default=100000,
+    )
+
+    parser.add_argument(
+        "--export-ring",
+        dest="exportring",
+        metavar="[START]:[END]",
+        type=str,
+        help="Treat SERIALPORT as a ring buffer file and write the readings from START up to END, in seconds since the epoch, to stdout as OpenMetrics for promtool tsdb create-blocks-from openmetrics, then exit. Leave out START or END for the oldest or newest readings.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-P",
+        "--push-url",
+        dest="pushurl",
+        metavar="URL",
+        type=str,
+        help="Push every reading with its timestamp to this URL, like http://prometheus:9090/api/v1/write for remote-write or http://pushgateway:9091/metrics/job/qwiic_exporter for a Pushgateway.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--push-format",
+        dest="pushformat",
+        choices=PushSink.formats,
+        help="Push with the Prometheus remote-write protocol, which keeps every reading, or to a Pushgateway, which only keeps the newest reading of each batch. Defaults to remote-write.",
+        default="remote-write",
+    )
+
+    parser.add_argument(
+        "--push-interval",
+        dest="pushinterval",
+        metavar="SECONDS",
+        type=float,
+        help="Maximum number of seconds a reading waits before it is pushed. Defaults to 10.",
+        default=10.0,
+    )
+
+    parser.add_argument(
+        "--push-batch-size",
+        dest="pushbatchsize",
+        metavar="SAMPLES",
+        type=int,
+        help="Push as soon as this many samples are waiting. Defaults to 5000.",
+        default=5000,
+    )
+
+    parser.add_argument(
+        "--push-queue-size",
+        dest="pushqueuesize",
+        metavar="BATCHES",
+        type=int,
+        help="The number of batches kept for retrying when pushing fails, the oldest is dropped when there are more. Defaults to 100.",
+        default=100,
+    )
+
+    parser.add_argument(
+        "--derived-metrics",
+        dest="derivedmetrics",
+        metavar="PATH",
+        nargs="?",
+        const="",
+        help="Compute derived metrics like the dew point, absolute humidity, sea level pressure and the magnitude of the acceleration from the readings of each line, and export them with the same labels as the sensor metrics. Optionally the path of a JSON file with the definitions, defaults to the definitions shipped with qwiic_exporter.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--flat-collector",
+        dest="flatcollector",
+        action="store_true",
+        help="Keep the values of all sensor metrics in flat arrays which are only turned into samples when the metrics are collected, instead of in a Gauge per metric. The metrics are the same, but metrics of sensors which are no longer in the header line disappear right away, regardless of --series-ttl.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="useworkers",
+        action="store_true",
+        help="Ingest the lines of each serial port in a worker process of its own, for when one process can not keep up with many devices. The workers publish their values in shared memory, which the main process writes the textfile and serves HTTP from. Can not be combined with --asyncio, --aggregation-window, --ring or --push-url.",
+    )
+
+    parser.add_argument(
+        "-T",
+        "--device-time",
+        dest="devicetime",
+        action="store_true",
+        help="Timestamp readings with the rtcDate and rtcTime of the device, taken to be UTC, instead of the host clock. The timestamps are used in the ring buffer and when pushing, and the drift between the clocks is exported.",
+    )
+
+    parser.add_argument(
+        "--date-format",
+        dest="dateformat",
+        metavar="FORMAT",
+        type=str,
+        help="The strptime format of rtcDate. Defaults to %%m/%%d/%%Y, use %%d/%%m/%%Y if the device is not set to American dates.",
+        default="%m/%d/%Y",
+    )
+
+    parser.add_argument(
+        "--max-drift",
+        dest="maxdrift",
+        metavar="SECONDS",
+        type=float,
+        help="Warn when the device clock is more than this many seconds off the host clock. Defaults to 5.",
+        default=5.0,
+    )
+
+    parser.add_argument(
+        "--trace-memory",
+        dest="tracememory",
+        action="store_true",
+        help="Measure peak memory use with tracemalloc when replaying or profiling, and list the top allocations in the profile. Slows things down.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="PATH",
+        help="Run under cProfile, or replay the capture with --replay, until --profile-lines lines are read or --profile-seconds have passed. The stats are dumped to PATH in the pstats format, and the time spent reading, decoding, parsing header lines, ingesting and writing the textfile to PATH.json.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile-lines",
+        dest="profilelines",
+        metavar="LINES",
+        type=int,
+        help="Stop profiling after this many lines have been read. Defaults to 10000. Set to 0 for no limit.",
+        default=10000,
+    )
+
+    parser.add_argument(
+        "--profile-seconds",
+        dest="profileseconds",
+        metavar="SECONDS",
+        type=float,
+        help="Stop profiling after this many seconds. Defaults to 60. Set to 0 for no limit.",
+        default=60.0,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_const",
+        dest="loglevel",
+        const="DEBUG",
+        help="Debug mode. Equal to setting --log-level=DEBUG.",
+        default=argparse.SUPPRESS,
+    )
+
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        dest="loglevel",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Logging level. One of DEBUG, INFO, WARNING, ERROR, CRITICAL. Defaults to INFO.",
+        default="INFO",
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_const",
+        dest="loglevel",
+        const="WARNING",
+        help="Quiet mode. No output at all if no errors are encountered. Equal to setting --log-level=WARNING.",
+        default=argparse.SUPPRESS,
+    )
+
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        version=f"%(prog)s version {__version__}",
+        help="Show qwiic_exporter version and exit.",
+    )
+
+    return parser
+
+
+def main() -> None:
+    """Get args, initialise QwiicExporter object, and start the loop.
+
+    Args: None
+    Returns: None
+    """
+    # get argparse object and parse args
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.exportring is not None:
+        try:
+            startstring, _, endstring = args.exportring.partition(":")
+            start = float(startstring) if startstring else -math.inf
+            end = float(endstring) if endstring else math.inf
+            ring = ReadingRing.open(args.SERIALPORT)
+        except (OSError, ValueError) as e:
+            parser.error(f"Unable to export ring buffer: {e}")
+        ring.export_openmetrics(sys.stdout, start=start, end=end)
+        ring.close()
+        return
+    if args.useworkers and (
+        args.useasyncio
+        or args.aggregationwindow
+        or args.ring
+        or args.pushurl
+        or args.replay
+        or args.profile
+    ):
+        parser.error(
+            "--workers can not be combined with --asyncio, --aggregation-window, --ring, --push-url, --replay or --profile"
+        )
+    if not args.PROMPATH and not args.listen and not args.replay and not args.pushurl:
+        parser.error(
+            "PROMPATH is required unless --listen, --push-url or --replay is used"
+        )
+
+    # define the log format used for stdout depending on the requested loglevel
+    if args.loglevel == "DEBUG":
+        console_logformat = "%(asctime)s %(levelname)s qwiic_exporter.%(funcName)s():%(lineno)i:  %(message)s"
+    else:
+        console_logformat = "%(asctime)s %(levelname)s qwiic_exporter %(message)s"
 
     # configure the log format used for console
     logging.basicConfig(
@@ -514,12 +4255,161 @@ def main() -> None:
         datefmt="%Y-%m-%d %H:%M:%S %z",
     )
 
-    qwe = QwiicExporter()
+    try:
+        catalogue = SensorCatalogue.load(
+            path=args.sensorcatalogue, indexpath=args.sensorindex
+        )
+    except (OSError, ValueError) as e:
+        parser.error(f"Unable to load sensor catalogue: {e}")
+    qwe = QwiicExporter(catalogue=catalogue)
+    if args.derivedmetrics is not None:
+        try:
+            qwe.derived_metrics = load_derived_metrics(path=args.derivedmetrics or None)
+        except (OSError, ValueError) as e:
+            parser.error(f"Unable to load derived metrics: {e}")
     qwe.serialport = args.SERIALPORT
     qwe.prompath = args.PROMPATH
+    qwe.flush_interval = args.flushinterval
+    qwe.max_staleness = args.maxstaleness
+    qwe.listen = args.listen
+    qwe.use_asyncio = args.useasyncio
+    qwe.use_workers = args.useworkers
+    qwe.use_flat_collector = args.flatcollector
+    qwe.header_cache_path = args.headercache
+    qwe.aggregation_window = args.aggregationwindow
+    qwe.drain_threshold = args.drainthreshold
+    qwe.header_interval = args.headerinterval
+    qwe.resync_threshold = args.resyncthreshold
+    qwe.series_ttl = args.seriesttl
+    qwe.max_series = args.maxseries
+    qwe.ring_path = args.ring
+    qwe.ring_size = args.ringsize
+    qwe.device_time = args.devicetime
+    qwe.date_format = args.dateformat
+    qwe.max_drift = args.maxdrift
+    qwe.push_url = args.pushurl
+    qwe.push_format = args.pushformat
+    qwe.push_interval = args.pushinterval
+    qwe.push_batch_size = args.pushbatchsize
+    qwe.push_queue_size = args.pushqueuesize
+    # after the settings, which the devices take over from qwe
+    for serialport in args.serialports:
+        qwe.add_device(serialport=serialport)
+    if args.profile:
+        profiler = Profiler(
+            exporter=qwe,
+            path=args.profile,
+            lines=args.profilelines,
+            seconds=args.profileseconds,
+            trace_memory=args.tracememory,
+        )
+        target: typing.Callable[[], typing.Any]
+        if args.replay:
+            target = functools.partial(qwe.replay, path=args.SERIALPORT)
+        else:
+            target = qwe.disco
+        print(profiler.report(profiler.run(target)))
+        return
+    if args.replay:
+        print(qwe.replay(path=args.SERIALPORT, trace_memory=args.tracememory).report())
+        return
     qwe.disco()
 
 
+def get_simulator_parser() -> argparse.ArgumentParser:
+    """Create and return the argparse object for the simulator.
+
+    Args: None
+    Returns: The argparse object
+    """
+    parser = argparse.ArgumentParser(
+        description=f"qwiic_simulator version {__version__}. Simulates a SparkFun OpenLog Artemis on a pseudo-terminal for load testing qwiic_exporter."
+    )
+
+    parser.add_argument(
+        "-s",
+        "--sensor",
+        dest="sensors",
+        metavar="SENSOR",
+        action="append",
+        choices=list(SensorCatalogue.load().sensors),
+        help="Name of a sensor to simulate with all its subsensors enabled. Can be specified multiple times, also for the same sensor. Defaults to all known sensors.",
+        default=[],
+    )
+
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        help="The number of data lines per second. Defaults to 10.",
+        default=10.0,
+    )
+
+    parser.add_argument(
+        "--reboot-probability",
+        dest="rebootprobability",
+        type=float,
+        help="The probability of a reboot banner instead of a data line. Defaults to 0.",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--noise-probability",
+        dest="noiseprobability",
+        type=float,
+        help="The probability of random line noise instead of a data line. Defaults to 0.",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--truncate-probability",
+        dest="truncateprobability",
+        type=float,
+        help="The probability of a data line being truncated. Defaults to 0.",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for the random readings and events, for reproducible output.",
+        default=None,
+    )
+
+    return parser
+
+
+def simulator_main() -> None:
+    """Get args, start an OpenLogSimulator, and run it until interrupted.
+
+    Args: None
+    Returns: None
+    """
+    args = get_simulator_parser().parse_args()
+    sensors = SensorCatalogue.load().sensors
+    sensorconfig = [(name, list(sensors[name])) for name in args.sensors or sensors]
+    simulator = OpenLogSimulator(
+        sensorconfig=sensorconfig,
+        rate=args.rate,
+        reboot_probability=args.rebootprobability,
+        noise_probability=args.noiseprobability,
+        truncate_probability=args.truncateprobability,
+        seed=args.seed,
+    )
+    simulator.start()
+    print(f"Simulating an OpenLog Artemis on {simulator.path}", flush=True)
+    try:
+        while True:
+            time.sleep(10)
+            print(
+                f"Written {simulator.written} lines, dropped {simulator.dropped} lines"
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
 def init() -> None:
     """Call the main() function if being invoked as a script. This is here just as a testable way of calling main()."""
     if __name__ == "__main__":
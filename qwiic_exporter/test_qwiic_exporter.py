@@ -3,9 +3,40 @@
 
 Runs with pytest and tox.
 """
+import asyncio
+import gzip
+import http.client
+import http.server
+import io
+import json
 import logging
+import math
+import multiprocessing
+import os
+import pstats
+import struct
+import threading
+import time
+import tty
 
-from qwiic_exporter import QwiicExporter
+import prometheus_client
+import pytest
+import serial
+
+from qwiic_exporter import (
+    FlatPlan,
+    LineFramer,
+    LineGenerator,
+    OpenLogSimulator,
+    Profiler,
+    PushSink,
+    QwiicExporter,
+    ReadingRing,
+    SensorCatalogue,
+    Shard,
+    TextfileFlusher,
+    load_derived_metrics,
+)
 
 
 def test_get_sensor_signatures():
@@ -76,10 +107,19 @@ def test_get_sensor_signatures():
                 ["hPa"],
                 ["degC"],
             ]
+        elif name == "VEML6075 UV sensor":
+            assert qwe.get_subsensor_signatures(data) == [
+                ["uva", "uvb", "uvIndex"],
+                ["uva", "uvb"],
+                ["uva", "uvIndex"],
+                ["uvb", "uvIndex"],
+                ["uva"],
+                ["uvb"],
+                ["uvIndex"],
+            ]
         else:
-            assert (
-                qwe.get_subsensor_signatures(data) is False
-            ), "Unknown sensor, cannot test get_sensor_signatures()"
+            # every other sensor in the catalogue, one signature per non-empty combination
+            assert len(qwe.get_subsensor_signatures(data)) == 2 ** len(data) - 1
 
 
 def test_parse_sensor_config():
@@ -241,4 +281,1151 @@ def test_ingest_data_wrong_metric_count(caplog):
     qwe.ingest_data(
         data="01/07/2000,16:18:45.54,-638.67,153.32,782.23,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,99500.64,53.06,152.98,6.32,1.00,"
     )
+    # a single short line is noise
+    assert "Gauge index is out of sync" not in caplog.text
+    assert qwe.noise_lines == 1
+    assert qwe.header_requests == 0
+
+    # a few in a row are a changed sensor config, and the header line is requested once
+    for _ in range(3):
+        qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,")
     assert "Gauge index is out of sync" in caplog.text
+    assert qwe.noise_lines == 3
+    assert qwe.header_requests == 1
+
+
+def test_resync():
+    """Make sure a changed sensor config is inferred from the header cache, and header requests are rate limited."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.header_interval = 0.2
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count")
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,altitude_m,temp_degC"
+    )
+    assert len(qwe.plan) == 4
+
+    # the third line in a row with 2 readings switches to the cached sensor config and is ingested
+    for count in range(1, 4):
+        qwe.ingest_data(data=f"01/07/2000,16:18:45.54,1.00,{count},")
+    assert qwe.last_ingest is not None
+    assert qwe.provisional_header == "output_Hz,count"
+    assert (
+        list(qwe.registry._names_to_collectors["qwiic_measurements_total"]._samples())[
+            0
+        ][2]
+        == 3
+    )
+    assert qwe.header_requests == 1
+
+    # unknown lineups do not request the header again while a request is pending or recent
+    for count in range(6):
+        qwe.ingest_data(data="01/07/2000,16:18:45.54" + ",1" * (5 + count // 3))
+    assert qwe.header_requests == 1
+    qwe.header_due = None
+    time.sleep(0.2)
+    for _ in range(3):
+        qwe.ingest_data(data="01/07/2000,16:18:45.54,1,1,1,1,1,1,1")
+    assert qwe.header_requests == 2
+    assert qwe.noise_lines == 2 + 2 + 2 + 2
+
+
+def test_evict_series():
+    """Make sure series no longer in the sensor config are removed, after the TTL or beyond the series cap."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count"
+    )
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,99500.64,53.06,152.98,6.32,1.00,1,")
+    assert b"qwiic_humidity_percent" in qwe.exposition.get()
+
+    # without a TTL the series of the BME280 are gone as soon as it is unplugged
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count")
+    exposition = qwe.exposition.get()
+    assert b"qwiic_humidity_percent" not in exposition
+    assert "qwiic_humidity_percent" not in qwe.registry._names_to_collectors
+    # and so are the series of the OpenLog Artemis, which moved from sensorindex 2 to 1
+    assert b'sensorindex="2"' not in exposition
+    assert qwe.series_evicted == 6
+
+    # with a TTL they are kept until it has passed, unless they are plugged in again
+    qwe.series_ttl = 0.1
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count"
+    )
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,pressure_Pa,output_Hz,count")
+    assert len(qwe.retired) == 2 + 3
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,output_Hz,count"
+    )
+    assert len(qwe.retired) == 2 + 2
+    assert qwe.evict_series() == 0
+    time.sleep(0.1)
+    assert qwe.evict_series() == 4
+    assert qwe.retired == {}
+
+    # beyond the cap retired series are evicted oldest first, whatever their age
+    qwe.series_ttl = 3600
+    qwe.max_series = 5
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count"
+    )
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count")
+    assert len(qwe.retired) == 5 - len(qwe.plan)
+
+
+def test_flat_collector():
+    """Make sure the flat collector exports the same metrics as the gauges."""
+    expositions = []
+    for flat in False, True:
+        qwe = QwiicExporter()
+        qwe.use_flat_collector = flat
+        qwe.serialport = "/dev/ttyUSB0"
+        other = qwe.add_device(serialport="/dev/ttyUSB1")
+        for device in qwe.devices:
+            device.serial = MockSerial()
+            device.parse_sensor_config(
+                headerline="rtcDate,rtcTime,aX,aY,aZ,gX,gY,gZ,mX,mY,mZ,imu_degC,tvoc_ppb,co2_ppm,prox(no unit),ambient_lux,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count,"
+            )
+        qwe.ingest_data(
+            data="01/07/2000,16:18:45.54,-638.67,153.32,782.23,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,99500.64,53.06,152.98,6.32,1.00,2523,"
+        )
+        other.ingest_raw_batch(
+            [
+                b"01/07/2000,16:18:45.54,-638.67,153.32,782.23,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,99500.64,53.06,152.98,6.32,1.00,2524,"
+            ]
+        )
+        assert isinstance(qwe.plan, FlatPlan) == flat
+        # the self-metrics include the ingest latency, which differs between runs
+        exposition = qwe.exposition.get().decode("UTF-8")
+        expositions.append(exposition[exposition.index("# HELP qwiic_build_info") :])
+    assert (
+        'qwiic_measurements_total{device="/dev/ttyUSB1",sensor="OpenLog Artemis",sensorindex="5",subsensor="Counter"} 2524.0'
+        in expositions[1]
+    )
+    assert expositions[0] == expositions[1]
+
+
+def test_exposition_template(tmp_path):
+    """Make sure the pre-rendered template gives the same exposition as generate_latest(), and is only rebuilt when the sensor config changes."""
+
+    def expected(qwe):
+        """Return the exposition rendered by prometheus_client, without the sample age which changes all the time."""
+        return [
+            line
+            for line in prometheus_client.generate_latest(qwe.registry).splitlines()
+            if b"sample_age" not in line
+        ]
+
+    def rendered(qwe):
+        """Return the exposition rendered from the template, without the sample age."""
+        return [
+            line
+            for line in qwe.template.render().splitlines()
+            if b"sample_age" not in line
+        ]
+
+    for flat in False, True:
+        qwe = QwiicExporter()
+        qwe.use_flat_collector = flat
+        qwe.series_ttl = 3600
+        qwe.serialport = "/dev/ttyUSB0"
+        other = qwe.add_device(serialport='/dev/"odd"\\port%s')
+        for device in qwe.devices:
+            device.serial = MockSerial()
+        qwe.parse_sensor_config(
+            headerline="rtcDate,rtcTime,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count"
+        )
+        qwe.ingest_data(
+            data="01/07/2000,16:18:45.54,99500.64,53.06,152.98,6.32,1.00,1,"
+        )
+        other.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count")
+        assert rendered(qwe) == expected(qwe)
+        assert qwe.template.builds == 1
+
+        # new values are formatted into the same template
+        other.ingest_data(data="01/07/2000,16:18:45.54,1.00,1e30,")
+        qwe.ingest_data(data="01/07/2000,16:18:45.54,99500.64,nan,152.98,-inf,1.00,2,")
+        assert rendered(qwe) == expected(qwe)
+        assert b'subsensor="Counter"} 1e+30' in qwe.template.render()
+        assert qwe.template.builds == 1
+
+        # a changed sensor config, with retired series kept, and collectors registered later
+        qwe.parse_sensor_config(headerline="rtcDate,rtcTime,temp_degC,output_Hz,count")
+        TextfileFlusher(exporter=qwe, min_interval=3600, max_staleness=7200)
+        assert rendered(qwe) == expected(qwe)
+        assert qwe.template.builds == 2
+
+    qwe.prompath = str(tmp_path / "qwiic.prom")
+    qwe.write_textfile_collector_file()
+    assert os.listdir(tmp_path) == ["qwiic.prom"]
+    assert b"qwiic_measurements_total{" in (tmp_path / "qwiic.prom").read_bytes()
+
+
+def test_derived_metrics():
+    """Make sure derived metrics are computed for every sensor with their inputs, with the labels of the sensor."""
+    for flat in False, True:
+        qwe = QwiicExporter()
+        qwe.serial = MockSerial()
+        qwe.use_flat_collector = flat
+        qwe.derived_metrics = load_derived_metrics()
+        qwe.derived_metrics["qwiic_sea_level_pressure_pascals"]["parameters"][
+            "elevation"
+        ] = 500
+        qwe.parse_sensor_config(
+            headerline="rtcDate,rtcTime,aX,aY,aZ,gX,gY,gZ,mX,mY,mZ,imu_degC,tvoc_ppb,co2_ppm,prox(no unit),ambient_lux,pressure_Pa,humidity_%,altitude_m,temp_degC,output_Hz,count,"
+        )
+        # the IMU has a temperature but no humidity, so only the BME280 gets a dew point
+        assert [labels["sensor"] for labels in qwe.derived.plan.labelsets] == [
+            "BME280 atmospheric sensor",
+            "BME280 atmospheric sensor",
+            "BME280 atmospheric sensor",
+            "ICM-20948 IMU",
+        ]
+        qwe.ingest_raw(
+            b"01/07/2000,16:18:45.54,300.00,400.00,0.00,-1.69,1.47,-0.42,21.45,37.80,-5.85,9.77,2,417,20,0,95000.00,50.00,152.98,20.00,1.00,2523,"
+        )
+        dewpoint, absolute, sealevel, acceleration = qwe.derived.plan.values
+        assert round(dewpoint, 1) == 9.3
+        assert round(absolute, 1) == 8.6
+        assert round(sealevel) == 100669
+        assert acceleration == 0.5
+
+        exposition = qwe.exposition.get()
+        assert (
+            b'qwiic_acceleration_magnitude_gs{sensor="ICM-20948 IMU",sensorindex="1",subsensor="Acceleration magnitude"} 0.5'
+            in exposition
+        )
+        assert (
+            b'qwiic_dew_point_degrees{sensor="BME280 atmospheric sensor",sensorindex="4",subsensor="Dew point"}'
+            in exposition
+        )
+
+        # impossible inputs give NaN instead of an exception, and batches are derived too
+        qwe.ingest_raw_batch(
+            [
+                b"01/07/2000,16:18:45.54,0,0,0,0,0,0,0,0,0,0,0,0,0,0,95000.00,0,0,20.00,1.00,2524,"
+            ]
+        )
+        assert math.isnan(qwe.derived.plan.values[0])
+        assert qwe.derived.plan.values[3] == 0
+
+        # derived series are retired with the sensor
+        qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count")
+        assert qwe.derived is None
+        assert b"qwiic_dew_point_degrees{" not in qwe.exposition.get()
+
+
+def test_textfile_flusher(tmp_path):
+    """Make sure the TextfileFlusher coalesces writes and only writes when something changed."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.prompath = str(tmp_path / "qwiic.prom")
+    flusher = TextfileFlusher(exporter=qwe, min_interval=3600, max_staleness=7200)
+
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    for count in range(10):
+        qwe.ingest_data(data=f"01/07/2000,16:18:45.54,1.00,{count},")
+
+    # first flush happens right away, the next one has to wait for min_interval
+    assert flusher.flush_if_due()
+    assert "qwiic_measurements_total" in (tmp_path / "qwiic.prom").read_text()
+    assert flusher.writes_saved._value.get() == 9
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,10,")
+    assert not flusher.flush_if_due()
+
+    # pending changes are written on stop, and nothing is written when nothing changed
+    flusher.stop()
+    assert flusher.writes._value.get() == 2
+    assert not flusher.flush_if_due()
+
+    # a later flusher of the same exporter, like the one of a second replay(), counts on
+    flusher = TextfileFlusher(exporter=qwe, min_interval=3600, max_staleness=7200)
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,11,")
+    flusher.stop()
+    assert flusher.writes._value.get() == 3
+
+
+def test_http_server():
+    """Make sure the HTTP server serves the cached exposition, with keep-alive and gzip."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.listen = "127.0.0.1:0"
+    server = qwe.start_http_server()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,2523,")
+
+    # two scrapes over the same connection only render once
+    conn = http.client.HTTPConnection(*server.server_address)
+    for _ in range(2):
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        assert response.status == 200
+        assert b"qwiic_measurements_total" in response.read()
+    assert qwe.exposition.renders == 1
+
+    # new values are rendered on the next scrape, gzipped if asked
+    qwe.ingest_data(data="01/07/2000,16:18:46.54,1.00,2524,")
+    conn.request("GET", "/metrics", headers={"Accept-Encoding": "gzip"})
+    response = conn.getresponse()
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert b"2524.0" in gzip.decompress(response.read())
+    assert qwe.exposition.renders == 2
+
+    conn.request("GET", "/nope")
+    assert conn.getresponse().status == 404
+    conn.close()
+    server.shutdown()
+
+    # bracketed IPv6 addresses
+    qwe.listen = "[::1]:0"
+    try:
+        server = qwe.start_http_server()
+    except OSError:
+        pytest.skip("IPv6 is not available")
+    conn = http.client.HTTPConnection("::1", server.server_address[1])
+    conn.request("GET", "/metrics")
+    assert b"2524.0" in conn.getresponse().read()
+    conn.close()
+    server.shutdown()
+
+
+def test_ingest_plan():
+    """Make sure parse_sensor_config() compiles a plan of pre-bound child gauges in header order."""
+    qwe = QwiicExporter()
+    qwe.parse_sensor_config(
+        headerline="rtcDate,rtcTime,aX,aY,aZ,prox(no unit),ambient_lux,output_Hz,"
+    )
+    assert len(qwe.plan) == 6
+    assert list(qwe.plan.multipliers) == [0.001, 0.001, 0.001, 1, 1, 1]
+    assert qwe.plan.children[3] is qwe.registry._names_to_collectors[
+        "qwiic_proximity"
+    ].labels(sensor="VCNL4040 proximity sensor", sensorindex=2, subsensor="Proximity")
+
+
+def test_ingest_raw():
+    """Make sure raw lines from the serial port are ingested without decoding, and bad lines are skipped."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    assert not qwe.handle_line(b"rtcDate,rtcTime,aX,aY,aZ,output_Hz,count,\r\n")
+    assert qwe.handle_line(
+        b"01/07/2000,16:18:45.54,-638.67,153.32,782.23,1.00,2523,\r\n"
+    )
+    gauge = qwe.registry._names_to_collectors["qwiic_accelerometer_x_gs"]
+    assert list(gauge._samples())[0][2] == -0.63867
+
+    # non-numeric readings are rejected and leave the metrics alone
+    assert not qwe.handle_line(b"01/07/2000,16:18:46.54,-6\xff8.67,1,7,1.00,2524,\r\n")
+    assert qwe.rejected_lines == 1
+    assert list(gauge._samples())[0][2] == -0.63867
+    assert qwe.generation == 1
+
+
+def test_ingest_raw_batch():
+    """Make sure a batch of lines updates the metrics with the newest valid line, with and without numpy."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,count,")
+    lines = [f"01/07/2000,16:18:45.54,{i},2,3,{i},".encode() for i in range(40)]
+    lines.insert(10, b"01/07/2000,16:18:45.54,1,2,")
+    gauge = qwe.registry._names_to_collectors["qwiic_accelerometer_x_gs"]
+
+    # the short line is skipped, the rest is converted with numpy if we have it
+    assert qwe.ingest_raw_batch(lines) == 40
+    assert list(gauge._samples())[0][2] == 0.039
+
+    # a non-numeric line makes the batch fall back to converting line by line
+    lines.append(b"01/07/2000,16:18:45.54,1,2,x,41,")
+    qwe.numpy_batch_size = 1000
+    assert qwe.ingest_raw_batch(lines) == 40
+    assert qwe.rejected_lines == 1
+    assert qwe.generation == 80
+
+
+def test_drain():
+    """Make sure a backlog only ingests the newest data line and still handles header lines in order."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.drain_threshold = 100
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,count,")
+    gauge = qwe.registry._names_to_collectors["qwiic_accelerometer_x_gs"]
+    backlog = b"".join(
+        f"01/07/2000,16:18:45.54,{i}000,2,3,{i},\r\n".encode() for i in range(10)
+    )
+
+    # small reads are handled line by line
+    assert qwe.receive(backlog[:45])
+    assert qwe.lines_dropped == 0
+
+    # the rest of the backlog only updates the gauges once, with the newest line
+    assert qwe.receive(backlog[40:] + b"01/07/2000,16:18:45.54,1")
+    assert qwe.generation == 2
+    assert qwe.lines_dropped == 8
+    assert qwe.lines_lagging == 9
+    assert list(gauge._samples())[0][2] == 9.0
+
+    # a new header in the backlog is applied before the data lines that follow it
+    assert qwe.receive(
+        b",2,3,4,\r\nrtcDate,rtcTime,aX,aY,aZ,\r\n"
+        + b"01/07/2000,16:18:45.54,5,6,7,\r\n" * 10
+    )
+    assert len(qwe.plan) == 3
+    assert list(gauge._samples())[0][2] == 0.005
+    assert qwe.lines_dropped == 17
+
+
+def test_line_framer():
+    """Make sure lines are framed across reads, and lines longer than the buffer are discarded."""
+    framer = LineFramer(size=32)
+    stream = io.BytesIO(b"first\r\n\r\nsecond\n" + b"noise" * 10 + b"\nthird\r\nfourth")
+    framer.fill(stream, 1000)
+    assert [bytes(line) for line in framer.lines()] == [b"first", b"second"]
+    assert framer.pending() == b"noisenoisenoisen"
+
+    # the noise does not fit in the buffer, it is skipped up to the next newline
+    lines = []
+    while framer.fill(stream, 1000):
+        lines += [bytes(line) for line in framer.lines()]
+    assert lines == [b"third"]
+    assert framer.overflows == 1
+    assert framer.pending() == b"fourth"
+
+
+def test_multiple_devices():
+    """Make sure more than one device can share a registry, with a device label on the metrics."""
+    qwe = QwiicExporter()
+    qwe.serialport = "/dev/ttyUSB0"
+    other = qwe.add_device(serialport="/dev/ttyUSB1")
+    assert qwe.devices == [qwe, other]
+    assert other.registry is qwe.registry
+    for device in qwe.devices:
+        device.serial = MockSerial()
+
+    # lines can arrive in pieces, and each device has its own header
+    assert not qwe.receive(
+        b"rtcDate,rtcTime,output_Hz,count,\r\n01/07/2000,16:18:45.54,1.00,"
+    )
+    assert qwe.receive(b"2523,\r\n01/07")
+    assert qwe.framer.pending() == b"01/07"
+    other.receive(b"rtcDate,rtcTime,count,\r\n01/07/2000,16:18:45.54,42,\r\n")
+    assert qwe.total_generation() == 2
+
+    samples = list(
+        qwe.registry._names_to_collectors["qwiic_measurements_total"]._samples()
+    )
+    assert [
+        (sample[1]["device"], sample[1]["sensorindex"], sample[2]) for sample in samples
+    ] == [
+        ("/dev/ttyUSB0", "1", 2523),
+        ("/dev/ttyUSB1", "1", 42),
+    ]
+    assert b'device="/dev/ttyUSB1"' in qwe.exposition.get()
+
+
+def test_shard_dead_writer():
+    """Make sure a shard whose worker died while writing neither hangs the front-end nor inverts the sequence."""
+    qwe = QwiicExporter()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,2523,")
+    shard = Shard(multiprocessing.get_context("fork"))
+    shard.retries = 10
+    shard.publish(qwe.generation, qwe.plans())
+    layout, values = shard.read()
+    assert values == [1.0, 2523.0]
+
+    # the worker dies between the two increments of the next write
+    shard.array[0] += 1
+    shard.array[3] = 5.0
+    assert shard.read() == (layout, [1.0, 2523.0])
+
+    # the restarted worker is forked from the front-end and numbers its layouts from 0 again
+    shard.reset()
+    assert shard.read() is None
+    shard.layoutnumbers = {}
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,count,")
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,2524,")
+    shard.publish(qwe.generation, qwe.plans())
+    assert shard.array[0] % 2 == 0
+    layout, values = shard.read()
+    assert [name for name, _, _ in layout] == ["qwiic_measurements_total"]
+    assert values == [2524.0]
+
+
+def test_shard_layouts():
+    """Make sure a header line sent again reuses the layout number of the same header, and only the current plans are kept."""
+    qwe = QwiicExporter()
+    shard = Shard(multiprocessing.get_context("fork"))
+    lines = [
+        ("rtcDate,rtcTime,output_Hz,count,", "01/07/2000,16:18:45.54,1.00,2523,")
+    ] * 3
+    lines.append(("rtcDate,rtcTime,count,", "01/07/2000,16:18:45.54,2523,"))
+    for header, data in lines:
+        qwe.parse_sensor_config(headerline=header)
+        qwe.ingest_data(data=data)
+        shard.publish(qwe.generation, qwe.plans())
+    assert len(shard.layoutnumbers) == 2
+    assert shard.plans == qwe.plans()
+    assert shard.array[2] == 1
+    assert [shard.layouts.get()[0] for _ in range(2)] == [0, 1]
+    assert shard.layouts.empty()
+
+    # a header line after the last data line, the new plans have no values yet
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,")
+    shard.publish(qwe.generation, qwe.plans())
+    assert shard.array[2] == 1
+    assert shard.layouts.empty()
+
+
+def test_workers():
+    """Make sure worker processes ingest a device each, and the front-end exports their values, derived metrics and counters from shared memory."""
+    ptys = [os.openpty() for _ in range(2)]
+    qwe = QwiicExporter()
+    qwe.derived_metrics = {
+        "qwiic_count_magnitude": {
+            "help": "The magnitude of the counter",
+            "subsensor": "Counter magnitude",
+            "function": "magnitude",
+            "inputs": ["qwiic_measurements_total"],
+        }
+    }
+    qwe.serialport = os.ttyname(ptys[0][1])
+    qwe.add_device(serialport=os.ttyname(ptys[1][1]))
+    for _, slave in ptys:
+        tty.setraw(slave)
+    qwe.start_workers()
+    try:
+        for count, (master, _) in enumerate(ptys):
+            # the header is sent once the worker has opened the port and asked for it
+            assert os.read(master, 1) == b"\n"
+            os.write(
+                master,
+                f"rtcDate,rtcTime,output_Hz,count,\r\n01/07/2000,16:18:45.54,1.00,{count + 40},\r\n".encode(
+                    "ASCII"
+                ),
+            )
+        deadline = time.monotonic() + 10
+        # the counters are published after the values
+        lines_read = [
+            f'qwiic_lines_read_total{{device="{os.ttyname(slave)}"}} 2.0'.encode(
+                "ASCII"
+            )
+            for _, slave in ptys
+        ]
+        while (
+            not all(line in qwe.exposition.get() for line in lines_read)
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.05)
+        assert qwe.total_generation() == 2
+        exposition = qwe.exposition.get()
+        for count, (_, slave) in enumerate(ptys):
+            assert (
+                f'qwiic_measurements_total{{device="{os.ttyname(slave)}",sensor="OpenLog Artemis",sensorindex="1",subsensor="Counter"}} {count + 40}.0'.encode(
+                    "ASCII"
+                )
+                in exposition
+            )
+            assert (
+                f'qwiic_count_magnitude{{device="{os.ttyname(slave)}",sensor="OpenLog Artemis",sensorindex="1",subsensor="Counter magnitude"}} {count + 40}.0'.encode(
+                    "ASCII"
+                )
+                in exposition
+            )
+        assert all(line in exposition for line in lines_read)
+        assert (
+            f'qwiic_ingest_duration_seconds_count{{device="{os.ttyname(ptys[0][1])}"}} 1.0'.encode(
+                "ASCII"
+            )
+            in exposition
+        )
+    finally:
+        workers = list(qwe.workers)
+        qwe.stop_workers()
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def test_run_async():
+    """Make sure the asyncio pipeline handles lines from a pty and schedules the header request without sleeping."""
+    master, slave = os.openpty()
+    qwe = QwiicExporter()
+    qwe.serialport = os.ttyname(slave)
+    qwe.header_delay = 0.2
+    qwe.initialise_serial(timeout=0)
+
+    async def scenario():
+        task = asyncio.ensure_future(qwe.run_async())
+        await asyncio.sleep(0.05)
+        # a reboot opens the menu right away, and asks for the header when the delay has passed
+        os.write(master, b"Artemis OpenLog v1.9\r\n")
+        await asyncio.sleep(0.1)
+        assert os.read(master, 100) == b"\n"
+        await asyncio.sleep(0.3)
+        assert os.read(master, 100) == b"h"
+        # lines split across reads are handled
+        os.write(master, b"rtcDate,rtcTime,output_Hz,count,\r\n01/07/2000,16:18:45.")
+        await asyncio.sleep(0.05)
+        os.write(master, b"54,1.00,2523,\r\n")
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert qwe.generation == 1
+    assert qwe.loop is None
+
+    # a serial port which goes away ends the pipeline instead of calling the reader forever
+    async def hangup():
+        task = asyncio.ensure_future(qwe.run_async())
+        await asyncio.sleep(0.05)
+        os.close(master)
+        await asyncio.wait_for(task, timeout=2)
+
+    with pytest.raises((OSError, serial.SerialException)) as excinfo:
+        asyncio.run(hangup())
+    assert not isinstance(excinfo.value, asyncio.TimeoutError)
+    assert qwe.loop is None
+    qwe.serial.close()
+
+
+def test_sensor_catalogue(tmp_path, monkeypatch):
+    """Make sure a catalogue file is compiled once, and loaded from the index file until it changes."""
+    path = tmp_path / "sensors.json"
+    path.write_text(
+        '{"Scale": {"Weight": [{"header": "grams", "metric": "qwiic_weight_grams", "help": "Weight", "multiplier": 0.001}]}}'
+    )
+    indexpath = str(tmp_path / "sensors.index")
+    catalogue = SensorCatalogue.from_index(str(path), indexpath)
+    assert catalogue.sensors == {
+        "Scale": {"Weight": [("grams", "qwiic_weight_grams", "Weight", 0.001)]}
+    }
+    assert os.path.exists(indexpath)
+
+    # the index is used as long as the catalogue is unchanged
+    loaded = SensorCatalogue.from_index(str(path), indexpath)
+    assert loaded.sensors == catalogue.sensors
+    assert loaded.matcher.longest_match(["grams"], 0) == ("Scale", ["Weight"], 1)
+    path.write_text(
+        '{"Scale": {"Weight": [{"header": "kilograms", "metric": "qwiic_weight", "help": "Weight"}]}}'
+    )
+    assert (
+        SensorCatalogue.from_index(str(path), indexpath).sensors["Scale"]["Weight"][0][
+            0
+        ]
+        == "kilograms"
+    )
+
+    # devices use the catalogue of the exporter
+    qwe = QwiicExporter()
+    qwe.use_catalogue(SensorCatalogue.load(str(path)))
+    qwe.serial = MockSerial()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,kilograms,")
+    assert qwe.sensorconfig == [("Scale", ["Weight"])]
+    assert SensorCatalogue.load(str(path)) is SensorCatalogue.load(str(path))
+
+    # the shipped catalogue is not compiled when the exporter is given one
+    monkeypatch.setattr(SensorCatalogue, "loaded", {})
+    qwe = QwiicExporter(catalogue=SensorCatalogue.load(str(path), indexpath))
+    qwe.serialport = "/dev/ttyUSB0"
+    qwe.add_device(serialport="/dev/ttyUSB1")
+    assert qwe.devices[1].sensors is qwe.sensors
+    assert list(SensorCatalogue.loaded) == [(str(path), indexpath)]
+
+
+def test_sensor_catalogue_ambiguous_headers():
+    """Make sure the only sensors with the same header fields in the shipped catalogue are the ones documented."""
+    catalogue = SensorCatalogue.load()
+    sensors = {}
+    for name, subsensors in catalogue.sensors.items():
+        fields = ",".join(
+            metric[0] for metrics in subsensors.values() for metric in metrics
+        )
+        sensors.setdefault(fields, []).append(name)
+    assert [names for names in sensors.values() if len(names) > 1] == [
+        [
+            "AHT20 humidity and temperature sensor",
+            "SHTC3 humidity and temperature sensor",
+        ]
+    ]
+    # MS8607 without pressure logs the same fields, and wins as the later sensor
+    assert (
+        catalogue.matcher.longest_match(["humidity_%", "degC"], 0)[0]
+        == "MS8607 PHT sensor"
+    )
+
+
+def test_signature_matcher():
+    """Make sure the SignatureMatcher finds the same sensor as the signature lookup table for every signature."""
+    qwe = QwiicExporter()
+    for sigstr, sensorname in qwe.get_sensor_signature_lookup_table().items():
+        tokens = sigstr.split(",")
+        match = qwe.matcher.longest_match(tokens, 0)
+        assert match[0] == sensorname
+        assert match[2] == len(tokens)
+        assert [
+            metric[0]
+            for subsensor in match[1]
+            for metric in qwe.sensors[sensorname][subsensor]
+        ] == tokens
+
+    # unknown tokens do not match anything
+    assert qwe.matcher.longest_match(["aX", "foo"], 1) is None
+
+
+def test_header_cache(tmp_path):
+    """Make sure parsed header lines are cached, and a restart ingests with the cached sensor config until the header arrives."""
+    path = str(tmp_path / "headers.json")
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.headercache.load(path, qwe.sensors)
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,output_Hz,")
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,prox(no unit),ambient_lux,")
+
+    # known header lines skip the signature matcher
+    qwe.matcher = None
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,output_Hz,")
+    assert qwe.sensorconfig == [
+        ("ICM-20948 IMU", ["Accelerometer"]),
+        ("OpenLog Artemis", ["Frequency"]),
+    ]
+
+    # a restarted exporter picks the cached sensor config with the right number of metrics
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.headercache.load(path, qwe.sensors)
+    assert qwe.handle_line(b"01/07/2000,16:18:45.54,20,0,")
+    assert qwe.provisional_header == "prox(no unit),ambient_lux"
+    assert not qwe.handle_line(b"01/07/2000,16:18:45.54,20,0,1,")
+    assert qwe.handle_line(b"rtcDate,rtcTime,prox(no unit),ambient_lux,") is False
+    assert qwe.provisional_header is None
+    assert qwe.generation == 1
+
+
+def test_aggregation():
+    """Make sure min/max/mean of every reading in the last complete window is exported."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.aggregation_window = 3600
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,count,")
+    for ax in [100, -300, 500]:
+        qwe.ingest_data(data=f"01/07/2000,16:18:45.54,{ax},0,0,1,")
+    qwe.ingest_raw_batch(
+        [f"01/07/2000,16:18:45.54,{ax},0,0,1,".encode() for ax in range(40)]
+    )
+
+    # nothing is exported until the window is complete
+    assert b"qwiic_accelerometer_x_gs_min" not in qwe.exposition.get()
+    qwe.aggregator.window_end -= 3600
+    qwe.generation += 1
+    exposition = qwe.exposition.get().decode()
+    labels = '{sensor="ICM-20948 IMU",sensorindex="1",subsensor="Accelerometer"}'
+    assert f"qwiic_accelerometer_x_gs_min{labels} -0.3" in exposition
+    assert f"qwiic_accelerometer_x_gs_max{labels} 0.5" in exposition
+    assert f"qwiic_accelerometer_x_gs_mean{labels} 0.0251" in exposition
+    assert 'qwiic_aggregation_window_lines{device=""} 43.0' in exposition
+
+    # a scrape waits for an update in progress instead of rolling the window under it
+    qwe.aggregator.window_end -= 3600
+    with qwe.aggregator.lock:
+        scrape = threading.Thread(target=qwe.exposition.get)
+        qwe.generation += 1
+        scrape.start()
+        scrape.join(timeout=0.2)
+        assert scrape.is_alive()
+    scrape.join()
+    assert b"qwiic_aggregation_window_lines" not in qwe.exposition.get()
+
+
+def test_reading_ring(tmp_path):
+    """Make sure readings are recorded in the ring buffer, wrap around, and export as OpenMetrics."""
+    path = str(tmp_path / "qwiic.ring")
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.ring_path = path
+    qwe.ring_size = 3
+    qwe.open_ring()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    for count in range(5):
+        qwe.ingest_data(f"01/07/2000,16:18:45.54,{count}.00,{count},")
+    qwe.ingest_raw_batch(
+        [b"01/07/2000,16:18:45.54,5.00,5,", b"01/07/2000,16:18:45.54,6.00,6,"]
+    )
+
+    # the ring holds the newest three lines, and survives a restart
+    qwe.ring.close()
+    ring = ReadingRing.open(path)
+    records = list(ring.query())
+    assert [values for _, _, values in records] == [(4.0, 4.0), (5.0, 5.0), (6.0, 6.0)]
+    assert list(ring.query(start=records[1][0])) == records[1:]
+
+    out = io.StringIO()
+    assert ring.export_openmetrics(out, end=records[1][0]) == 2
+    assert out.getvalue() == (
+        "# TYPE qwiic_output_hertz gauge\n"
+        "# HELP qwiic_output_hertz The actual frequency of output from OpenLog Artemis in hertz\n"
+        f'qwiic_output_hertz{{sensor="OpenLog Artemis",sensorindex="1",subsensor="Frequency"}} 4.0 {records[0][0]:.3f}\n'
+        "# TYPE qwiic_measurements_total gauge\n"
+        "# HELP qwiic_measurements_total The number of measurements made by OpenLog Artemis in hertz\n"
+        f'qwiic_measurements_total{{sensor="OpenLog Artemis",sensorindex="1",subsensor="Counter"}} 4.0 {records[0][0]:.3f}\n'
+        "# EOF\n"
+    )
+
+    # the records are as wide as the widest line, and are widened when a wider line comes
+    assert ring.width == 2
+    assert os.path.getsize(path) == ReadingRing.header.size + 3 * 4 * 8
+    qwe.ring = ring
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,aX,aY,aZ,output_Hz,")
+    qwe.ingest_data("01/07/2000,16:18:45.54,1000,2000,3000,7.00,")
+    assert ring.width == 4
+    assert os.path.getsize(path) == ReadingRing.header.size + 3 * 6 * 8
+    assert [values for _, _, values in ring.query()] == [
+        (5.0, 5.0),
+        (6.0, 6.0),
+        (1.0, 2.0, 3.0, 7.0),
+    ]
+    ring.close()
+    ring = ReadingRing.open(path)
+    assert ring.width == 4
+    ring.close()
+
+
+def test_replay(tmp_path):
+    """Make sure a recorded capture is replayed through the same logic as disco() and statistics are collected."""
+    qwe = QwiicExporter()
+    generator = LineGenerator(
+        sensors=qwe.sensors,
+        sensorconfig=[
+            ("VCNL4040 proximity sensor", ["Proximity", "Ambient Light"]),
+            ("OpenLog Artemis", ["Frequency", "Counter"]),
+        ],
+        rate=10,
+        seed=42,
+    )
+    assert (
+        generator.header_line()
+        == b"rtcDate,rtcTime,prox(no unit),ambient_lux,output_Hz,count,\r\n"
+    )
+    capture = tmp_path / "capture.txt"
+    with capture.open("wb") as f:
+        f.write(b"Artemis OpenLog v1.9\r\n")
+        f.write(generator.header_line())
+        for _ in range(100):
+            f.write(generator.data_line())
+        f.write(b"\xff\xfe noise\r\n")
+    assert generator.data_line().startswith(b"01/07/2000,16:18:55.00,")
+
+    qwe.prompath = str(tmp_path / "qwiic.prom")
+    qwe.flush_interval = 0
+    stats = qwe.replay(path=str(capture), trace_memory=True)
+    assert qwe.generation == 100
+    assert "qwiic_measurements_total" in (tmp_path / "qwiic.prom").read_text()
+
+    summary = stats.summary()
+    assert summary["lines"] == 103
+    # the reboot banner and the header line
+    assert summary["stages"]["header"]["count"] == 2
+    assert summary["stages"]["ingest"]["count"] == 101
+    assert summary["stages"]["write"]["count"] == 100
+    assert summary["peak_memory_bytes"] > 0
+    assert "Replayed 103 lines" in stats.report()
+
+
+def test_profiler(tmp_path):
+    """Make sure the profiler splits the time of a replay by stage and stops after the configured seconds."""
+    qwe = QwiicExporter()
+    generator = LineGenerator(
+        sensors=qwe.sensors,
+        sensorconfig=[("OpenLog Artemis", ["Frequency", "Counter"])],
+        rate=10,
+        seed=42,
+    )
+    capture = tmp_path / "capture.txt"
+    with capture.open("wb") as f:
+        f.write(b"Artemis OpenLog v1.9\r\n")
+        f.write(generator.header_line())
+        for _ in range(50):
+            f.write(generator.data_line())
+    qwe.prompath = str(tmp_path / "qwiic.prom")
+    qwe.flush_interval = 0
+
+    path = str(tmp_path / "qwiic.prof")
+    profiler = Profiler(exporter=qwe, path=path, trace_memory=True)
+    summary = profiler.run(lambda: qwe.replay(path=str(capture)))
+    assert summary["lines"] == 52
+    for stage in "serial read", "decode", "header parse", "ingest", "textfile write":
+        assert summary["stages"][stage]["calls"] > 0
+        assert summary["stages"][stage]["seconds"] >= 0
+    # the reboot banner and the header line, and splitting and converting each data line
+    assert summary["stages"]["header parse"]["calls"] == 2
+    assert summary["stages"]["decode"]["calls"] == 100
+    assert summary["stages"]["ingest"]["calls"] == 50
+    assert summary["stages"]["textfile write"]["calls"] == 50
+    assert summary["peak_memory_bytes"] > 0
+    with open(f"{path}.json") as f:
+        assert json.load(f)["stages"] == summary["stages"]
+    assert pstats.Stats(path).total_calls > 0
+    assert "Profiled 52 lines" in Profiler.report(summary)
+
+    started = time.monotonic()
+    Profiler(exporter=qwe, path=path, seconds=0.2).run(lambda: time.sleep(5))
+    assert time.monotonic() - started < 2
+
+
+def test_simulator():
+    """Make sure the simulator answers the header handshake and the exporter survives reboots, noise and truncated lines."""
+    simulator = OpenLogSimulator(
+        sensorconfig=[
+            ("BME280 atmospheric sensor", ["Pressure", "Humidity", "Temperature"]),
+            ("OpenLog Artemis", ["Frequency", "Counter"]),
+        ],
+        rate=500,
+        reboot_probability=0.01,
+        noise_probability=0.02,
+        truncate_probability=0.02,
+        seed=1,
+    )
+    simulator.start()
+    qwe = QwiicExporter()
+    qwe.serialport = simulator.path
+    qwe.header_delay = 0.05
+    qwe.initialise_serial(timeout=0)
+    qwe.request_header()
+
+    async def scenario():
+        task = asyncio.ensure_future(qwe.run_async())
+        await asyncio.sleep(1)
+        task.cancel()
+
+    asyncio.run(scenario())
+    qwe.serial.close()
+    simulator.stop()
+    assert qwe.sensorconfig == [
+        ("BME280 atmospheric sensor", ["Pressure", "Humidity", "Temperature"]),
+        ("OpenLog Artemis", ["Frequency", "Counter"]),
+    ]
+    assert qwe.generation > 100
+    assert simulator.written > 400
+
+
+def test_self_metrics():
+    """Make sure the exporter exports metrics about itself."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.handle_line(b"Artemis OpenLog v1.9\r\n")
+    qwe.handle_line(b"rtcDate,rtcTime,\xff,\r\n")
+    qwe.handle_line(b"rtcDate,rtcTime,output_Hz,count,\r\n")
+    qwe.handle_line(b"01/07/2000,16:18:45.54,1.00,2523,\r\n")
+    qwe.handle_line(b"01/07/2000,16:18:45.54,1.00,x,\r\n")
+    exposition = qwe.exposition.get().decode()
+    assert 'qwiic_lines_read_total{device=""} 5.0' in exposition
+    assert 'qwiic_lines_rejected_total{device=""} 1.0' in exposition
+    assert 'qwiic_decode_errors_total{device=""} 1.0' in exposition
+    assert 'qwiic_header_requests_total{device=""} 1.0' in exposition
+    assert 'qwiic_ingest_duration_seconds_count{device=""} 2.0' in exposition
+    assert 'qwiic_newest_sample_age_seconds{device=""}' in exposition
+    assert "qwiic_textfile_write_duration_seconds_count 0.0" in exposition
+
+
+class StubReceiver(http.server.BaseHTTPRequestHandler):
+    """A stub push receiver, which records every request and answers with the next queued status."""
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+    statuses = []
+
+    def do_POST(self):
+        """Record the request and send the next status."""
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests.append((self.path, self.client_address, dict(self.headers), body))
+        self.send_response(self.statuses.pop(0) if self.statuses else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Keep quiet."""
+
+
+def decode_snappy(data):
+    """Decode a snappy block made of literals only."""
+    position, length, shift = 0, 0, 0
+    while True:
+        length |= (data[position] & 0x7F) << shift
+        shift += 7
+        position += 1
+        if data[position - 1] < 0x80:
+            break
+    decoded = b""
+    while position < len(data):
+        tag = data[position] >> 2
+        assert data[position] & 3 == 0, "not a literal"
+        position += 1
+        if tag >= 60:
+            size = tag - 59
+            tag = int.from_bytes(data[position : position + size], "little")
+            position += size
+        decoded += data[position : position + tag + 1]
+        position += tag + 1
+    assert len(decoded) == length
+    return decoded
+
+
+def decode_protobuf(data):
+    """Decode a protobuf message into a list of (field number, value) with bytes, ints or floats."""
+    fields = []
+    position = 0
+
+    def varint():
+        nonlocal position
+        number, shift = 0, 0
+        while True:
+            number |= (data[position] & 0x7F) << shift
+            shift += 7
+            position += 1
+            if data[position - 1] < 0x80:
+                return number
+
+    while position < len(data):
+        key = varint()
+        if key & 7 == 0:
+            fields.append((key >> 3, varint()))
+        elif key & 7 == 1:
+            fields.append(
+                (key >> 3, struct.unpack("<d", data[position : position + 8])[0])
+            )
+            position += 8
+        else:
+            length = varint()
+            fields.append((key >> 3, data[position : position + length]))
+            position += length
+    return fields
+
+
+def test_push_sink():
+    """Make sure every reading is pushed as remote-write in batches over one connection, and failed batches are retried."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubReceiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubReceiver.requests = []
+    StubReceiver.statuses = [503]
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    # the sink is flushed by hand instead of from its thread
+    qwe.sink = sink = PushSink(
+        url="http://%s:%s/api/v1/write" % server.server_address,
+        batch_size=4,
+        flush_interval=60,
+    )
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+
+    # the first batch is full after two lines, fails, and is sent again with the next batch
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,1,")
+    assert not sink.flush_if_due()
+    qwe.ingest_data(data="01/07/2000,16:18:46.54,1.00,2,")
+    assert sink.flush_if_due()
+    assert len(sink.queue) == 1
+    qwe.ingest_data(data="01/07/2000,16:18:47.54,1.00,3,")
+    sink.stop()
+    server.shutdown()
+    assert sink.send_errors == 1
+    assert sink.samples_sent == 6
+    assert len(StubReceiver.requests) == 3
+
+    # readings with a timestamp which can not be encoded are rejected, and a batch which fails to encode is dropped
+    sink.add(qwe.plan, -1.0, [1.0, 4.0])
+    sink.add(qwe.plan, math.nan, [1.0, 4.0])
+    assert sink.samples_rejected == 4
+    assert not sink.buffer
+    sink.buffer.append((qwe.plan, -1.0, [1.0, 4.0]))
+    sink.buffered = 2
+    sink.flush()
+    assert sink.batches_dropped == 1
+    assert not sink.queue
+    assert len({request[1] for request in StubReceiver.requests}) == 1
+
+    path, _, headers, body = StubReceiver.requests[1]
+    assert path == "/api/v1/write"
+    assert headers["Content-Encoding"] == "snappy"
+    timeseries = [
+        decode_protobuf(series) for _, series in decode_protobuf(decode_snappy(body))
+    ]
+    labels = [
+        dict(
+            tuple(value for _, value in decode_protobuf(label))
+            for field, label in series
+            if field == 1
+        )
+        for series in timeseries
+    ]
+    assert labels == [
+        {
+            b"__name__": b"qwiic_output_hertz",
+            b"sensor": b"OpenLog Artemis",
+            b"sensorindex": b"1",
+            b"subsensor": b"Frequency",
+        },
+        {
+            b"__name__": b"qwiic_measurements_total",
+            b"sensor": b"OpenLog Artemis",
+            b"sensorindex": b"1",
+            b"subsensor": b"Counter",
+        },
+    ]
+    counts = [
+        dict(decode_protobuf(value)) for field, value in timeseries[1] if field == 2
+    ]
+    assert [sample[1] for sample in counts] == [1.0, 2.0]
+    assert all(abs(sample[2] / 1000 - time.time()) < 10 for sample in counts)
+
+
+def test_push_sink_pushgateway():
+    """Make sure only the newest value of each series is pushed to a Pushgateway."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubReceiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubReceiver.requests = []
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.push_url = "http://%s:%s/metrics/job/qwiic" % server.server_address
+    qwe.push_format = "pushgateway"
+    sink = qwe.start_push()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,1,")
+    qwe.ingest_data(data="01/07/2000,16:18:46.54,1.00,2,")
+    sink.stop()
+    server.shutdown()
+    assert [request[3] for request in StubReceiver.requests] == [
+        b"# HELP qwiic_output_hertz The actual frequency of output from OpenLog Artemis in hertz\n"
+        b"# TYPE qwiic_output_hertz gauge\n"
+        b'qwiic_output_hertz{sensor="OpenLog Artemis",sensorindex="1",subsensor="Frequency"} 1.0\n'
+        b"# HELP qwiic_measurements_total The number of measurements made by OpenLog Artemis in hertz\n"
+        b"# TYPE qwiic_measurements_total gauge\n"
+        b'qwiic_measurements_total{sensor="OpenLog Artemis",sensorindex="1",subsensor="Counter"} 2.0\n'
+    ]
+
+
+def test_device_time(tmp_path, caplog):
+    """Make sure readings are timestamped with the device clock, parsing each date once, and drift is reported."""
+    qwe = QwiicExporter()
+    qwe.serial = MockSerial()
+    qwe.device_time = True
+    qwe.ring_path = str(tmp_path / "qwiic.ring")
+    qwe.open_ring()
+    qwe.parse_sensor_config(headerline="rtcDate,rtcTime,output_Hz,count,")
+    qwe.ingest_data(data="01/07/2000,16:18:45.54,1.00,1,")
+    qwe.ingest_raw(b"01/07/2000,16:18:46.54,1.00,2,")
+    qwe.ingest_raw_batch(
+        [b"01/07/2000,23:59:59.99,1.00,3,", b"01/08/2000,00:00:00.99,1.00,4,"]
+    )
+    qwe.ingest_raw(b"01/08/2000,xx,1.00,5,")
+    assert [round(timestamp, 2) for timestamp, _, _ in qwe.ring.query()][:4] == [
+        947261925.54,
+        947261926.54,
+        947289599.99,
+        947289600.99,
+    ]
+    # the str date from ingest_data() is cached apart from the bytes dates
+    assert qwe.clock.dates_parsed == 3
+    assert qwe.clock.errors == 1
+
+    # a device clock from the year 2000 is far off the host clock
+    assert qwe.clock.drift < -600000000
+    assert "Device clock is" in caplog.text
+    assert "qwiic_device_clock_drift_seconds" in qwe.exposition.get().decode()
+    qwe.ring.close()
@@ -21,8 +21,12 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/tykling/QwiicExporter",
     packages=["qwiic_exporter"],
+    package_data={"qwiic_exporter": ["sensors.json", "derived.json"]},
     entry_points={
-        "console_scripts": ["qwiic_exporter = qwiic_exporter.qwiic_exporter:main"]
+        "console_scripts": [
+            "qwiic_exporter = qwiic_exporter.qwiic_exporter:main",
+            "qwiic_simulator = qwiic_exporter.qwiic_exporter:simulator_main",
+        ]
     },
     classifiers=[
         "Programming Language :: Python :: 3.7",
@@ -32,5 +36,6 @@ setuptools.setup(
     ],
     python_requires=">=3.7",
     install_requires=["pyserial", "prometheus_client"],
+    extras_require={"numpy": ["numpy"], "snappy": ["python-snappy"]},
     include_package_data=True,
 )